@@ -1,75 +1,332 @@
 from genericpath import exists
-from glob import glob
 from hashlib import md5
 from multiprocessing import Pool
-from os import mkdir
+from os import mkdir, makedirs, stat, remove
+from glob import glob
+from heapq import heapify, heappop, heappush
 from shutil import rmtree
+from queue import Queue
 import subprocess
+import sys
 import argparse
-from os.path import realpath
+from os.path import realpath, abspath, dirname
+from eigenstrat_io import file_md5
+from eigenstrat_merge import append_individuals, merge_datasets
 
 def read_input_file(filepath):
 	with open(filepath, 'r') as f:
 		return list(map(str.strip, f.readlines()))
 
-def generate_instances(stems):
-	ret = [list(x) for x in zip(stems[0::2], stems[1::2])]
-	if len(stems) % 2 != 0:
-		ret[-1].append(stems[-1])
+def generate_instances(stems, instances=2):
+	ret = [stems[i:i + instances] for i in range(0, len(stems), instances)]
+	if len(ret) > 1 and len(ret[-1]) == 1:
+		ret[-2].extend(ret.pop())
 	return ret
 
-def run_merge(input_stems, suffix, exe):
+def stem_size(stem):
+	"""
+	Returns the size in bytes of a stem's .geno file, used as the cost of rewriting it in a merge.
+	"""
+	return stat(stem + '.geno').st_size
+
+def merge_node(nodes, inputs):
+	"""
+	Returns a new merge node for the given input node indicies. Its size is estimated as the sum of its input sizes, which assumes that the inputs largely share SNPs.
+	"""
+	return {'stem' : None, 'inputs' : inputs, 'level' : max(nodes[i]['level'] for i in inputs) + 1, 'size' : sum(nodes[i]['size'] for i in inputs), 'order' : min(nodes[i]['order'] for i in inputs)}
+
+def build_merge_tree(stems, sizes, instances=2):
+	"""
+	Builds a merge tree of a list of stems, grouping stems (and then merge outputs) in input order, instances at a time.
+
+	RETURNS:
+		nodes: List of node dicts. The first len(stems) nodes are the input stems. Each merge node lists the node indicies of its 'inputs', its 'level' (the depth of the merge in the tree starting from 0) and its estimated output 'size' in bytes. The last node is the final merge.
+	ACCEPTS:
+		stems: List of genotype stems to merge.
+		sizes: List of the sizes of the stems' .geno files.
+		instances: Number of inputs per merge. Defaults to 2.
+	"""
+	nodes = [{'stem' : stem, 'inputs' : [], 'level' : -1, 'size' : size, 'order' : i} for i, (stem, size) in enumerate(zip(stems, sizes))]
+	current = list(range(len(stems)))
+	while len(current) > 1:
+		next_level = []
+		for group in generate_instances(current, instances):
+			nodes.append(merge_node(nodes, group))
+			next_level.append(len(nodes) - 1)
+		current = next_level
+	return nodes
+
+def plan_merge_tree(stems, sizes, instances=2, max_merge_bytes=0):
+	"""
+	Builds a size-aware merge tree, like an optimal (Huffman) merge pattern. The smallest datasets are always merged first, so the large ones are rewritten as few times as possible, which minimizes the total bytes rewritten across all merges.
+
+	RETURNS:
+		nodes: List of node dicts as returned by build_merge_tree().
+	ACCEPTS:
+		stems: List of genotype stems to merge.
+		sizes: List of the sizes of the stems' .geno files.
+		instances: Maximum number of inputs per merge. Defaults to 2.
+		max_merge_bytes: Maximum combined input size of a merge, above which fewer than instances inputs are merged at once. Every merge takes at least two inputs, so the final merges can exceed this. Defaults to 0, no limit.
+	"""
+	nodes = [{'stem' : stem, 'inputs' : [], 'level' : -1, 'size' : size, 'order' : i} for i, (stem, size) in enumerate(zip(stems, sizes))]
+	heap = [(size, i) for i, size in enumerate(sizes)]
+	heapify(heap)
+	# As in an optimal k-way merge pattern, the first merge takes just enough inputs that every later merge can take a full set
+	take = (len(stems) - 2) % (instances - 1) + 2
+	while len(heap) > 1:
+		group = [heappop(heap)[1], heappop(heap)[1]]
+		while len(group) < take and heap and (max_merge_bytes <= 0 or sum(nodes[i]['size'] for i in group) + heap[0][0] <= max_merge_bytes):
+			group.append(heappop(heap)[1])
+		# Keep the inputs of each merge in input stem order
+		group.sort(key=lambda i: nodes[i]['order'])
+		nodes.append(merge_node(nodes, group))
+		heappush(heap, (nodes[-1]['size'], len(nodes) - 1))
+		take = instances
+	return nodes
+
+def stem_key(stem, use_content=False):
+	"""
+	Returns the cache key of an input stem, the md5 of the sizes and mtimes of its .geno/.snp/.ind files, or of their contents if use_content is set. The stem's name is not part of the key.
+	"""
+	key = md5()
+	for ext in ['.geno', '.snp', '.ind']:
+		if use_content:
+			key.update(file_md5(stem + ext).encode('utf-8'))
+		else:
+			file_stat = stat(stem + ext)
+			key.update("{}:{};".format(file_stat.st_size, file_stat.st_mtime_ns).encode('utf-8'))
+	return key.hexdigest()
+
+def assign_output_stems(nodes, exe_key, output_dir, scratch_dir=None):
+	"""
+	Names the output of every merge in a merge tree by a content-addressed key, the md5 of the merge executable and of its inputs' keys in order. A merge's output stem therefore only changes when something in the subtree below it changes, so unchanged subtrees map to outputs from earlier runs.
+
+	ACCEPTS:
+		nodes: Merge tree as returned by build_merge_tree() or plan_merge_tree(), with a 'key' set on every input stem node. The 'key' and 'stem' of each merge node are set.
+		exe_key: md5 of the merge executable.
+		output_dir: Directory holding the merge{level} directory of the final merge.
+		scratch_dir: Directory holding the merge{level} directories of the intermediate merges. Defaults to None, using output_dir.
+	"""
+	for i, node in enumerate(nodes):
+		if node['inputs']:
+			node['key'] = md5("\t".join([exe_key] + [nodes[j]['key'] for j in node['inputs']]).encode('utf-8')).hexdigest()
+			output = "merge{}".format(node['level'])
+			node_dir = output_dir if i == len(nodes) - 1 or scratch_dir is None else scratch_dir
+			node['stem'] = "{}/{}/{}_{}".format(node_dir, output, output, node['key'])
+
+def remove_merge_output(stem):
+	"""
+	Deletes the output files (.geno, .snp, .ind, .oe, ...) of an intermediate merge.
+	"""
+	for path in glob(stem + '.*'):
+		try:
+			remove(path)
+		except OSError as e:
+			print("Error while deleting {}: {}".format(path, e))
+
+def read_completed_keys(md5_key_path):
+	"""
+	Returns the set of merge keys listed in a merge{level}.md5_key file. Keys are only added once their merge has succeeded.
+	"""
+	if not exists(md5_key_path):
+		return set()
+	with open(md5_key_path, 'r') as f:
+		return set(line.split('\t')[0] for line in f if line.strip())
+
+def run_merge(input_stems, output_stem, exe):
 	cmd = [exe]
 	cmd.extend(input_stems)
-	input_stems_str = "\t".join(input_stems)
-	output_md5 = md5(input_stems_str.encode('utf-8')).hexdigest()
-	output_stem = "{}_{}".format(suffix, output_md5)
 	cmd.append(output_stem)
-	with open(suffix + '.md5_key', 'a') as f:
-		f.write('\t'.join([output_md5, input_stems_str]) + '\n')
+	# Run each merge in its own directory so that concurrent merges don't share (or delete) each other's trashdirs
+	work_dir = output_stem + '_work'
+	if exists(work_dir):
+		rmtree(work_dir)
+	mkdir(work_dir)
 	oe = open(output_stem + ".oe", 'w')
-	subprocess.run(cmd, shell=False, stdout=oe, stderr=oe)
+	result = subprocess.run(cmd, shell=False, stdout=oe, stderr=oe, cwd=work_dir)
 	oe.close()
-	pass
+	try:
+		rmtree(work_dir)
+	except OSError as e:
+		print("Error while deleting {}: {}".format(work_dir, e))
+	return output_stem, result.returncode
+
+def run_merge_tree(nodes, exe, max_processes, keep_intermediates=False):
+	"""
+	Runs the merges of a merge tree as a dependency graph. Each merge starts as soon as all of its inputs exist, rather than waiting for every merge of the previous level, and up to max_processes merges run at once.
+	Merges whose output already exists from an earlier run (their key is in the level's .md5_key file) are reused, and the merges below them are skipped entirely.
+	Unless keep_intermediates is set, the output of an intermediate merge is deleted as soon as every merge that reads it has succeeded.
+
+	RETURNS:
+		final_stem: Output stem of the final merge.
+	ACCEPTS:
+		nodes: Merge tree with output stems assigned by assign_output_stems().
+		exe: Path to mergemany.
+		max_processes: Maximum number of concurrent merges.
+		keep_intermediates: Set to True to keep the outputs of intermediate merges, so that later runs can reuse them. Defaults to False.
+	"""
+	completed_keys = {}
+	for node in nodes:
+		if node['inputs']:
+			md5_key_path = "{}.md5_key".format(node['stem'].rsplit('_', 1)[0])
+			if md5_key_path not in completed_keys:
+				completed_keys[md5_key_path] = read_completed_keys(md5_key_path)
+			node['md5_key'] = md5_key_path
+			node['cached'] = node['key'] in completed_keys[md5_key_path] and exists(node['stem'] + '.geno')
+
+	# Only the merges that are not cached and feed into the final merge through other uncached merges need to run
+	needed = set()
+	stack = [len(nodes) - 1]
+	while stack:
+		i = stack.pop()
+		if nodes[i]['inputs'] and not nodes[i]['cached']:
+			needed.add(i)
+			stack.extend(nodes[i]['inputs'])
+	reused = sum(1 for node in nodes if node['inputs'] and node['cached'])
+	print("{} merges to run, {} reused from earlier runs.".format(len(needed), reused))
+
+	parents = {}
+	waiting = {}
+	# Number of merges still to run that read each intermediate merge's output
+	readers = {}
+	for i in needed:
+		for child in nodes[i]['inputs']:
+			parents[child] = i
+			if nodes[child]['inputs']:
+				readers[child] = readers.get(child, 0) + 1
+		waiting[i] = sum(1 for child in nodes[i]['inputs'] if child in needed)
+	done = Queue()
+	pool = Pool(processes=max_processes)
+
+	def submit(i):
+		input_stems = [nodes[child]['stem'] for child in nodes[i]['inputs']]
+		pool.apply_async(run_merge, (input_stems, nodes[i]['stem'], exe), callback=lambda result: done.put((i, result)), error_callback=lambda e: done.put((i, e)))
+
+	running = 0
+	for i in sorted(needed):
+		if waiting[i] == 0:
+			submit(i)
+			running += 1
+	failed = []
+	while running > 0:
+		i, result = done.get()
+		running -= 1
+		if isinstance(result, Exception) or result[1] != 0:
+			failed.append(result if isinstance(result, Exception) else "{} (see {}.oe)".format(result[0], result[0]))
+			continue
+		# Record the merge in its level's md5_key file only once it has succeeded, so that failed merges are never reused
+		with open(nodes[i]['md5_key'], 'a') as f:
+			f.write('\t'.join([nodes[i]['key']] + [nodes[child]['stem'] for child in nodes[i]['inputs']]) + '\n')
+		print("Merged {}".format(result[0]))
+		if not keep_intermediates:
+			for child in nodes[i]['inputs']:
+				if child in readers:
+					readers[child] -= 1
+					if readers[child] == 0:
+						remove_merge_output(nodes[child]['stem'])
+		parent = parents.get(i)
+		if parent is not None:
+			waiting[parent] -= 1
+			# Stop starting new merges once one has failed, but let the running ones finish
+			if waiting[parent] == 0 and not failed:
+				submit(parent)
+				running += 1
+	pool.close()
+	pool.join()
+	if failed:
+		raise RuntimeError("Merges failed: {}".format(", ".join(map(str, failed))))
+	return nodes[-1]['stem']
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="run pairwise (or n-wise) genotype merge iterations")
 	parser.add_argument('input_stems', help="file with stems to merge")
-	# parser.add_argument('-n', '--instances_per_merge', help="number of stems to include in each merge", default=2)
+	parser.add_argument('-n', '--instances_per_merge', help="maximum number of stems to include in each merge", default=2)
+	parser.add_argument('--plan', help="'ordered' groups stems in input order, so that stems added to the end of the list only rerun the merges on their path. 'size' merges the smallest datasets first to minimize the total bytes rewritten, but adding stems can regroup most of the tree. Defaults to 'ordered', or 'size' with --overwrite.", choices=['size', 'ordered'], default=None)
+	parser.add_argument('--max_merge_gb', help="With --plan size, merge fewer than --instances_per_merge stems at once if their .geno files would add up to more than this many GB. Default is no limit.", type=float, default=0)
 	parser.add_argument('-e', '--executable', help="pointer to mergemany", default="/home/np29/o2bin/mergemany") # TODO: make a switch to handle packed/eigenstrat
 	parser.add_argument('-p', "--max_processes", help="Maximun concurrent processes to run", default=20)
-	parser.add_argument('-o', "--overwrite", help="overwrite merge directories", action="store_true")
+	parser.add_argument('-o', "--overwrite", help="overwrite merge directories instead of reusing merges from earlier runs", action="store_true")
+	parser.add_argument('--append_to', help="stem of an existing merged dataset (e.g. an earlier final merge). The input stems' individuals are appended to it on its SNPs in a single pass instead of re-merging everything.", default="")
+	parser.add_argument('--native', help="merge all input stems in a single pass with eigenstrat_merge.merge_datasets() instead of running a tree of mergemany merges", action="store_true")
+	parser.add_argument('--scratch_dir', help="directory for the intermediate merge levels, e.g. on fast scratch storage. Only the final merge is written to the current directory. Defaults to the current directory.", default="")
+	parser.add_argument('--keep_intermediates', help="keep the outputs of intermediate merges so that later runs can reuse them. This is the default unless --overwrite or --scratch_dir is set.", action="store_true", default=None)
+	parser.add_argument('--remove_intermediates', help="delete the output of each intermediate merge as soon as the merge reading it has succeeded, to save scratch space. This is the default with --overwrite or --scratch_dir.", action="store_false", dest='keep_intermediates')
+	parser.add_argument('--content_keys', help="key reused merges on the md5 of the input files' contents instead of their sizes and mtimes", action="store_true")
 
 	args = parser.parse_args()
 
 	input_stems = realpath(args.input_stems)
-	# instances = int(args.instances_per_merge)
+	instances = int(args.instances_per_merge)
+	if instances < 2:
+		raise ValueError("--instances_per_merge must be at least 2!")
 	mergemany_path = realpath(args.executable)
 	max_processes = int(args.max_processes)
 	overwrite = args.overwrite
 
-	stems = read_input_file(input_stems)
-	
-	suffix = 0
-	while len(stems) > 1:
-		instances = generate_instances(stems)
-		output = "merge{}".format(suffix)
-		output_w_dir = "{}/{}".format(output, output)
-		if exists(output) and overwrite:
+	# Merges run in their own directories, so stems must be absolute
+	stems = [abspath(stem) for stem in read_input_file(input_stems) if stem != ""]
+
+	# Append mode: add the new individuals to an existing merge instead of merging along a tree
+	if args.append_to != "":
+		if len(stems) < 1:
+			raise ValueError("At least one stem is needed to append!")
+		base_stem = abspath(args.append_to)
+		append_key = md5("\t".join(stem_key(stem, use_content=args.content_keys) for stem in [base_stem] + stems).encode('utf-8')).hexdigest()
+		if exists("append") and overwrite:
+			rmtree("append")
+		makedirs("append", exist_ok=True)
+		output_stem = abspath("append/append_{}".format(append_key))
+		if append_key in read_completed_keys("append/append.md5_key") and exists(output_stem + '.geno'):
+			print("Reusing {} from an earlier run.".format(output_stem))
+		else:
+			append_individuals(base_stem, stems, output_stem)
+			with open("append/append.md5_key", 'a') as f:
+				f.write('\t'.join([append_key, base_stem] + stems) + '\n')
+		print("Done! Final merge in: {}".format(output_stem))
+		sys.exit(0)
+
+	if len(stems) < 2:
+		raise ValueError("At least two stems are needed to merge!")
+
+	# Native mode: one N-way merge in this process instead of a tree of mergemany runs
+	if args.native:
+		native_key = md5("\t".join(stem_key(stem, use_content=args.content_keys) for stem in stems).encode('utf-8')).hexdigest()
+		if exists("native") and overwrite:
+			rmtree("native")
+		makedirs("native", exist_ok=True)
+		output_stem = abspath("native/native_{}".format(native_key))
+		if native_key in read_completed_keys("native/native.md5_key") and exists(output_stem + '.geno'):
+			print("Reusing {} from an earlier run.".format(output_stem))
+		else:
+			merge_datasets(stems, output_stem)
+			with open("native/native.md5_key", 'a') as f:
+				f.write('\t'.join([native_key] + stems) + '\n')
+		print("Done! Final merge in: {}".format(output_stem))
+		sys.exit(0)
+
+	# Unless starting from scratch, default to the plan and cleanup under which later runs can reuse merges. Intermediates written to a scratch directory are still cleaned up by default, since scratch space is what --scratch_dir is for.
+	scratch_dir = abspath(args.scratch_dir) if args.scratch_dir != "" else None
+	plan = args.plan if args.plan is not None else ('size' if overwrite else 'ordered')
+	keep_intermediates = args.keep_intermediates if args.keep_intermediates is not None else not overwrite and scratch_dir is None
+	if not overwrite and plan == 'size':
+		print("Warning: with --plan size, adding or removing stems can regroup most of the merge tree, so few merges from earlier runs are reused. Use --plan ordered and add new stems to the end of the list for incremental merges.")
+	if not overwrite and not keep_intermediates:
+		print("Warning: intermediate merges are deleted{}, so later runs can only reuse the final merge. Use --keep_intermediates to keep them.".format(" from --scratch_dir" if args.keep_intermediates is None else " with --remove_intermediates"))
+
+	sizes = [stem_size(stem) for stem in stems]
+	if plan == 'size':
+		nodes = plan_merge_tree(stems, sizes, instances, int(args.max_merge_gb * 1024**3))
+	else:
+		nodes = build_merge_tree(stems, sizes, instances)
+	merges = [node for node in nodes if node['inputs']]
+	print("Planned {} merges over {} levels, rewriting an estimated {} bytes in total.".format(len(merges), nodes[-1]['level'] + 1, sum(node['size'] for node in merges)))
+	for i in range(len(stems)):
+		nodes[i]['key'] = stem_key(stems[i], use_content=args.content_keys)
+	assign_output_stems(nodes, file_md5(mergemany_path), abspath("."), scratch_dir)
+	if overwrite:
+		for output in set(glob("merge*/") + (glob(scratch_dir + "/merge*/") if scratch_dir is not None else [])):
 			rmtree(output)
-		mkdir(output)
-		# new_stems = []
-		p = Pool(processes=min(len(stems), max_processes))
-		# for inputs in instances:
-		p.starmap(run_merge, [(x, output_w_dir, mergemany_path) for x in instances])
-			# new_stems.append(output_w_dir)
-		p.close()
-		trash_dirs = glob("./trashdir*")
-		for trash_dir in trash_dirs:
-			try:
-				rmtree(trash_dir)
-			except:
-				print("Error while deleting file : ", trash_dir)
-		suffix += 1
-		stems = [x[:-4] for x in glob((output_w_dir + '*.ind'))]
-	print("Done! Final merge in: {}".format(output))
\ No newline at end of file
+	for node in merges:
+		makedirs(dirname(node['stem']), exist_ok=True)
+	final_stem = run_merge_tree(nodes, mergemany_path, max_processes, keep_intermediates=keep_intermediates)
+	print("Done! Final merge in: {}".format(final_stem))
@@ -1,11 +1,11 @@
 import subprocess
 import json
 from multiprocessing import Pool
-from os.path import basename
+from os.path import basename, getsize
 from pathlib import Path
+from queue import Queue
 import re
 from collections import Counter
-from time import sleep
 
 
 FIELD_MAPPING = {
@@ -22,6 +22,7 @@ FIELD_MAPPING = {
 # LENGTH_DEAM_MAP = json.loads(open("~{write_json(length_deam_map)}", 'r').read()) 
 # CONTDEAM_PL = "~{contDeam_pl}"
 # PROCESSES = int("~{processes}")
+# MEMORY_MB = int("~{memory_mb}")
 # =========================
 
 # debugging variables
@@ -30,6 +31,11 @@ MT_REF = "/n/groups/reich/matt/pipeline/static/mtdna_rsrs.fa"
 LENGTH_DEAM_MAP = json.loads('{"ds.minus": 40, "ds.half": 30, "ds.plus": 20, "ss.minus": 5, "ss.half": 2, "ss.plus": 1}') 
 CONTDEAM_PL = "/home/adm515/dev/schmutzi/src/schmutzi/src/contDeam.pl"
 PROCESSES = int("1")
+MEMORY_MB = int("1000")
+
+# Estimated peak memory of one calmd + contDeam job: a fixed overhead plus an allowance per GB of input BAM
+JOB_BASE_MEMORY_MB = 500
+JOB_MEMORY_MB_PER_BAM_GB = 250
 
 def library_type_from_histogram(histogram):
     library_types = []
@@ -96,6 +102,33 @@ def run_calmd_contDeam(id, bam, histogram, library_type, length_deam_custom):
     except Exception as e:
         print(f"Error processing {id}: {e}")
 
+def estimate_job_memory_mb(bam_bytes):
+    """Estimate the peak memory in MB of one calmd + contDeam job from the size of its BAM."""
+    return JOB_BASE_MEMORY_MB + JOB_MEMORY_MB_PER_BAM_GB * bam_bytes / 1024**3
+
+def run_jobs(jobs, processes, memory_mb):
+    """
+    Run jobs on a pool of workers, largest BAM first so that a big BAM never starts last and sets the wall time.
+    A job only starts while the estimated memory of the running jobs stays within memory_mb, so fewer than processes
+    jobs may run at once when the BAMs are large. A job that exceeds memory_mb on its own runs alone.
+    Results are reported as they complete and returned in the order of jobs.
+    """
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i]["bam_bytes"], reverse=True)
+    done = Queue()
+    running = {}
+    results = [None] * len(jobs)
+    with Pool(processes=processes) as pool:
+        while order or running:
+            while order and len(running) < processes and (not running or sum(running.values()) + jobs[order[0]]["memory_mb"] <= memory_mb):
+                i = order.pop(0)
+                running[i] = jobs[i]["memory_mb"]
+                pool.apply_async(run_calmd_contDeam, args=jobs[i]["args"], callback=lambda result, i=i: done.put((i, result)), error_callback=lambda e, i=i: done.put((i, e)))
+            i, result = done.get()
+            del running[i]
+            results[i] = result if not isinstance(result, Exception) else None
+            print(f"Finished {jobs[i]['args'][0]} ({len(jobs) - len(order) - len(running)} of {len(jobs)} done): {'failed' if results[i] is None else 'ok'}", flush=True)
+    return results
+
 def get_from_list_or_return_none(lst, index):
     """Helper function to safely get an item from a list or return None if index is out of range."""
     try:
@@ -106,9 +139,7 @@ def get_from_list_or_return_none(lst, index):
 with open(DRIVER_PATH, 'r') as driver_file:
     driver_lines = [x.split() for x in driver_file.readlines()] # do not strip whitespace since there are optional fields
 
-pool = Pool(processes=PROCESSES)
-results = []
-
+jobs = []
 for line in driver_lines:
     # Skip empty lines
     if not line:
@@ -120,10 +151,12 @@ for line in driver_lines:
     library_type = get_from_list_or_return_none(line, FIELD_MAPPING["library_type"])
     length_deam_custom = get_from_list_or_return_none(line, FIELD_MAPPING["length_deam_custom"])
 
-    results.append(pool.apply_async(run_calmd_contDeam, args=(id, bam, histogram, library_type, length_deam_custom)))
+    bam_bytes = getsize(bam) if bam and Path(bam).exists() else 0
+    jobs.append({"args" : (id, bam, histogram, library_type, length_deam_custom), "bam_bytes" : bam_bytes, "memory_mb" : estimate_job_memory_mb(bam_bytes)})
 
-pool.close()
-paths_out = [ result.get() for result in results]  # Wait for all processes to complete
-sleep(10)
+paths_out = run_jobs(jobs, PROCESSES, MEMORY_MB)
+failed = [job["args"][0] for job, paths in zip(jobs, paths_out) if paths is None]
+if failed:
+    raise RuntimeError(f"calmd/contDeam failed for: {', '.join(failed)}")
+# Every job has returned by now, so its outputs are complete and no wait is needed before writing the paths
 open("calmd_paths.txt", 'w').write("\n".join(["\t".join(x) for x in paths_out]))
-pool.join()
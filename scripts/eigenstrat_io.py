@@ -0,0 +1,642 @@
+"""
+Shared helpers for reading and writing Eigenstrat (.geno/.snp/.ind) datasets in-process.
+
+Genotype rows are handled as numpy uint8 matrices of ASCII genotype characters ('0', '1', '2', '9'), one row per SNP and one column per individual, so plain-text .geno files can be memory-mapped and sliced without any decoding.
+Plain-text EIGENSTRAT, 2-bit PACKEDANCESTRYMAP and CHUNKED .geno files can be read and written. The format of an existing .geno file is detected from its header.
+
+CHUNKED is a compressed layout of PACKEDANCESTRYMAP records. The records are split into chunks of a fixed number of SNP rows, each chunk is zlib-compressed on its own, and a [geno].idx side index lists the byte offset of every chunk. Readers decompress only the chunks holding the rows they ask for, several at once, so compressed masters on network storage cost less I/O without losing random access.
+"""
+from collections import OrderedDict, namedtuple
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+from os import cpu_count, pread, remove, rename, stat
+from os.path import exists
+import gzip
+import json
+import zlib
+import numpy as np
+
+# Target size of each block of .geno rows held in memory at once while streaming
+BLOCK_BYTES = 256 * 1024 * 1024
+NEWLINE = ord('\n')
+HASH_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Genotype file formats, named as in convertf par files
+EIGENSTRAT = 'EIGENSTRAT'
+PACKEDANCESTRYMAP = 'PACKEDANCESTRYMAP'
+CHUNKED = 'CHUNKED'
+GENO_FORMATS = [EIGENSTRAT, PACKEDANCESTRYMAP, CHUNKED]
+# Formats whose GenoFile records are 2-bit packed records
+PACKED_FORMATS = [PACKEDANCESTRYMAP, CHUNKED]
+# Packed records are never shorter than this many bytes, so that the header always fits in the first record
+PACKED_MIN_RECORD_LEN = 48
+# Map between ASCII genotype characters and 2-bit packed genotype codes. 3 is missing ('9').
+ASCII_TO_CODE = np.full(256, 255, dtype=np.uint8)
+ASCII_TO_CODE[[ord('0'), ord('1'), ord('2'), ord('9')]] = [0, 1, 2, 3]
+CODE_TO_ASCII = np.array([ord('0'), ord('1'), ord('2'), ord('9')], dtype=np.uint8)
+
+# Uncompressed size of each chunk of a CHUNKED geno file, its zlib compression level and the extension of its side index
+CHUNK_BYTES = 4 * 1024 * 1024
+CHUNK_COMPRESSION_LEVEL = 6
+CHUNK_INDEX_SUFFIX = '.idx'
+CHUNK_INDEX_VERSION = 1
+# Number of decompressed chunks each reader keeps for the next read
+CHUNK_CACHE = 4
+
+class GenoFile(namedtuple('GenoFile', ['path', 'format', 'n_ind', 'n_snp', 'records'])):
+	"""
+	An opened .geno file. records is a read-only memmap with one row per SNP: the raw text lines (including newlines) for EIGENSTRAT or the packed records for PACKEDANCESTRYMAP. For CHUNKED it is a ChunkedRecords, which decompresses packed records when indexed and holds an open file and a thread pool until it is closed.
+	"""
+	__slots__ = ()
+
+	def close(self):
+		"""
+		Releases the open file and decompression threads of a CHUNKED file. Memory maps are released when they are no longer referenced.
+		"""
+		if isinstance(self.records, ChunkedRecords):
+			self.records.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+def read_ind_file(ind_path):
+	"""
+	Reads an ind (or driver) file into a list of whitespace-split fields, skipping blank lines.
+
+	RETURNS:
+		ind_data: List of [ID, sex, group ID] field lists in file order.
+	ACCEPTS:
+		ind_path: Path to the ind file.
+	"""
+	with open(ind_path, 'r') as ind_file:
+		return [line.split() for line in ind_file if line.strip()]
+
+def read_snp_file(snp_path):
+	"""
+	Reads a snp file, keeping each line verbatim so that it can be written back out unchanged.
+
+	RETURNS:
+		snp_lines: List of snp file lines, stripped of leading whitespace and including the trailing newline.
+	ACCEPTS:
+		snp_path: Path to the snp file.
+	"""
+	with open(snp_path, 'r') as snp_file:
+		return [line.lstrip() if line.endswith('\n') else line.lstrip() + '\n' for line in snp_file if line.strip()]
+
+def read_snp_ids(snp_path):
+	"""
+	Reads only the SNP ID column of a snp file.
+
+	RETURNS:
+		snp_ids: List of SNP IDs in file order.
+	ACCEPTS:
+		snp_path: Path to the snp file.
+	"""
+	with open(snp_path, 'r') as snp_file:
+		return [line.split()[0] for line in snp_file if line.strip()]
+
+def packed_record_len(n_ind):
+	"""
+	Returns the length in bytes of each record (header or SNP row) of a PACKEDANCESTRYMAP geno file with n_ind individuals.
+	"""
+	return max(PACKED_MIN_RECORD_LEN, (n_ind * 2 + 7) // 8)
+
+def hash_ids(ids):
+	"""
+	Computes the EIGENSOFT hash of a list of individual or SNP IDs, as stored in PACKEDANCESTRYMAP headers and checked by EIGENSOFT programs against the .ind/.snp files.
+
+	RETURNS:
+		id_hash: Unsigned 32-bit hash.
+	ACCEPTS:
+		ids: List of ID strings in file order.
+	"""
+	id_hash = 0
+	for x in ids:
+		x_hash = 0
+		for ch in x.encode():
+			x_hash = (x_hash * 23 + ch) & 0xFFFFFFFF
+		id_hash = ((id_hash * 17) & 0xFFFFFFFF) ^ x_hash
+	return id_hash
+
+def packed_header(n_ind, n_snp, ind_hash, snp_hash):
+	"""
+	Builds the zero-padded header record of a PACKEDANCESTRYMAP geno file.
+	"""
+	header = "GENO {:7d} {:7d} {:x} {:x}".format(n_ind, n_snp, ind_hash, snp_hash).encode()
+	return header.ljust(packed_record_len(n_ind), b'\0')
+
+def transposed_header(n_ind, n_snp, ind_hash, snp_hash):
+	"""
+	Builds the zero-padded header record of a transposed (TGENO) packed geno file, which has one record per individual instead of one per SNP.
+	"""
+	header = "TGENO {:7d} {:7d} {:x} {:x}".format(n_ind, n_snp, ind_hash, snp_hash).encode()
+	return header.ljust(packed_record_len(n_snp), b'\0')
+
+def chunked_header(n_ind, n_snp, ind_hash, snp_hash):
+	"""
+	Builds the zero-padded header of a CHUNKED geno file. It holds the same fields as a PACKEDANCESTRYMAP header, but is always PACKED_MIN_RECORD_LEN bytes long.
+	"""
+	header = "CGENO {:7d} {:7d} {:x} {:x}".format(n_ind, n_snp, ind_hash, snp_hash).encode()
+	return header.ljust(PACKED_MIN_RECORD_LEN, b'\0')
+
+def read_packed_header(geno_path, magic=b'GENO'):
+	"""
+	Reads the header of a PACKEDANCESTRYMAP geno file.
+
+	RETURNS:
+		header: Tuple of (n_ind, n_snp, ind_hash, snp_hash).
+	ACCEPTS:
+		geno_path: Path to the geno file.
+		magic: First word of the header. Defaults to b'GENO'. Use b'TGENO' for transposed files and b'CGENO' for CHUNKED files.
+	"""
+	with open(geno_path, 'rb') as geno_file:
+		return parse_packed_header(geno_file.read(PACKED_MIN_RECORD_LEN), geno_path, magic)
+
+def parse_packed_header(header, geno_path, magic=b'GENO'):
+	"""
+	Parses the first PACKED_MIN_RECORD_LEN bytes of a PACKEDANCESTRYMAP geno file.
+
+	RETURNS:
+		header: Tuple of (n_ind, n_snp, ind_hash, snp_hash).
+	ACCEPTS:
+		header: Bytes of the header record.
+		geno_path: Path to the geno file, used in error messages.
+		magic: First word of the header. Defaults to b'GENO'. Use b'TGENO' for transposed files and b'CGENO' for CHUNKED files.
+	"""
+	fields = header.split(b'\0')[0].split()
+	if len(fields) < 5 or fields[0] != magic:
+		raise ValueError("{} is not a {} geno file!".format(geno_path, {b'TGENO' : "transposed packed", b'CGENO' : CHUNKED}.get(magic, PACKEDANCESTRYMAP)))
+	return int(fields[1]), int(fields[2]), int(fields[3], 16), int(fields[4], 16)
+
+def is_gzip(path):
+	"""
+	Returns True if the file at path is gzip-compressed.
+	"""
+	with open(path, 'rb') as f:
+		return f.read(2) == b'\x1f\x8b'
+
+def detect_geno_format(geno_path):
+	"""
+	Determines whether a geno file is plain-text EIGENSTRAT, PACKEDANCESTRYMAP or CHUNKED from its first bytes.
+
+	RETURNS:
+		geno_format: EIGENSTRAT, PACKEDANCESTRYMAP or CHUNKED.
+	ACCEPTS:
+		geno_path: Path to the geno file.
+	"""
+	with open(geno_path, 'rb') as geno_file:
+		magic = geno_file.read(5)
+	if magic == b'GENO ':
+		return PACKEDANCESTRYMAP
+	if magic == b'CGENO':
+		return CHUNKED
+	if magic == b'TGENO':
+		raise ValueError("{} is a transposed packed geno file, which is not supported!".format(geno_path))
+	return EIGENSTRAT
+
+class ChunkedRecords:
+	"""
+	Read-only view of the packed records of a CHUNKED geno file that can be indexed like the memmap of a PACKEDANCESTRYMAP file, with an integer, a slice or an integer array of SNP rows. Only the chunks holding the requested rows are read and decompressed, on a pool of threads when there are several (zlib releases the GIL). The last few decompressed chunks are kept for the next read, so walking the file in blocks that do not line up with the chunks decompresses each chunk once.
+	"""
+	def __init__(self, geno_path, n_snp, record_len, chunk_rows, offsets, threads=None):
+		self.path = geno_path
+		self.shape = (n_snp, record_len)
+		self.chunk_rows = chunk_rows
+		self.offsets = offsets
+		self.threads = threads if threads is not None else min(8, cpu_count())
+		self.geno_file = open(geno_path, 'rb')
+		self.cache = OrderedDict()
+		self.pool = None
+
+	def read_chunk(self, chunk):
+		"""
+		Reads and decompresses one chunk into a matrix of packed records.
+		"""
+		data = zlib.decompress(pread(self.geno_file.fileno(), self.offsets[chunk + 1] - self.offsets[chunk], self.offsets[chunk]))
+		n_rows = min(self.chunk_rows, self.shape[0] - chunk * self.chunk_rows)
+		if len(data) != n_rows * self.shape[1]:
+			raise ValueError("Chunk {} of {} decompresses to {} bytes instead of {}!".format(chunk, self.path, len(data), n_rows * self.shape[1]))
+		return np.frombuffer(data, dtype=np.uint8).reshape((n_rows, self.shape[1]))
+
+	def read_chunks(self, chunks):
+		"""
+		Returns the decompressed records of each of the given chunks, reading the ones that are not cached in parallel.
+		"""
+		missing = [chunk for chunk in chunks if chunk not in self.cache]
+		if len(missing) > 1 and self.threads > 1:
+			if self.pool is None:
+				self.pool = ThreadPool(self.threads)
+			read = self.pool.map(self.read_chunk, missing)
+		else:
+			read = [self.read_chunk(chunk) for chunk in missing]
+		records = dict(zip(missing, read))
+		for chunk in chunks:
+			if chunk not in records:
+				records[chunk] = self.cache[chunk]
+				self.cache.move_to_end(chunk)
+		for chunk in missing[-CHUNK_CACHE:]:
+			self.cache[chunk] = records[chunk]
+		while len(self.cache) > CHUNK_CACHE:
+			self.cache.popitem(last=False)
+		return [records[chunk] for chunk in chunks]
+
+	def close(self):
+		"""
+		Closes the file and stops the decompression threads.
+		"""
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+		self.geno_file.close()
+		self.cache.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getitem__(self, rows):
+		if isinstance(rows, slice):
+			start, stop, step = rows.indices(self.shape[0])
+			if step == 1:
+				if stop <= start:
+					return np.empty((0, self.shape[1]), dtype=np.uint8)
+				first = start // self.chunk_rows
+				records = np.concatenate(self.read_chunks(list(range(first, (stop - 1) // self.chunk_rows + 1))))
+				return records[start - first * self.chunk_rows:stop - first * self.chunk_rows]
+			rows = np.arange(start, stop, step)
+		if np.isscalar(rows):
+			return self[np.array([rows])][0]
+		rows = np.asarray(rows, dtype=np.int64)
+		rows = np.where(rows < 0, rows + self.shape[0], rows)
+		if rows.size and (rows.min() < 0 or rows.max() >= self.shape[0]):
+			raise IndexError("Row index out of range for {} rows!".format(self.shape[0]))
+		chunks, inverse = np.unique(rows // self.chunk_rows, return_inverse=True)
+		out = np.empty((rows.size, self.shape[1]), dtype=np.uint8)
+		for i, records in enumerate(self.read_chunks([int(chunk) for chunk in chunks])):
+			selected = inverse == i
+			out[selected] = records[rows[selected] - chunks[i] * self.chunk_rows]
+		return out
+
+class ChunkedGenoWriter:
+	"""
+	File-like writer of a CHUNKED geno file, returned by create_geno(). write() takes packed records, which are buffered into chunks of chunk_rows rows and compressed on a pool of threads while later chunks are filled. close() writes the last chunk and then the side index, so a CHUNKED file is only readable once it is complete. The side index is only written if every SNP listed in the header was written, and a writer used in a with statement whose body raises deletes the partial file instead.
+	"""
+	def __init__(self, geno_path, n_ind, n_snp, ind_hash, snp_hash, chunk_bytes=CHUNK_BYTES, level=CHUNK_COMPRESSION_LEVEL, threads=None):
+		# A side index left by an earlier file at this path must not describe the new one while it is written
+		if exists(geno_path + CHUNK_INDEX_SUFFIX):
+			remove(geno_path + CHUNK_INDEX_SUFFIX)
+		self.path = geno_path
+		self.header_n_snp = n_snp
+		self.record_len = packed_record_len(n_ind)
+		self.chunk_rows = max(1, chunk_bytes // self.record_len)
+		self.level = level
+		self.n_ind = n_ind
+		self.n_snp = 0
+		self.buffer = bytearray()
+		self.geno_file = open(geno_path, 'wb')
+		self.geno_file.write(chunked_header(n_ind, n_snp, ind_hash, snp_hash))
+		self.offsets = [self.geno_file.tell()]
+		self.threads = threads if threads is not None else min(8, cpu_count())
+		self.pool = ThreadPool(self.threads)
+		self.pending = []
+
+	def write(self, records):
+		"""
+		Appends packed records, given as a uint8 matrix or as bytes.
+		"""
+		self.buffer += bytes(records) if not isinstance(records, np.ndarray) else np.ascontiguousarray(records).tobytes()
+		chunk_len = self.chunk_rows * self.record_len
+		n_full = len(self.buffer) // chunk_len
+		for i in range(n_full):
+			self.submit(bytes(self.buffer[i * chunk_len:(i + 1) * chunk_len]))
+		del self.buffer[:n_full * chunk_len]
+		# Keep only as many chunks in flight as there are threads compressing them
+		while len(self.pending) > self.threads:
+			self.flush_pending()
+
+	def submit(self, data):
+		self.n_snp += len(data) // self.record_len
+		self.pending.append(self.pool.apply_async(zlib.compress, (data, self.level)))
+
+	def flush_pending(self):
+		compressed = self.pending.pop(0).get()
+		self.geno_file.write(compressed)
+		self.offsets.append(self.offsets[-1] + len(compressed))
+
+	def close(self):
+		if self.geno_file.closed:
+			return
+		if len(self.buffer) % self.record_len != 0:
+			self.abort()
+			raise ValueError("{}: partial packed record written!".format(self.path))
+		if self.buffer:
+			self.submit(bytes(self.buffer))
+			self.buffer = bytearray()
+		while self.pending:
+			self.flush_pending()
+		self.pool.close()
+		self.pool.join()
+		self.geno_file.close()
+		if self.n_snp != self.header_n_snp:
+			remove(self.path)
+			raise ValueError("{}: {} SNPs were written but the header lists {}!".format(self.path, self.n_snp, self.header_n_snp))
+		index = {'version' : CHUNK_INDEX_VERSION, 'n_ind' : self.n_ind, 'n_snp' : self.n_snp, 'record_len' : self.record_len, 'chunk_rows' : self.chunk_rows, 'offsets' : self.offsets}
+		with open(self.path + CHUNK_INDEX_SUFFIX + '.tmp', 'w') as index_file:
+			json.dump(index, index_file)
+		rename(self.path + CHUNK_INDEX_SUFFIX + '.tmp', self.path + CHUNK_INDEX_SUFFIX)
+
+	def abort(self):
+		"""
+		Stops writing and deletes the partial file, without writing the side index.
+		"""
+		if self.geno_file.closed:
+			return
+		self.pool.terminate()
+		self.pool.join()
+		self.geno_file.close()
+		remove(self.path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is not None:
+			self.abort()
+		else:
+			self.close()
+
+def open_chunked(geno_path, n_ind, threads=None):
+	"""
+	Opens a CHUNKED geno file after checking its header against its side index.
+
+	RETURNS:
+		geno: GenoFile whose records are a ChunkedRecords.
+	ACCEPTS:
+		geno_path: Path to the geno file.
+		n_ind: Number of individuals (columns) in the geno file.
+		threads: Number of threads decompressing chunks. Defaults to None, using up to 8 CPUs.
+	"""
+	header_n_ind, n_snp = read_packed_header(geno_path, magic=b'CGENO')[:2]
+	if header_n_ind != n_ind:
+		raise ValueError("{} has {} individuals but {} were expected!".format(geno_path, header_n_ind, n_ind))
+	with open(geno_path + CHUNK_INDEX_SUFFIX, 'r') as index_file:
+		index = json.load(index_file)
+	if index['version'] != CHUNK_INDEX_VERSION or index['n_ind'] != n_ind or index['n_snp'] != n_snp or index['record_len'] != packed_record_len(n_ind):
+		raise ValueError("{} does not match the header of {}!".format(geno_path + CHUNK_INDEX_SUFFIX, geno_path))
+	if len(index['offsets']) - 1 != (n_snp + index['chunk_rows'] - 1) // index['chunk_rows']:
+		raise ValueError("{} lists {} chunks but {} SNPs need {}!".format(geno_path + CHUNK_INDEX_SUFFIX, len(index['offsets']) - 1, n_snp, (n_snp + index['chunk_rows'] - 1) // index['chunk_rows']))
+	records = ChunkedRecords(geno_path, n_snp, index['record_len'], index['chunk_rows'], index['offsets'], threads)
+	return GenoFile(geno_path, CHUNKED, n_ind, n_snp, records)
+
+def open_geno(geno_path, n_ind):
+	"""
+	Memory-maps an EIGENSTRAT or PACKEDANCESTRYMAP geno file without reading it, or opens a CHUNKED geno file for reading chunks on demand. The format is detected from the file header.
+
+	RETURNS:
+		geno: GenoFile describing the memory-mapped geno file.
+	ACCEPTS:
+		geno_path: Path to the geno file.
+		n_ind: Number of individuals (columns) in the geno file, i.e. the length of the matching ind file.
+	"""
+	geno_format = detect_geno_format(geno_path)
+	if geno_format == CHUNKED:
+		return open_chunked(geno_path, n_ind)
+	if geno_format == PACKEDANCESTRYMAP:
+		header_n_ind, n_snp = read_packed_header(geno_path)[:2]
+		if header_n_ind != n_ind:
+			raise ValueError("{} has {} individuals but {} were expected!".format(geno_path, header_n_ind, n_ind))
+		record_len = packed_record_len(n_ind)
+		records = np.memmap(geno_path, dtype=np.uint8, mode='r', offset=record_len, shape=(n_snp, record_len))
+		return GenoFile(geno_path, geno_format, n_ind, n_snp, records)
+
+	records = np.memmap(geno_path, dtype=np.uint8, mode='r')
+	row_len = n_ind + 1
+	if records.size % row_len != 0:
+		raise ValueError("{} is not a fixed-width Eigenstrat geno file with {} individuals!".format(geno_path, n_ind))
+	records = records.reshape((records.size // row_len, row_len))
+	# Only spot check the first and last rows here. Checking every row would page in the whole file.
+	if records.shape[0] > 0 and (records[0, -1] != NEWLINE or records[-1, -1] != NEWLINE):
+		raise ValueError("{} is not a fixed-width Eigenstrat geno file with {} individuals!".format(geno_path, n_ind))
+	return GenoFile(geno_path, geno_format, n_ind, records.shape[0], records)
+
+def unpack_genotypes(packed, n_ind):
+	"""
+	Decodes 2-bit packed genotype records into ASCII genotype rows. The first individual of each record is stored in the highest two bits of the first byte.
+
+	RETURNS:
+		rows: uint8 matrix of ASCII genotype characters, one row per record.
+	ACCEPTS:
+		packed: uint8 matrix of packed records, one row per record.
+		n_ind: Number of genotypes stored in each record.
+	"""
+	codes = np.empty((packed.shape[0], packed.shape[1] * 4), dtype=np.uint8)
+	for i, shift in enumerate((6, 4, 2, 0)):
+		codes[:, i::4] = (packed >> shift) & 3
+	return CODE_TO_ASCII[codes[:, :n_ind]]
+
+def pack_genotypes(rows, record_len):
+	"""
+	Encodes ASCII genotype rows as zero-padded 2-bit packed records.
+
+	RETURNS:
+		packed: uint8 matrix of packed records, one row per input row.
+	ACCEPTS:
+		rows: uint8 matrix of ASCII genotype characters ('0', '1', '2', '9').
+		record_len: Length in bytes of each packed record.
+	"""
+	codes = np.zeros((rows.shape[0], record_len * 4), dtype=np.uint8)
+	codes[:, :rows.shape[1]] = ASCII_TO_CODE[rows]
+	if (codes > 3).any():
+		raise ValueError("Invalid genotype values found! Only 0, 1, 2 and 9 are allowed.")
+	return (codes[:, 0::4] << 6) | (codes[:, 1::4] << 4) | (codes[:, 2::4] << 2) | codes[:, 3::4]
+
+def read_geno_rows(geno, rows):
+	"""
+	Reads SNP rows from an opened geno file as ASCII genotypes, regardless of the on-disk format.
+
+	RETURNS:
+		genotypes: uint8 matrix of ASCII genotype characters, one row per requested SNP.
+	ACCEPTS:
+		geno: GenoFile as returned by open_geno().
+		rows: Slice or integer array of SNP row indicies to read.
+	"""
+	if geno.format in PACKED_FORMATS:
+		return unpack_genotypes(geno.records[rows], geno.n_ind)
+	return geno.records[rows, :-1]
+
+def read_geno_columns(geno, rows, cols):
+	"""
+	Reads a subset of individuals (columns) for a subset of SNP rows without decoding whole rows. Only the bytes holding the requested genotypes are touched, which is much cheaper than read_geno_rows() when few columns are needed.
+
+	RETURNS:
+		genotypes: uint8 matrix of ASCII genotype characters with shape (len(rows), len(cols)).
+	ACCEPTS:
+		geno: GenoFile as returned by open_geno().
+		rows: Integer array of SNP row indicies.
+		cols: Integer array of individual column indicies.
+	"""
+	rows = np.asarray(rows, dtype=np.intp)
+	cols = np.asarray(cols, dtype=np.intp)
+	if geno.format == CHUNKED:
+		packed = geno.records[rows][:, cols // 4]
+		return CODE_TO_ASCII[(packed >> (6 - 2 * (cols % 4)).astype(np.uint8)) & 3]
+	if geno.format == PACKEDANCESTRYMAP:
+		packed = geno.records[np.ix_(rows, cols // 4)]
+		return CODE_TO_ASCII[(packed >> (6 - 2 * (cols % 4)).astype(np.uint8)) & 3]
+	return geno.records[np.ix_(rows, cols)]
+
+def iter_geno_blocks(geno, block_bytes=BLOCK_BYTES):
+	"""
+	Iterates over an opened geno file in contiguous blocks of SNP rows so that the whole file is read exactly once, sequentially.
+
+	RETURNS:
+		Generator of (start_row, stop_row, block) tuples where block is the (stop_row - start_row) x individuals ASCII genotype matrix without newlines.
+	ACCEPTS:
+		geno: GenoFile as returned by open_geno().
+		block_bytes: Approximate number of bytes of genotypes to hold per block. Defaults to BLOCK_BYTES.
+	"""
+	block_rows = max(1, block_bytes // (geno.n_ind + 1))
+	for start in range(0, geno.n_snp, block_rows):
+		stop = min(start + block_rows, geno.n_snp)
+		yield start, stop, read_geno_rows(geno, slice(start, stop))
+
+def iter_geno_stream(geno_path, n_ind, block_bytes=BLOCK_BYTES):
+	"""
+	Reads a geno file sequentially in blocks of SNP rows without memory-mapping it. Unlike iter_geno_blocks(), this also reads gzip-compressed EIGENSTRAT and PACKEDANCESTRYMAP geno files. CHUNKED files are read with iter_geno_blocks().
+
+	RETURNS:
+		Generator of (start_row, stop_row, block) tuples where block is the (stop_row - start_row) x individuals ASCII genotype matrix without newlines.
+	ACCEPTS:
+		geno_path: Path to the geno file, which may be gzip-compressed.
+		n_ind: Number of individuals (columns) in the geno file.
+		block_bytes: Approximate number of bytes of genotypes to hold per block. Defaults to BLOCK_BYTES.
+	"""
+	if not is_gzip(geno_path) and detect_geno_format(geno_path) == CHUNKED:
+		with open_chunked(geno_path, n_ind) as geno:
+			yield from iter_geno_blocks(geno, block_bytes)
+		return
+	opener = gzip.open if is_gzip(geno_path) else open
+	with opener(geno_path, 'rb') as geno_file:
+		pending = geno_file.read(5)
+		if pending == b'TGENO':
+			raise ValueError("{} is a transposed packed geno file, which is not supported!".format(geno_path))
+		packed = pending == b'GENO '
+		if packed:
+			record_len = packed_record_len(n_ind)
+			header_n_ind = parse_packed_header(pending + geno_file.read(record_len - len(pending)), geno_path)[0]
+			if header_n_ind != n_ind:
+				raise ValueError("{} has {} individuals but {} were expected!".format(geno_path, header_n_ind, n_ind))
+			pending = b''
+		else:
+			record_len = n_ind + 1
+		block_rows = max(1, block_bytes // (n_ind + 1))
+		start = 0
+		while True:
+			data = pending + geno_file.read(block_rows * record_len - len(pending))
+			pending = b''
+			if not data:
+				break
+			if len(data) % record_len != 0:
+				raise ValueError("{} is not a fixed-width geno file with {} individuals!".format(geno_path, n_ind))
+			records = np.frombuffer(data, dtype=np.uint8).reshape((len(data) // record_len, record_len))
+			if packed:
+				block = unpack_genotypes(records, n_ind)
+			else:
+				if (records[:, -1] != NEWLINE).any():
+					raise ValueError("{} is not a fixed-width Eigenstrat geno file with {} individuals!".format(geno_path, n_ind))
+				block = records[:, :-1]
+			yield start, start + len(block), block
+			start += len(block)
+
+def create_geno(geno_path, geno_format, ind_ids, snp_ids):
+	"""
+	Opens a new geno file for writing with write_geno_rows(), writing the header first for PACKEDANCESTRYMAP and CHUNKED files. The ind and snp IDs must describe the rows that will be written, in order, since they are hashed into packed headers.
+
+	RETURNS:
+		geno_file: File object opened in binary write mode, or a ChunkedGenoWriter for CHUNKED files.
+	ACCEPTS:
+		geno_path: Path to the geno file to create.
+		geno_format: EIGENSTRAT, PACKEDANCESTRYMAP or CHUNKED.
+		ind_ids: List of individual IDs in output column order.
+		snp_ids: List of SNP IDs in output row order.
+	"""
+	if geno_format not in GENO_FORMATS:
+		raise ValueError("Unknown geno format {}! Must be one of {}.".format(geno_format, ", ".join(GENO_FORMATS)))
+	if geno_format == CHUNKED:
+		return ChunkedGenoWriter(geno_path, len(ind_ids), len(snp_ids), hash_ids(ind_ids), hash_ids(snp_ids))
+	geno_file = open(geno_path, 'wb')
+	if geno_format == PACKEDANCESTRYMAP:
+		geno_file.write(packed_header(len(ind_ids), len(snp_ids), hash_ids(ind_ids), hash_ids(snp_ids)))
+	return geno_file
+
+def write_geno_rows(geno_file, rows, geno_format=EIGENSTRAT):
+	"""
+	Appends genotype rows to an open geno file.
+
+	ACCEPTS:
+		geno_file: File object opened in binary write/append mode, e.g. by create_geno().
+		rows: uint8 matrix of ASCII genotype characters, one row per SNP.
+		geno_format: Format of the geno file. Defaults to EIGENSTRAT.
+	"""
+	if rows.shape[0] == 0:
+		return
+	if geno_format in PACKED_FORMATS:
+		geno_file.write(pack_genotypes(rows, packed_record_len(rows.shape[1])))
+		return
+	out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+	out[:, :-1] = rows
+	out[:, -1] = NEWLINE
+	geno_file.write(out)
+
+def rehash_packed_geno(geno_path, ind_ids=None, snp_ids=None):
+	"""
+	Rewrites the header of a PACKEDANCESTRYMAP or CHUNKED geno file in place after its .ind or .snp file has been edited, so that EIGENSOFT hash checks still pass. The genotype records are not touched.
+
+	ACCEPTS:
+		geno_path: Path to the packed geno file.
+		ind_ids: New list of individual IDs. Defaults to None, keeping the existing individual hash.
+		snp_ids: New list of SNP IDs. Defaults to None, keeping the existing SNP hash.
+	"""
+	chunked = detect_geno_format(geno_path) == CHUNKED
+	n_ind, n_snp, ind_hash, snp_hash = read_packed_header(geno_path, magic=b'CGENO' if chunked else b'GENO')
+	if ind_ids is not None:
+		if len(ind_ids) != n_ind:
+			raise ValueError("{} has {} individuals but {} IDs were given!".format(geno_path, n_ind, len(ind_ids)))
+		ind_hash = hash_ids(ind_ids)
+	if snp_ids is not None:
+		if len(snp_ids) != n_snp:
+			raise ValueError("{} has {} SNPs but {} IDs were given!".format(geno_path, n_snp, len(snp_ids)))
+		snp_hash = hash_ids(snp_ids)
+	with open(geno_path, 'r+b') as geno_file:
+		geno_file.write((chunked_header if chunked else packed_header)(n_ind, n_snp, ind_hash, snp_hash))
+
+def file_md5(path):
+	"""
+	Computes the md5 hex digest of a file's contents, reading it in large blocks.
+
+	RETURNS:
+		digest: md5 hex digest string.
+	ACCEPTS:
+		path: Path to the file to hash.
+	"""
+	file_hash = md5()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b''):
+			file_hash.update(block)
+	return file_hash.hexdigest()
+
+def stat_key(path):
+	"""
+	Returns the [mtime_ns, size] of a file, used to tell whether it has changed without reading it, e.g. to skip re-hashing or re-verifying it.
+	"""
+	file_stat = stat(path)
+	return [file_stat.st_mtime_ns, file_stat.st_size]
@@ -0,0 +1,346 @@
+"""
+Merges Eigenstrat datasets in-process.
+
+merge_datasets() merges any number of datasets at once. Their .snp files are joined on (chromosome, position, SNP ID), encoded as int64 numpy keys and sorted with numpy, and then the merged .geno file is written in one pass. Each output row is gathered from every dataset that has the SNP, and individuals from the other datasets are filled with 9. This replaces the log2(N) levels of rewrites made by merging pairs of datasets with mergemany.
+
+append_individuals() adds the individuals of one or more new datasets to an existing merged dataset. The SNPs of the existing dataset are kept as they are. Its .geno file is streamed once, and the new individuals' genotypes are appended to each row, so a large, stable reference panel is never re-merged just to add a few samples.
+"""
+import argparse
+from os import remove
+from os.path import abspath, exists
+from shutil import copyfile
+from contextlib import ExitStack
+from eigenstrat_io import read_ind_file, read_snp_file, open_geno, read_geno_rows, iter_geno_blocks, create_geno, write_geno_rows, BLOCK_BYTES, CHUNK_INDEX_SUFFIX, GENO_FORMATS
+import numpy as np
+
+# Genotype written for SNPs that a dataset does not have
+MISSING = ord('9')
+# Swapping the alleles of a SNP swaps these genotypes
+FLIP_ALLELES = np.arange(256, dtype=np.uint8)
+FLIP_ALLELES[[ord('0'), ord('2')]] = [ord('2'), ord('0')]
+# Sort ranks of the non-numeric chromosome names used in .snp files, following EIGENSOFT's numbering
+CHROM_RANKS = {'X' : 23, 'Y' : 24, 'MT' : 90, 'XY' : 91}
+# Chromosome names that are neither numbers nor in CHROM_RANKS get codes from here up, so that they sort after all others
+OTHER_CHROM_CODE = 1 << 20
+# Join keys hold the chromosome code above the physical position, which must fit in this many bits
+POSITION_BITS = 40
+
+def chrom_code(chrom, other_chroms):
+	"""
+	Returns the sort code of a chromosome name. Chromosomes sort numerically, then X, Y, MT and XY, then any other names. Other names get codes from OTHER_CHROM_CODE up, numbered by other_chroms, to which new names are added in the order they are seen.
+	"""
+	if chrom.isdigit():
+		return int(chrom)
+	if chrom.upper() in CHROM_RANKS:
+		return CHROM_RANKS[chrom.upper()]
+	return OTHER_CHROM_CODE + other_chroms.setdefault(chrom, len(other_chroms))
+
+def read_snp_keys(snp_lines, other_chroms):
+	"""
+	Parses the columns of a dataset's SNPs that merge_datasets() joins on into numpy arrays.
+
+	RETURNS:
+		loci: int64 array of each SNP's chromosome code (see chrom_code()) shifted above its physical position, so that loci sort by chromosome and then position.
+		ids: Bytes array of SNP IDs.
+		alleles: Bytes matrix of the two alleles of each SNP, empty where the snp file does not list them.
+	ACCEPTS:
+		snp_lines: snp file lines, as returned by read_snp_file().
+		other_chroms: Dict numbering chromosome names other than the numbered ones, X, Y, MT and XY, as used by chrom_code().
+	"""
+	fields = [line.split() for line in snp_lines]
+	chroms, chrom_rows = np.unique(np.array([f[1] for f in fields], dtype=str), return_inverse=True)
+	codes = np.array([chrom_code(chrom, other_chroms) for chrom in chroms], dtype=np.int64)
+	positions = np.array([int(float(f[3])) for f in fields], dtype=np.int64)
+	if positions.size and (positions.min() < 0 or positions.max() >= 1 << POSITION_BITS):
+		raise ValueError("Physical positions must be between 0 and {}!".format((1 << POSITION_BITS) - 1))
+	loci = (codes[chrom_rows.reshape(-1)] << POSITION_BITS) | positions
+	ids = np.array([f[0] for f in fields], dtype=bytes)
+	alleles = np.array([(f + ['', ''])[4:6] for f in fields], dtype=bytes).reshape((len(fields), 2))
+	return loci, ids, alleles
+
+def find_keys(loci, ids, key_loci, key_ids):
+	"""
+	Returns the rows of a sorted set of (locus, SNP ID) keys at which each of key_loci and key_ids are found. Every key must be in the set.
+
+	ACCEPTS:
+		loci: Sorted int64 array of loci, as returned by read_snp_keys().
+		ids: Bytes array of SNP IDs, sorted within each locus.
+		key_loci: int64 array of the loci to look up.
+		key_ids: Bytes array of the SNP IDs to look up.
+	"""
+	rows = np.searchsorted(loci, key_loci)
+	# Only a few loci hold more than one SNP, and only those need their IDs compared
+	stops = np.searchsorted(loci, key_loci, side='right')
+	for k in np.flatnonzero(stops - rows > 1):
+		rows[k] += np.searchsorted(ids[rows[k]:stops[k]], key_ids[k])
+	return rows
+
+def align_snps(base_snp_lines, snp_lines):
+	"""
+	Matches the SNPs of a dataset to the SNPs of the base dataset by SNP ID.
+
+	RETURNS:
+		rows: int64 numpy array over the base SNPs of the matching row in the dataset, or -1 where the dataset does not have the SNP (or its alleles do not match).
+		flip: Boolean numpy array over the base SNPs, True where the dataset lists the SNP's alleles in the opposite order, so 0 and 2 genotypes must be swapped.
+		counts: Dict of the number of dataset SNPs that were 'matched', 'flipped', 'mismatched' (different alleles, left missing) and 'dropped' (not in the base dataset).
+	ACCEPTS:
+		base_snp_lines: snp file lines of the base dataset, as returned by read_snp_file().
+		snp_lines: snp file lines of the dataset being aligned.
+	"""
+	base_rows = {}
+	for i, line in enumerate(base_snp_lines):
+		fields = line.split()
+		base_rows[fields[0]] = (i, fields[4:6])
+	rows = np.full(len(base_snp_lines), -1, dtype=np.int64)
+	flip = np.zeros(len(base_snp_lines), dtype=bool)
+	counts = {'matched' : 0, 'flipped' : 0, 'mismatched' : 0, 'dropped' : 0}
+	for j, line in enumerate(snp_lines):
+		fields = line.split()
+		if fields[0] not in base_rows:
+			counts['dropped'] += 1
+			continue
+		i, base_alleles = base_rows[fields[0]]
+		alleles = fields[4:6]
+		if alleles == base_alleles:
+			counts['matched'] += 1
+		elif alleles == base_alleles[::-1]:
+			counts['flipped'] += 1
+			flip[i] = True
+		else:
+			counts['mismatched'] += 1
+			continue
+		rows[i] = j
+	return rows, flip, counts
+
+def remove_outputs(output_stem):
+	"""
+	Removes the output files of a merge that failed, so that a partial dataset is not left behind. CHUNKED writers already delete their own partial geno file.
+	"""
+	for ext in ['.geno', '.geno' + CHUNK_INDEX_SUFFIX, '.snp', '.ind']:
+		if exists(output_stem + ext):
+			remove(output_stem + ext)
+
+def append_individuals(base_stem, new_stems, output_stem, output_format=None, block_bytes=BLOCK_BYTES):
+	"""
+	Writes a copy of the base dataset with the individuals of new_stems appended, on the base dataset's SNPs. New individuals get missing genotypes for base SNPs that their dataset does not have, and SNPs that are not in the base dataset are dropped. If writing fails, the partial output files are removed.
+
+	RETURNS:
+		output_stem: Path stem of the merged dataset.
+	ACCEPTS:
+		base_stem: Path to the existing merged Eigenstrat files, without extension.
+		new_stems: List of paths to the Eigenstrat files whose individuals are added.
+		output_stem: Path stem for the merged .geno/.snp/.ind files. Must differ from base_stem.
+		output_format: Format of the output geno file, EIGENSTRAT or PACKEDANCESTRYMAP. Defaults to the format of the base geno file.
+		block_bytes: Approximate number of bytes of base genotypes to hold in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	if abspath(output_stem) == abspath(base_stem):
+		raise ValueError("The output stem must differ from the base stem!")
+	base_ind = read_ind_file(base_stem + '.ind')
+	base_snp_lines = read_snp_file(base_stem + '.snp')
+	with ExitStack() as genos:
+		base_geno = genos.enter_context(open_geno(base_stem + '.geno', len(base_ind)))
+		if base_geno.n_snp != len(base_snp_lines):
+			raise IndexError("{} has {} rows but its snp file has {}!".format(base_stem + '.geno', base_geno.n_snp, len(base_snp_lines)))
+		if output_format is None:
+			output_format = base_geno.format
+
+		ind_data = list(base_ind)
+		seen_ids = set(fields[0] for fields in base_ind)
+		new_datasets = []
+		for stem in new_stems:
+			stem_ind = read_ind_file(stem + '.ind')
+			duplicates = seen_ids.intersection(fields[0] for fields in stem_ind)
+			if duplicates:
+				raise ValueError("{} has individuals that are already in the merge: {}".format(stem, ", ".join(sorted(duplicates))))
+			seen_ids.update(fields[0] for fields in stem_ind)
+			ind_data.extend(stem_ind)
+			stem_snp_lines = read_snp_file(stem + '.snp')
+			geno = genos.enter_context(open_geno(stem + '.geno', len(stem_ind)))
+			if geno.n_snp != len(stem_snp_lines):
+				raise IndexError("{} has {} rows but its snp file has {}!".format(stem + '.geno', geno.n_snp, len(stem_snp_lines)))
+			rows, flip, counts = align_snps(base_snp_lines, stem_snp_lines)
+			print("{}: {} individuals, {matched} SNPs matched, {flipped} with swapped alleles, {mismatched} with different alleles and {dropped} not in the base dataset.".format(stem, len(stem_ind), **counts))
+			new_datasets.append((geno, rows, flip))
+
+		try:
+			with open(output_stem + '.ind', 'w') as ind_file:
+				ind_file.writelines("\t".join(fields) + "\n" for fields in ind_data)
+			copyfile(base_stem + '.snp', output_stem + '.snp')
+
+			with create_geno(output_stem + '.geno', output_format, [fields[0] for fields in ind_data], [line.split()[0] for line in base_snp_lines]) as geno_file:
+				for start, stop, block in iter_geno_blocks(base_geno, block_bytes):
+					out = np.empty((stop - start, len(ind_data)), dtype=np.uint8)
+					out[:, :len(base_ind)] = block
+					col = len(base_ind)
+					for geno, rows, flip in new_datasets:
+						block_rows = rows[start:stop]
+						present = block_rows >= 0
+						new_block = np.full((stop - start, geno.n_ind), MISSING, dtype=np.uint8)
+						new_block[present] = read_geno_rows(geno, block_rows[present])
+						block_flip = flip[start:stop]
+						new_block[block_flip] = FLIP_ALLELES[new_block[block_flip]]
+						out[:, col:col + geno.n_ind] = new_block
+						col += geno.n_ind
+					write_geno_rows(geno_file, out, output_format)
+		except BaseException:
+			remove_outputs(output_stem)
+			raise
+	return output_stem
+
+def merge_datasets(stems, output_stem, output_format=None, block_bytes=BLOCK_BYTES):
+	"""
+	Merges any number of datasets in a single pass. The output has the individuals of every dataset, in the order of stems, and the union of their SNPs sorted by chromosome and position. Genotypes of individuals whose dataset does not have a SNP, or lists it with different alleles, are written as 9. Alleles listed in the opposite order to the first dataset with the SNP are flipped to match it. If writing fails, the partial output files are removed.
+	SNPs are joined on int64 keys of their chromosome and position (see read_snp_keys()) and their IDs, with numpy sorts and searches. Each .snp file is read twice, once to build the union of the SNPs and once to map its rows into the union, so only the union and the row maps are held in memory. Row maps are not stored for datasets that have every SNP of the union in order, e.g. pulldowns on the same SNP set.
+
+	RETURNS:
+		output_stem: Path stem of the merged dataset.
+	ACCEPTS:
+		stems: List of paths to the Eigenstrat files to merge, without extension.
+		output_stem: Path stem for the merged .geno/.snp/.ind files. Must differ from every input stem.
+		output_format: Format of the output geno file, EIGENSTRAT or PACKEDANCESTRYMAP. Defaults to the format of the first dataset's geno file.
+		block_bytes: Approximate number of bytes of output genotypes to hold in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	if abspath(output_stem) in [abspath(stem) for stem in stems]:
+		raise ValueError("The output stem must differ from the input stems!")
+	ind_data = []
+	seen_ids = set()
+	datasets = []
+	other_chroms = {}
+	# Union of the SNPs sorted by (locus, ID), with the alleles of the first dataset listing each SNP and where its snp file line is
+	union_loci = np.empty(0, dtype=np.int64)
+	union_ids = np.empty(0, dtype=bytes)
+	union_alleles = np.empty((0, 2), dtype=bytes)
+	union_sources = np.empty(0, dtype=np.int64)
+	union_rows = np.empty(0, dtype=np.int64)
+	with ExitStack() as genos:
+		for i, stem in enumerate(stems):
+			stem_ind = read_ind_file(stem + '.ind')
+			duplicates = seen_ids.intersection(fields[0] for fields in stem_ind)
+			if duplicates:
+				raise ValueError("{} has individuals that are already in the merge: {}".format(stem, ", ".join(sorted(duplicates))))
+			seen_ids.update(fields[0] for fields in stem_ind)
+			ind_data.extend(stem_ind)
+			snp_lines = read_snp_file(stem + '.snp')
+			geno = genos.enter_context(open_geno(stem + '.geno', len(stem_ind)))
+			if geno.n_snp != len(snp_lines):
+				raise IndexError("{} has {} rows but its snp file has {}!".format(stem + '.geno', geno.n_snp, len(snp_lines)))
+			loci, ids, alleles = read_snp_keys(snp_lines, other_chroms)
+			del snp_lines
+			order = np.lexsort((ids, loci))
+			same = (loci[order][1:] == loci[order][:-1]) & (ids[order][1:] == ids[order][:-1])
+			if same.any():
+				raise ValueError("{} lists SNP {} more than once!".format(stem, ids[order][1:][same][0].decode()))
+			datasets.append({'stem' : stem, 'geno' : geno})
+			if len(order) == len(union_loci) and np.array_equal(loci[order], union_loci) and np.array_equal(ids[order], union_ids):
+				continue
+			# The sort is stable, so where a SNP is already in the union its existing entry comes first and is kept
+			all_loci = np.concatenate([union_loci, loci])
+			all_ids = np.concatenate([union_ids, ids])
+			merged = np.lexsort((all_ids, all_loci))
+			first = np.ones(len(merged), dtype=bool)
+			first[1:] = (all_loci[merged][1:] != all_loci[merged][:-1]) | (all_ids[merged][1:] != all_ids[merged][:-1])
+			keep = merged[first]
+			union_loci = all_loci[keep]
+			union_ids = all_ids[keep]
+			union_alleles = np.concatenate([union_alleles, alleles])[keep]
+			union_sources = np.concatenate([union_sources, np.full(len(loci), i, dtype=np.int64)])[keep]
+			union_rows = np.concatenate([union_rows, np.arange(len(loci), dtype=np.int64)])[keep]
+		if output_format is None:
+			output_format = datasets[0]['geno'].format
+
+		# Other chromosome names were numbered as they were seen. Renumber them alphabetically and re-sort the union.
+		renumber = np.zeros(len(other_chroms), dtype=np.int64)
+		for rank, chrom in enumerate(sorted(other_chroms)):
+			renumber[other_chroms[chrom]] = rank
+			other_chroms[chrom] = rank
+		if other_chroms:
+			codes = union_loci >> POSITION_BITS
+			other = codes >= OTHER_CHROM_CODE
+			union_loci[other] = ((OTHER_CHROM_CODE + renumber[codes[other] - OTHER_CHROM_CODE]) << POSITION_BITS) | (union_loci[other] & ((1 << POSITION_BITS) - 1))
+			resort = np.lexsort((union_ids, union_loci))
+			union_loci, union_ids, union_alleles, union_sources, union_rows = (a[resort] for a in (union_loci, union_ids, union_alleles, union_sources, union_rows))
+		snp_ids, snp_counts = np.unique(union_ids, return_counts=True)
+		if (snp_counts > 1).any():
+			raise ValueError("SNP {} is listed at more than one position!".format(snp_ids[snp_counts > 1][0].decode()))
+		del snp_ids, snp_counts
+		n_snp = len(union_loci)
+
+		# Map every dataset's rows to output rows. A dataset's rows are indexed by their rank in its sorted order, so its out_rows increase.
+		# Maps that are the identity, and flip or skip masks that are all False, are stored as None.
+		snp_lines_out = np.empty(n_snp, dtype=object)
+		for i, dataset in enumerate(datasets):
+			snp_lines = read_snp_file(dataset['stem'] + '.snp')
+			loci, ids, alleles = read_snp_keys(snp_lines, other_chroms)
+			order = np.lexsort((ids, loci))
+			out_rows = find_keys(union_loci, union_ids, loci[order], ids[order])
+			own = np.flatnonzero(union_sources == i)
+			for out_row, row in zip(own, union_rows[own]):
+				snp_lines_out[out_row] = snp_lines[row]
+			del snp_lines
+			first_alleles = union_alleles[out_rows]
+			alleles = alleles[order]
+			matched = (alleles == first_alleles).all(axis=1)
+			flip = ~matched & (alleles == first_alleles[:, ::-1]).all(axis=1)
+			skip = ~matched & ~flip
+			dataset['counts'] = {'matched' : int(matched.sum()), 'flipped' : int(flip.sum()), 'mismatched' : int(skip.sum())}
+			dataset['order'] = None if np.array_equal(order, np.arange(len(order))) else order
+			dataset['out_rows'] = None if len(out_rows) == n_snp else out_rows
+			dataset['flip'] = flip if flip.any() else None
+			dataset['skip'] = skip if skip.any() else None
+			if dataset['order'] is not None:
+				print("{}: SNPs are not sorted by chromosome and position, so its rows will be read out of order.".format(dataset['stem']))
+		for dataset in datasets:
+			print("{}: {} individuals, {matched} SNPs matched, {flipped} with swapped alleles and {mismatched} with different alleles.".format(dataset['stem'], dataset['geno'].n_ind, **dataset['counts']))
+		print("Merging {} individuals on {} SNPs.".format(len(ind_data), n_snp))
+
+		try:
+			with open(output_stem + '.snp', 'w') as snp_file:
+				snp_file.writelines(snp_lines_out)
+			with open(output_stem + '.ind', 'w') as ind_file:
+				ind_file.writelines("\t".join(fields) + "\n" for fields in ind_data)
+			del snp_lines_out
+
+			block_rows = max(1, block_bytes // (len(ind_data) + 1))
+			with create_geno(output_stem + '.geno', output_format, [fields[0] for fields in ind_data], [snp_id.decode() for snp_id in union_ids]) as geno_file:
+				for start in range(0, n_snp, block_rows):
+					stop = min(start + block_rows, n_snp)
+					out = np.full((stop - start, len(ind_data)), MISSING, dtype=np.uint8)
+					col = 0
+					for dataset in datasets:
+						geno = dataset['geno']
+						if dataset['out_rows'] is None:
+							lo, hi = start, stop
+							dest = slice(0, stop - start)
+						else:
+							lo, hi = np.searchsorted(dataset['out_rows'], [start, stop])
+							dest = dataset['out_rows'][lo:hi] - start
+						block = read_geno_rows(geno, slice(lo, hi) if dataset['order'] is None else dataset['order'][lo:hi])
+						if dataset['flip'] is not None or dataset['skip'] is not None:
+							# Rows read with a slice can be a read-only view of an EIGENSTRAT memmap
+							block = np.array(block)
+						if dataset['flip'] is not None:
+							block_flip = dataset['flip'][lo:hi]
+							block[block_flip] = FLIP_ALLELES[block[block_flip]]
+						if dataset['skip'] is not None:
+							block[dataset['skip'][lo:hi]] = MISSING
+						out[dest, col:col + geno.n_ind] = block
+						col += geno.n_ind
+					write_geno_rows(geno_file, out, output_format)
+		except BaseException:
+			remove_outputs(output_stem)
+			raise
+	return output_stem
+
+if __name__ == "__main__":
+	Parser = argparse.ArgumentParser(description="Merge Eigenstrat datasets in a single pass, or append the individuals of new datasets to an existing merged dataset, keeping its SNPs.")
+	Parser.add_argument('--base', help="Path to an existing merged Eigenstrat dataset, without extension. The --new individuals are appended to it on its SNPs. If not given, the --new datasets are merged on the union of their SNPs.", type=str, default="")
+	Parser.add_argument('--new', help="Paths to the Eigenstrat files to merge or append, without extension.", nargs='+', required=True)
+	Parser.add_argument('--output', help="Path stem for the merged output files.", type=str, required=True)
+	Parser.add_argument('--output_format', help="Format of the output geno file. Defaults to the format of the base (or first) geno file.", choices=GENO_FORMATS, default=None)
+	args = Parser.parse_args()
+
+	new_stems = [abspath(stem) for stem in args.new]
+	if args.base != "":
+		append_individuals(base_stem=abspath(args.base), new_stems=new_stems, output_stem=abspath(args.output), output_format=args.output_format)
+	else:
+		merge_datasets(new_stems, output_stem=abspath(args.output), output_format=args.output_format)
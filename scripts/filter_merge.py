@@ -1,5 +1,7 @@
 import argparse
 from os import rename
+from os.path import exists
+from eigenstrat_io import detect_geno_format, rehash_packed_geno, read_ind_file, PACKED_FORMATS
 
 def read_driver(driver_filename):
 	driver_dict = {}
@@ -32,6 +34,10 @@ def update_ind_file(ind_filename, driver_dict):
 					new_ind.write('\t'.join([pulldownID, sex, "Ignore"]) + '\n')
 	rename(ind_filename, '{}.pdOrig'.format(ind_filename))
 	rename('{}.tmp'.format(ind_filename), ind_filename)
+	# Packed geno headers carry a hash of the individual IDs, which must match the updated ind file
+	geno_filename = ind_filename[:-4] + '.geno' if ind_filename.endswith('.ind') else ind_filename + '.geno'
+	if exists(geno_filename) and detect_geno_format(geno_filename) in PACKED_FORMATS:
+		rehash_packed_geno(geno_filename, ind_ids=[fields[0] for fields in read_ind_file(ind_filename)])
 	pass
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+"""
+Converts the .geno file of an Eigenstrat dataset to or from the CHUNKED compressed format described in eigenstrat_io.py.
+
+Every script that opens .geno files through eigenstrat_io reads CHUNKED files directly and only decompresses the chunks it needs, so a master can be stored compressed and still be subset, reordered, merged and verified.
+"""
+import argparse
+from os.path import abspath
+from shutil import copyfile
+from eigenstrat_io import read_ind_file, read_snp_ids, open_geno, iter_geno_blocks, create_geno, write_geno_rows, hash_ids, ChunkedGenoWriter, BLOCK_BYTES, CHUNK_BYTES, CHUNK_COMPRESSION_LEVEL, CHUNKED, GENO_FORMATS, PACKED_FORMATS
+
+def compress_geno(input_stem, output_stem, output_format=CHUNKED, chunk_bytes=CHUNK_BYTES, level=CHUNK_COMPRESSION_LEVEL, threads=None, block_bytes=BLOCK_BYTES):
+	"""
+	Writes a copy of a dataset with its .geno file in another format. Packed records are copied without decoding between PACKEDANCESTRYMAP and CHUNKED files, since CHUNKED files store PACKEDANCESTRYMAP records.
+
+	RETURNS:
+		output_stem: Path stem of the converted dataset.
+	ACCEPTS:
+		input_stem: Path to the input Eigenstrat files, without extension.
+		output_stem: Path stem for the output .geno/.snp/.ind files.
+		output_format: Format of the output geno file. Defaults to CHUNKED.
+		chunk_bytes: Uncompressed size of each chunk of a CHUNKED output in bytes. Defaults to CHUNK_BYTES.
+		level: zlib compression level of a CHUNKED output, 1 (fastest) to 9 (smallest). Defaults to CHUNK_COMPRESSION_LEVEL.
+		threads: Number of threads compressing or decompressing chunks. Defaults to None, using up to 8 CPUs.
+		block_bytes: Approximate number of bytes of genotypes to hold in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	ind_ids = [fields[0] for fields in read_ind_file(input_stem + '.ind')]
+	snp_ids = read_snp_ids(input_stem + '.snp')
+	with open_geno(input_stem + '.geno', len(ind_ids)) as geno:
+		if geno.n_snp != len(snp_ids):
+			raise IndexError("{} has {} rows but its snp file has {}!".format(input_stem + '.geno', geno.n_snp, len(snp_ids)))
+		if geno.format == CHUNKED and threads is not None:
+			geno.records.threads = threads
+		copyfile(input_stem + '.ind', output_stem + '.ind')
+		copyfile(input_stem + '.snp', output_stem + '.snp')
+		if output_format == CHUNKED:
+			geno_file = ChunkedGenoWriter(output_stem + '.geno', len(ind_ids), len(snp_ids), hash_ids(ind_ids), hash_ids(snp_ids), chunk_bytes=chunk_bytes, level=level, threads=threads)
+		else:
+			geno_file = create_geno(output_stem + '.geno', output_format, ind_ids, snp_ids)
+		with geno_file:
+			if geno.format in PACKED_FORMATS and output_format in PACKED_FORMATS:
+				block_rows = max(1, block_bytes // geno.records.shape[1])
+				for start in range(0, geno.n_snp, block_rows):
+					geno_file.write(geno.records[start:start + block_rows])
+			else:
+				for start, stop, block in iter_geno_blocks(geno, block_bytes):
+					write_geno_rows(geno_file, block, output_format)
+	return output_stem
+
+if __name__ == "__main__":
+	Parser = argparse.ArgumentParser(description="Convert an Eigenstrat .geno file to or from the chunked, compressed CHUNKED format.")
+	Parser.add_argument('--input', help="Path to the input Eigenstrat files, without extension.", type=str, required=True)
+	Parser.add_argument('--output', help="Path stem for the converted output files.", type=str, required=True)
+	Parser.add_argument('--output_format', help="Format of the output geno file. Default is CHUNKED.", choices=GENO_FORMATS, default=CHUNKED)
+	Parser.add_argument('--chunk_mb', help="Uncompressed size in MB of each chunk of a CHUNKED output. Default is {}.".format(CHUNK_BYTES // 1024**2), type=float, default=CHUNK_BYTES / 1024**2)
+	Parser.add_argument('--level', help="zlib compression level of a CHUNKED output, 1 (fastest) to 9 (smallest). Default is {}.".format(CHUNK_COMPRESSION_LEVEL), type=int, choices=range(1, 10), default=CHUNK_COMPRESSION_LEVEL)
+	Parser.add_argument('-t', '--threads', help="Number of threads compressing or decompressing chunks. Defaults to up to 8 CPUs.", type=int, default=None)
+	args = Parser.parse_args()
+
+	compress_geno(abspath(args.input), abspath(args.output), output_format=args.output_format, chunk_bytes=int(args.chunk_mb * 1024**2), level=args.level, threads=args.threads)
@@ -0,0 +1,232 @@
+"""
+Reorders the individuals and/or the SNPs of an Eigenstrat dataset to match driver files. Replaces c_eig_reorder and c_snp_reorder.
+
+Genotypes are never loaded whole, and both axes are reordered in a single pass over the .geno file. Individuals are reordered by permuting the columns of each block of SNP rows. SNPs are reordered by gathering rows from the memory-mapped .geno file in output order, or, when the .geno file cannot be memory-mapped (e.g. it is gzip-compressed), by an external bucket sort through scratch files. Either way memory use is bounded by --memory_mb rather than by the size of the dataset.
+"""
+import argparse
+from os import remove
+from os.path import abspath, realpath, dirname, join, exists
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+from eigenstrat_io import read_ind_file, read_snp_file, read_snp_ids, open_geno, read_geno_rows, iter_geno_stream, create_geno, write_geno_rows, pack_genotypes, unpack_genotypes, detect_geno_format, is_gzip, EIGENSTRAT, GENO_FORMATS
+import numpy as np
+
+# Default memory budget for genotype data
+DEFAULT_MEMORY_MB = 1024
+# The external sort keeps one scratch file open per bucket
+MAX_BUCKETS = 512
+
+def build_permutation(source_ids, target_ids, id_type="individual"):
+	"""
+	Builds the permutation that takes items in source order to target order using a hash lookup of the source IDs, so each target ID is found in constant time.
+
+	RETURNS:
+		permutation: intp numpy array where permutation[i] is the source position of the i-th target ID.
+	ACCEPTS:
+		source_ids: List of IDs in input file order.
+		target_ids: List of the same IDs in the desired output order.
+		id_type: Name of the kind of ID, used in error messages. Defaults to "individual".
+	"""
+	source_positions = {}
+	for i, source_id in enumerate(source_ids):
+		if source_id in source_positions:
+			raise ValueError("Duplicate {} ID {} in the input!".format(id_type, source_id))
+		source_positions[source_id] = i
+	if len(target_ids) != len(source_positions):
+		raise ValueError("The driver lists {} {} IDs but the input has {}!".format(len(target_ids), id_type, len(source_positions)))
+	permutation = np.empty(len(target_ids), dtype=np.intp)
+	for i, target_id in enumerate(target_ids):
+		try:
+			permutation[i] = source_positions[target_id]
+		except KeyError:
+			raise KeyError("{} ID {} from the driver is not in the input!".format(id_type.capitalize(), target_id))
+	if len(np.unique(permutation)) != len(permutation):
+		raise ValueError("The driver lists the same {} ID more than once!".format(id_type))
+	return permutation
+
+def find_geno(input_stem):
+	"""
+	Returns the path of the geno file for input_stem, which is [stem].geno or, failing that, [stem].geno.gz.
+	"""
+	if not exists(input_stem + '.geno') and exists(input_stem + '.geno.gz'):
+		return input_stem + '.geno.gz'
+	return input_stem + '.geno'
+
+def rows_per_block(n_ind, memory_bytes):
+	"""
+	Returns how many SNP rows of n_ind individuals can be processed at once within memory_bytes, allowing for the input rows, their reordered copy and the output buffer.
+	"""
+	return max(1, memory_bytes // (3 * (n_ind + 1)))
+
+def gather_snp_rows(geno, permutation, geno_file, output_format, block_rows, ind_permutation=None):
+	"""
+	Writes the rows of a memory-mapped geno file in permutation order, optionally permuting the individuals of each row too. Each block of output rows is read from the input in ascending row order, so the memory map is walked forwards, and then put back into output order.
+
+	ACCEPTS:
+		geno: GenoFile as returned by open_geno().
+		permutation: intp numpy array of input row positions in output order.
+		geno_file: Output file object as returned by create_geno().
+		output_format: Format of the output geno file.
+		block_rows: Number of rows to gather at once.
+		ind_permutation: intp numpy array of input individual positions in output order. Defaults to None, keeping the input order.
+	"""
+	# Raw records can be copied straight across when neither the format nor the individuals change
+	raw = output_format == geno.format and ind_permutation is None
+	for start in range(0, len(permutation), block_rows):
+		source_rows = permutation[start:start + block_rows]
+		order = np.argsort(source_rows)
+		if raw:
+			rows = geno.records[source_rows[order]]
+		else:
+			rows = read_geno_rows(geno, source_rows[order])
+			if ind_permutation is not None:
+				rows = rows[:, ind_permutation]
+		out = np.empty_like(rows)
+		out[order] = rows
+		if raw:
+			geno_file.write(out)
+		else:
+			write_geno_rows(geno_file, out, output_format)
+
+def external_reorder_rows(geno_path, n_ind, permutation, geno_file, output_format, block_rows, scratch_dir, ind_permutation=None):
+	"""
+	Writes the rows of a geno file in permutation order with an external bucket sort, for geno files that cannot be memory-mapped. The individuals of each row can be permuted too. The input is read once, sequentially, and each row is appended to the scratch file of the block of output rows it belongs to. Each bucket is then loaded, put in order and written out. Scratch rows are stored 2-bit packed.
+
+	ACCEPTS:
+		geno_path: Path to the input geno file, which may be gzip-compressed.
+		n_ind: Number of individuals in the input geno file.
+		permutation: intp numpy array of input row positions in output order.
+		geno_file: Output file object as returned by create_geno().
+		output_format: Format of the output geno file.
+		block_rows: Number of rows held in memory at once, which is also the number of output rows per bucket.
+		scratch_dir: Directory in which to create the scratch files.
+		ind_permutation: intp numpy array of input individual positions in output order. Defaults to None, keeping the input order.
+	"""
+	n_snp = len(permutation)
+	n_buckets = (n_snp + block_rows - 1) // block_rows
+	if n_buckets > MAX_BUCKETS:
+		raise ValueError("Sorting {} SNPs in this memory budget needs {} scratch buckets, more than the {} allowed. Increase --memory_mb.".format(n_snp, n_buckets, MAX_BUCKETS))
+	target_positions = np.empty(n_snp, dtype=np.int64)
+	target_positions[permutation] = np.arange(n_snp)
+	record_len = (n_ind + 3) // 4
+	bucket_dir = mkdtemp(prefix='geno_reorder_', dir=scratch_dir)
+	try:
+		row_paths = [join(bucket_dir, '{}.rows'.format(b)) for b in range(n_buckets)]
+		target_paths = [join(bucket_dir, '{}.targets'.format(b)) for b in range(n_buckets)]
+		row_files = [open(path, 'wb') for path in row_paths]
+		target_files = [open(path, 'wb') for path in target_paths]
+		try:
+			n_read = 0
+			for start, stop, block in iter_geno_stream(geno_path, n_ind, block_rows * (n_ind + 1)):
+				if stop > n_snp:
+					raise IndexError("{} has more rows than its snp file!".format(geno_path))
+				targets = target_positions[start:stop]
+				buckets = targets // block_rows
+				order = np.argsort(buckets, kind='stable')
+				bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+				packed = pack_genotypes(block[order], record_len)
+				for b in np.flatnonzero(np.diff(bounds)):
+					row_files[b].write(packed[bounds[b]:bounds[b + 1]])
+					target_files[b].write(targets[order[bounds[b]:bounds[b + 1]]].tobytes())
+				n_read = stop
+			if n_read != n_snp:
+				raise IndexError("{} has {} rows but its snp file has {}!".format(geno_path, n_read, n_snp))
+		finally:
+			for f in row_files + target_files:
+				f.close()
+
+		for b in range(n_buckets):
+			packed = np.fromfile(row_paths[b], dtype=np.uint8).reshape((-1, record_len))
+			targets = np.fromfile(target_paths[b], dtype=np.int64) - b * block_rows
+			rows = np.empty((len(targets), n_ind), dtype=np.uint8)
+			rows[targets] = unpack_genotypes(packed, n_ind)
+			write_geno_rows(geno_file, rows if ind_permutation is None else rows[:, ind_permutation], output_format)
+			remove(row_paths[b])
+			remove(target_paths[b])
+	finally:
+		rmtree(bucket_dir, ignore_errors=True)
+
+def reorder_dataset(input_stem, output_stem, ind_driver_path="", snp_driver_path="", output_format=None, memory_bytes=DEFAULT_MEMORY_MB * 1024**2, method='auto', scratch_dir=None):
+	"""
+	Writes a copy of an Eigenstrat dataset with its individuals and/or SNPs in the order of the driver files. When both are given, the two permutations are applied together in a single pass over the .geno file.
+
+	RETURNS:
+		output_stem: Path stem of the reordered dataset.
+	ACCEPTS:
+		input_stem: Path to the input Eigenstrat files, without extension. The geno file may be gzip-compressed and named [stem].geno or [stem].geno.gz.
+		output_stem: Path stem for the reordered .geno/.snp/.ind files. Must differ from input_stem.
+		ind_driver_path: Path to a file listing every input individual ID, one per line, in the desired order. Only the first column is used, so an ind file also works. Defaults to "", keeping the input individual order and copying the .ind file.
+		snp_driver_path: Path to a file listing every input SNP ID, one per line, in the desired order. Only the first column is used, so a snp file also works. Defaults to "", keeping the input SNP order and copying the .snp file.
+		output_format: Format of the output geno file, EIGENSTRAT or PACKEDANCESTRYMAP. Defaults to the format of the input.
+		memory_bytes: Memory budget for genotype data in bytes. Defaults to DEFAULT_MEMORY_MB.
+		method: How to reorder SNPs. 'gather' to read rows from the memory-mapped input in output order, 'external' to bucket sort through scratch files, or 'auto' to gather unless the input is gzip-compressed. Defaults to 'auto'.
+		scratch_dir: Directory for the external sort's scratch files. Defaults to the output directory.
+	"""
+	if realpath(output_stem) == realpath(input_stem):
+		raise ValueError("The output stem must differ from the input stem!")
+	ind_data = read_ind_file(input_stem + '.ind')
+	snp_lines = read_snp_file(input_stem + '.snp')
+	input_geno = find_geno(input_stem)
+	compressed = is_gzip(input_geno)
+	if output_format is None:
+		output_format = EIGENSTRAT if compressed else detect_geno_format(input_geno)
+
+	ind_permutation = None
+	if ind_driver_path != "":
+		ind_permutation = build_permutation([fields[0] for fields in ind_data], [fields[0] for fields in read_ind_file(ind_driver_path)])
+		with open(output_stem + '.ind', 'w') as ind_file:
+			ind_file.writelines("\t".join(ind_data[i]) + "\n" for i in ind_permutation)
+		ind_ids = [ind_data[i][0] for i in ind_permutation]
+	else:
+		copyfile(input_stem + '.ind', output_stem + '.ind')
+		ind_ids = [fields[0] for fields in ind_data]
+
+	snp_permutation = None
+	if snp_driver_path != "":
+		snp_permutation = build_permutation([line.split()[0] for line in snp_lines], read_snp_ids(snp_driver_path), id_type="SNP")
+		with open(output_stem + '.snp', 'w') as snp_file:
+			snp_file.writelines(snp_lines[i] for i in snp_permutation)
+		snp_ids = [snp_lines[i].split()[0] for i in snp_permutation]
+	else:
+		copyfile(input_stem + '.snp', output_stem + '.snp')
+		snp_ids = [line.split()[0] for line in snp_lines]
+
+	if method == 'auto':
+		method = 'external' if compressed else 'gather'
+	if snp_permutation is not None and method == 'gather' and compressed:
+		raise ValueError("{} is gzip-compressed and cannot be memory-mapped. Use the external method.".format(input_geno))
+
+	block_rows = rows_per_block(len(ind_data), memory_bytes)
+	with create_geno(output_stem + '.geno', output_format, ind_ids, snp_ids) as geno_file:
+		# Without a SNP permutation the rows are already in output order, so just stream them
+		if snp_permutation is None:
+			n_read = 0
+			for start, stop, block in iter_geno_stream(input_geno, len(ind_data), block_rows * (len(ind_data) + 1)):
+				write_geno_rows(geno_file, block if ind_permutation is None else block[:, ind_permutation], output_format)
+				n_read = stop
+			if n_read != len(snp_lines):
+				raise IndexError("{} has {} rows but its snp file has {}!".format(input_geno, n_read, len(snp_lines)))
+		elif method == 'gather':
+			with open_geno(input_geno, len(ind_data)) as geno:
+				if geno.n_snp != len(snp_lines):
+					raise IndexError("{} has {} rows but its snp file has {}!".format(input_geno, geno.n_snp, len(snp_lines)))
+				gather_snp_rows(geno, snp_permutation, geno_file, output_format, block_rows, ind_permutation)
+		else:
+			external_reorder_rows(input_geno, len(ind_data), snp_permutation, geno_file, output_format, block_rows, scratch_dir if scratch_dir is not None else dirname(output_stem), ind_permutation)
+	return output_stem
+
+if __name__ == "__main__":
+	Parser = argparse.ArgumentParser(description="Reorder the individuals and/or the SNPs of an Eigenstrat dataset to match driver files.")
+	Parser.add_argument('--input', help="Path to the input Eigenstrat files, without extension. The geno file may be gzip-compressed and named [input].geno or [input].geno.gz.", type=str, required=True)
+	Parser.add_argument('--ind_driver', help="File listing every individual ID in the desired output order, one per line. Only the first column is used, so an ind file can be given.", type=str, default="")
+	Parser.add_argument('--snp_driver', help="File listing every SNP ID in the desired output order, one per line. Only the first column is used, so a snp file can be given.", type=str, default="")
+	Parser.add_argument('--output', help="Path stem for the reordered output files.", type=str, required=True)
+	Parser.add_argument('--output_format', help="Format of the output geno file. Defaults to the format of the input geno file, or EIGENSTRAT for gzip-compressed input.", choices=GENO_FORMATS, default=None)
+	Parser.add_argument('--memory_mb', help="Memory budget in MB for genotype data. The ID tables and .snp lines are held in memory in addition to this. Default is {}.".format(DEFAULT_MEMORY_MB), type=int, default=DEFAULT_MEMORY_MB)
+	Parser.add_argument('--snp_method', help="How to reorder SNPs: 'gather' reads rows from the memory-mapped input in output order, 'external' bucket sorts through scratch files. 'auto' (default) gathers unless the input is gzip-compressed.", choices=['auto', 'gather', 'external'], default='auto')
+	Parser.add_argument('--scratch_dir', help="Directory for the scratch files of the external SNP sort. Defaults to the output directory.", type=str, default=None)
+	args = Parser.parse_args()
+
+	if args.ind_driver == "" and args.snp_driver == "":
+		Parser.error("Specify --ind_driver, --snp_driver or both.")
+	reorder_dataset(input_stem=abspath(args.input), output_stem=abspath(args.output), ind_driver_path=abspath(args.ind_driver) if args.ind_driver != "" else "", snp_driver_path=abspath(args.snp_driver) if args.snp_driver != "" else "", output_format=args.output_format, memory_bytes=args.memory_mb * 1024**2, method=args.snp_method, scratch_dir=args.scratch_dir)
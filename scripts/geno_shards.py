@@ -0,0 +1,347 @@
+"""
+Splits Eigenstrat datasets into one shard per chromosome and runs operations on the shards in parallel.
+
+A sharded dataset [stem] is a [stem].shards.json manifest, a single [stem].ind file and, for each chromosome, a [stem].chr[chrom].geno/.snp pair. Each shard's [stem].chr[chrom].ind is a symlink to [stem].ind, so every shard is also a complete Eigenstrat dataset that any other script can read. The manifest is written last, so a sharded dataset whose manifest exists is complete.
+
+Subsetting, merging, reordering and verifying run per shard across a process pool, and a monolithic dataset is only written when one is requested with the concat operation.
+"""
+import argparse
+import json
+import sys
+from multiprocessing import Pool
+from os import cpu_count, remove, rename, symlink
+from os.path import abspath, basename, exists, islink
+from shutil import copyfile
+from eigenstrat_io import read_ind_file, read_snp_file, open_geno, read_geno_rows, read_geno_columns, iter_geno_blocks, create_geno, write_geno_rows, BLOCK_BYTES, GENO_FORMATS
+from eigenstrat_merge import merge_datasets
+from geno_reorder import reorder_dataset
+from geno_verify import verify_dataset
+import numpy as np
+
+MANIFEST_SUFFIX = '.shards.json'
+MANIFEST_VERSION = 1
+OPERATIONS = ['split', 'concat', 'subset', 'merge', 'reorder', 'verify']
+
+def shard_stem(stem, chrom):
+	"""
+	Returns the path stem of the shard of a sharded dataset holding one chromosome.
+	"""
+	return "{}.chr{}".format(stem, chrom)
+
+def is_sharded(stem):
+	"""
+	Returns True if stem is a complete sharded dataset, i.e. its manifest exists.
+	"""
+	return exists(stem + MANIFEST_SUFFIX)
+
+def read_manifest(stem):
+	"""
+	Reads the manifest of a sharded dataset.
+
+	RETURNS:
+		manifest: Dict with the 'version', the geno 'format', 'n_ind' and the list of 'shards', each a dict with its 'chrom' and 'n_snp', in chromosome order.
+	ACCEPTS:
+		stem: Path stem of the sharded dataset.
+	"""
+	with open(stem + MANIFEST_SUFFIX, 'r') as manifest_file:
+		manifest = json.load(manifest_file)
+	if manifest.get('version') != MANIFEST_VERSION:
+		raise ValueError("{} has manifest version {} but version {} is supported!".format(stem + MANIFEST_SUFFIX, manifest.get('version'), MANIFEST_VERSION))
+	return manifest
+
+def shard_stems(stem):
+	"""
+	Returns the path stems of the shards of a sharded dataset, in chromosome order.
+	"""
+	return [shard_stem(stem, shard['chrom']) for shard in read_manifest(stem)['shards']]
+
+def clear_shard_inds(stem, chroms):
+	"""
+	Removes the .ind files of existing shards before workers rewrite them. Shard .ind files are symlinks to [stem].ind, so writing through them would overwrite the shared file.
+	"""
+	for chrom in chroms:
+		ind_path = shard_stem(stem, chrom) + '.ind'
+		if exists(ind_path) or islink(ind_path):
+			remove(ind_path)
+
+def finish_sharded(stem, chroms, geno_format):
+	"""
+	Completes a sharded dataset whose shard .geno/.snp files and [stem].ind have been written: points every shard's .ind at [stem].ind and then writes the manifest.
+
+	ACCEPTS:
+		stem: Path stem of the sharded dataset.
+		chroms: List of the chromosomes of the shards, in order.
+		geno_format: Format of the shard geno files.
+	"""
+	n_ind = len(read_ind_file(stem + '.ind'))
+	shards = []
+	clear_shard_inds(stem, chroms)
+	for chrom in chroms:
+		symlink(basename(stem) + '.ind', shard_stem(stem, chrom) + '.ind')
+		shards.append({'chrom' : chrom, 'n_snp' : len(read_snp_file(shard_stem(stem, chrom) + '.snp'))})
+	manifest = {'version' : MANIFEST_VERSION, 'format' : geno_format, 'n_ind' : n_ind, 'shards' : shards}
+	with open(stem + MANIFEST_SUFFIX + '.tmp', 'w') as manifest_file:
+		json.dump(manifest, manifest_file, indent=1)
+	rename(stem + MANIFEST_SUFFIX + '.tmp', stem + MANIFEST_SUFFIX)
+
+def write_shard(input_stem, output_stem, rows, snp_lines, output_format, block_bytes=BLOCK_BYTES):
+	"""
+	Writes the given SNP rows of a monolithic dataset as one shard. Run in a worker process.
+
+	ACCEPTS:
+		input_stem: Path to the monolithic Eigenstrat files, without extension.
+		output_stem: Path stem of the shard.
+		rows: Sorted integer array of the SNP rows in the shard.
+		snp_lines: List of the .snp file lines of the shard's rows, so that workers do not each read the full .snp file.
+		output_format: Format of the shard's geno file.
+		block_bytes: Approximate number of bytes of genotypes to hold in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	ind_ids = [fields[0] for fields in read_ind_file(input_stem + '.ind')]
+	with open(output_stem + '.snp', 'w') as snp_file:
+		snp_file.writelines(snp_lines)
+	with open_geno(input_stem + '.geno', len(ind_ids)) as geno, create_geno(output_stem + '.geno', output_format, ind_ids, [line.split()[0] for line in snp_lines]) as geno_file:
+		block_rows = max(1, block_bytes // (len(ind_ids) + 1))
+		for start in range(0, len(rows), block_rows):
+			block = rows[start:start + block_rows]
+			# Shards of a dataset sorted by chromosome are contiguous, so copy them as raw records
+			if output_format == geno.format and block[-1] - block[0] == len(block) - 1:
+				geno_file.write(geno.records[block[0]:block[-1] + 1])
+			else:
+				write_geno_rows(geno_file, read_geno_rows(geno, block), output_format)
+
+def shard_dataset(input_stem, output_stem, output_format=None, processes=1, block_bytes=BLOCK_BYTES):
+	"""
+	Splits a monolithic dataset into one shard per chromosome, writing the shards in parallel. Shards are in the order in which their chromosomes first appear in the .snp file, and each keeps the input order of its SNPs.
+
+	RETURNS:
+		output_stem: Path stem of the sharded dataset.
+	ACCEPTS:
+		input_stem: Path to the monolithic Eigenstrat files, without extension.
+		output_stem: Path stem for the sharded dataset.
+		output_format: Format of the shard geno files, EIGENSTRAT or PACKEDANCESTRYMAP. Defaults to the format of the input.
+		processes: Number of shards written at once. Defaults to 1.
+		block_bytes: Approximate number of bytes of genotypes each worker holds in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	n_ind = len(read_ind_file(input_stem + '.ind'))
+	snp_lines = read_snp_file(input_stem + '.snp')
+	with open_geno(input_stem + '.geno', n_ind) as geno:
+		if geno.n_snp != len(snp_lines):
+			raise IndexError("{} has {} rows but its snp file has {}!".format(input_stem + '.geno', geno.n_snp, len(snp_lines)))
+		if output_format is None:
+			output_format = geno.format
+	chrom_rows = {}
+	for i, line in enumerate(snp_lines):
+		chrom_rows.setdefault(line.split()[1], []).append(i)
+	copyfile(input_stem + '.ind', output_stem + '.ind')
+	tasks = [(input_stem, shard_stem(output_stem, chrom), np.array(rows, dtype=np.int64), [snp_lines[i] for i in rows], output_format, block_bytes) for chrom, rows in chrom_rows.items()]
+	with Pool(processes=max(1, min(processes, len(tasks)))) as pool:
+		pool.starmap(write_shard, tasks)
+	finish_sharded(output_stem, list(chrom_rows), output_format)
+	return output_stem
+
+def concat_shards(input_stem, output_stem, output_format=None, block_bytes=BLOCK_BYTES):
+	"""
+	Writes a sharded dataset as a monolithic dataset, concatenating its shards in manifest order.
+
+	RETURNS:
+		output_stem: Path stem of the monolithic dataset.
+	ACCEPTS:
+		input_stem: Path stem of the sharded dataset.
+		output_stem: Path stem for the monolithic .geno/.snp/.ind files.
+		output_format: Format of the output geno file, EIGENSTRAT or PACKEDANCESTRYMAP. Defaults to the format of the shards.
+		block_bytes: Approximate number of bytes of genotypes to hold in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	manifest = read_manifest(input_stem)
+	if output_format is None:
+		output_format = manifest['format']
+	ind_ids = [fields[0] for fields in read_ind_file(input_stem + '.ind')]
+	snp_ids = []
+	with open(output_stem + '.snp', 'w') as snp_file:
+		for stem in shard_stems(input_stem):
+			snp_lines = read_snp_file(stem + '.snp')
+			snp_file.writelines(snp_lines)
+			snp_ids.extend(line.split()[0] for line in snp_lines)
+	copyfile(input_stem + '.ind', output_stem + '.ind')
+	with create_geno(output_stem + '.geno', output_format, ind_ids, snp_ids) as geno_file:
+		for stem in shard_stems(input_stem):
+			with open_geno(stem + '.geno', len(ind_ids)) as geno:
+				if geno.format == output_format:
+					# Records of the same format and width can be copied as they are. Only packed headers differ between the shards and the output.
+					block_rows = max(1, block_bytes // geno.records.shape[1])
+					for start in range(0, geno.n_snp, block_rows):
+						geno_file.write(geno.records[start:start + block_rows])
+				else:
+					for start, stop, block in iter_geno_blocks(geno, block_bytes):
+						write_geno_rows(geno_file, block, output_format)
+	return output_stem
+
+def subset_shard(input_stem, output_stem, cols, output_format, block_bytes=BLOCK_BYTES):
+	"""
+	Writes the given individuals (columns) of one shard. Run in a worker process.
+
+	ACCEPTS:
+		input_stem: Path stem of the input shard.
+		output_stem: Path stem of the output shard.
+		cols: Integer array of the input columns of the individuals to keep, in output order.
+		output_format: Format of the output geno file.
+		block_bytes: Approximate number of bytes of genotypes to hold in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	ind_data = read_ind_file(input_stem + '.ind')
+	snp_lines = read_snp_file(input_stem + '.snp')
+	copyfile(input_stem + '.snp', output_stem + '.snp')
+	with open_geno(input_stem + '.geno', len(ind_data)) as geno, create_geno(output_stem + '.geno', output_format, [ind_data[i][0] for i in cols], [line.split()[0] for line in snp_lines]) as geno_file:
+		block_rows = max(1, block_bytes // (len(ind_data) + 1))
+		for start in range(0, geno.n_snp, block_rows):
+			rows = np.arange(start, min(start + block_rows, geno.n_snp))
+			write_geno_rows(geno_file, read_geno_columns(geno, rows, cols), output_format)
+
+def subset_sharded(input_stem, output_stem, ind_ids, output_format=None, processes=1):
+	"""
+	Writes a sharded dataset with only the given individuals, in the given order, subsetting the shards in parallel.
+
+	RETURNS:
+		output_stem: Path stem of the subset sharded dataset.
+	ACCEPTS:
+		input_stem: Path stem of the input sharded dataset.
+		output_stem: Path stem for the output sharded dataset.
+		ind_ids: List of the individual IDs to keep.
+		output_format: Format of the output shard geno files. Defaults to the format of the input shards.
+		processes: Number of shards subset at once. Defaults to 1.
+	"""
+	manifest = read_manifest(input_stem)
+	if output_format is None:
+		output_format = manifest['format']
+	ind_data = read_ind_file(input_stem + '.ind')
+	columns = {fields[0] : i for i, fields in enumerate(ind_data)}
+	missing = [ind_id for ind_id in ind_ids if ind_id not in columns]
+	if missing:
+		raise KeyError("Individuals not in {}: {}".format(input_stem, ", ".join(missing)))
+	cols = np.array([columns[ind_id] for ind_id in ind_ids], dtype=np.intp)
+	with open(output_stem + '.ind', 'w') as ind_file:
+		ind_file.writelines("\t".join(ind_data[i]) + "\n" for i in cols)
+	chroms = [shard['chrom'] for shard in manifest['shards']]
+	tasks = [(shard_stem(input_stem, chrom), shard_stem(output_stem, chrom), cols, output_format) for chrom in chroms]
+	with Pool(processes=max(1, min(processes, len(tasks)))) as pool:
+		pool.starmap(subset_shard, tasks)
+	finish_sharded(output_stem, chroms, output_format)
+	return output_stem
+
+def merge_shard(input_stems, output_stem, output_format):
+	"""
+	Merges the shards of one chromosome with merge_datasets(). Run in a worker process.
+	"""
+	merge_datasets(input_stems, output_stem, output_format)
+
+def merge_sharded(input_stems, output_stem, output_format=None, processes=1):
+	"""
+	Merges sharded datasets chromosome by chromosome, merging the shards in parallel with merge_datasets(). Every input must have the same chromosomes.
+
+	RETURNS:
+		output_stem: Path stem of the merged sharded dataset.
+	ACCEPTS:
+		input_stems: List of path stems of the sharded datasets to merge.
+		output_stem: Path stem for the merged sharded dataset.
+		output_format: Format of the output shard geno files. Defaults to the format of the first input.
+		processes: Number of chromosomes merged at once. Defaults to 1.
+	"""
+	manifests = [read_manifest(stem) for stem in input_stems]
+	chroms = [shard['chrom'] for shard in manifests[0]['shards']]
+	for stem, manifest in zip(input_stems, manifests):
+		if sorted(shard['chrom'] for shard in manifest['shards']) != sorted(chroms):
+			raise ValueError("{} does not have the same chromosomes as {}!".format(stem, input_stems[0]))
+	if output_format is None:
+		output_format = manifests[0]['format']
+	tasks = [([shard_stem(stem, chrom) for stem in input_stems], shard_stem(output_stem, chrom), output_format) for chrom in chroms]
+	clear_shard_inds(output_stem, chroms)
+	with Pool(processes=max(1, min(processes, len(tasks)))) as pool:
+		pool.starmap(merge_shard, tasks)
+	# Every shard merge writes the same individuals, so keep the first shard's .ind as the shared one
+	rename(shard_stem(output_stem, chroms[0]) + '.ind', output_stem + '.ind')
+	finish_sharded(output_stem, chroms, output_format)
+	return output_stem
+
+def reorder_shard(input_stem, output_stem, ind_driver_path, output_format):
+	"""
+	Reorders the individuals of one shard with reorder_dataset(). Run in a worker process.
+	"""
+	reorder_dataset(input_stem, output_stem, ind_driver_path=ind_driver_path, output_format=output_format)
+
+def reorder_sharded(input_stem, output_stem, ind_driver_path, output_format=None, processes=1):
+	"""
+	Reorders the individuals of a sharded dataset to match a driver file, reordering the shards in parallel. SNPs stay in shard order.
+
+	RETURNS:
+		output_stem: Path stem of the reordered sharded dataset.
+	ACCEPTS:
+		input_stem: Path stem of the input sharded dataset.
+		output_stem: Path stem for the output sharded dataset.
+		ind_driver_path: Path to a file listing every input individual ID in the desired order, as for geno_reorder.py.
+		output_format: Format of the output shard geno files. Defaults to the format of the input shards.
+		processes: Number of shards reordered at once. Defaults to 1.
+	"""
+	manifest = read_manifest(input_stem)
+	if output_format is None:
+		output_format = manifest['format']
+	chroms = [shard['chrom'] for shard in manifest['shards']]
+	tasks = [(shard_stem(input_stem, chrom), shard_stem(output_stem, chrom), ind_driver_path, output_format) for chrom in chroms]
+	clear_shard_inds(output_stem, chroms)
+	with Pool(processes=max(1, min(processes, len(tasks)))) as pool:
+		pool.starmap(reorder_shard, tasks)
+	rename(shard_stem(output_stem, chroms[0]) + '.ind', output_stem + '.ind')
+	finish_sharded(output_stem, chroms, output_format)
+	return output_stem
+
+def verify_sharded(stem, processes=1):
+	"""
+	Verifies every shard of a sharded dataset with verify_dataset(), checking the chunks of each shard in parallel.
+
+	RETURNS:
+		problems: List of problem descriptions, each prefixed with its shard. Empty if every shard passed.
+	ACCEPTS:
+		stem: Path stem of the sharded dataset.
+		processes: Number of worker processes checking chunks. Defaults to 1.
+	"""
+	problems = []
+	for shard, stem_path in zip(read_manifest(stem)['shards'], shard_stems(stem)):
+		shard_problems = verify_dataset(stem_path, processes=processes)
+		if len(read_snp_file(stem_path + '.snp')) != shard['n_snp']:
+			shard_problems.append("snp file does not have the {} SNPs listed in the manifest".format(shard['n_snp']))
+		problems.extend("{}: {}".format(stem_path, problem) for problem in shard_problems)
+	return problems
+
+if __name__ == "__main__":
+	Parser = argparse.ArgumentParser(description="Split Eigenstrat datasets into per-chromosome shards and run operations on the shards in parallel.")
+	Parser.add_argument('operation', help="split: shard a monolithic dataset. concat: write a sharded dataset as a monolithic one. subset: keep the individuals listed in --ind_list. merge: merge sharded datasets. reorder: reorder individuals to match --ind_driver. verify: check every shard with geno_verify.py.", choices=OPERATIONS)
+	Parser.add_argument('--input', help="Path stem of the input dataset. Give several stems to merge.", nargs='+', required=True)
+	Parser.add_argument('--output', help="Path stem for the output dataset. Not used by verify.", type=str, default="")
+	Parser.add_argument('--output_format', help="Format of the output geno files. Defaults to the format of the (first) input.", choices=GENO_FORMATS, default=None)
+	Parser.add_argument('--ind_list', help="For subset, file listing the individual IDs to keep in output order. Only the first column is used, so an ind file can be given.", type=str, default="")
+	Parser.add_argument('--ind_driver', help="For reorder, file listing every individual ID in the desired output order.", type=str, default="")
+	Parser.add_argument('-p', '--processes', help="Number of shards processed at once. Defaults to the number of CPUs.", type=int, default=cpu_count())
+	args = Parser.parse_args()
+
+	input_stems = [abspath(stem) for stem in args.input]
+	if args.operation != 'merge' and len(input_stems) != 1:
+		Parser.error("{} takes a single --input stem.".format(args.operation))
+	if args.operation != 'verify' and args.output == "":
+		Parser.error("{} needs --output.".format(args.operation))
+	output_stem = abspath(args.output) if args.output != "" else ""
+	if args.operation == 'split':
+		shard_dataset(input_stems[0], output_stem, output_format=args.output_format, processes=args.processes)
+	elif args.operation == 'concat':
+		concat_shards(input_stems[0], output_stem, output_format=args.output_format)
+	elif args.operation == 'subset':
+		if args.ind_list == "":
+			Parser.error("subset needs --ind_list.")
+		subset_sharded(input_stems[0], output_stem, [fields[0] for fields in read_ind_file(args.ind_list)], output_format=args.output_format, processes=args.processes)
+	elif args.operation == 'merge':
+		merge_sharded(input_stems, output_stem, output_format=args.output_format, processes=args.processes)
+	elif args.operation == 'reorder':
+		if args.ind_driver == "":
+			Parser.error("reorder needs --ind_driver.")
+		reorder_sharded(input_stems[0], output_stem, abspath(args.ind_driver), output_format=args.output_format, processes=args.processes)
+	else:
+		problems = verify_sharded(input_stems[0], processes=args.processes)
+		for problem in problems:
+			print(problem)
+		sys.exit(1 if problems else 0)
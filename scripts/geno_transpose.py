@@ -0,0 +1,151 @@
+"""
+Builds and reads a sample-major companion of an Eigenstrat .geno file, so that a few individuals can be pulled out of a large master without reading every SNP row.
+
+The companion [stem].tgeno is a transposed packed geno file in EIGENSOFT's TGENO layout: a header record followed by one record per individual holding that individual's genotypes for every SNP, 2 bits each. It is built once per master with a few sequential passes over the .geno file, and then each individual is read from one contiguous record.
+"""
+import argparse
+from os import rename, stat
+from os.path import abspath, exists
+from eigenstrat_io import read_ind_file, read_snp_file, read_snp_ids, open_geno, read_geno_columns, read_packed_header, transposed_header, hash_ids, packed_record_len, pack_genotypes, unpack_genotypes, create_geno, write_geno_rows, BLOCK_BYTES, GENO_FORMATS, PACKEDANCESTRYMAP
+import numpy as np
+
+TGENO_SUFFIX = '.tgeno'
+# Default memory budget for the transposed records built in each pass
+DEFAULT_MEMORY_MB = 1024
+
+def transposed_path(stem):
+	"""
+	Returns the path of the sample-major companion of a dataset.
+	"""
+	return stem + TGENO_SUFFIX
+
+def is_transposed_current(stem):
+	"""
+	Returns True if the dataset has a sample-major companion that is newer than its .geno, .snp and .ind files, so that it can be used in place of the .geno file.
+	"""
+	tgeno_path = transposed_path(stem)
+	if not exists(tgeno_path):
+		return False
+	tgeno_mtime = stat(tgeno_path).st_mtime_ns
+	return all(stat(stem + ext).st_mtime_ns <= tgeno_mtime for ext in ['.geno', '.snp', '.ind'])
+
+def build_transposed(stem, memory_bytes=DEFAULT_MEMORY_MB * 1024**2, block_bytes=BLOCK_BYTES):
+	"""
+	Writes the sample-major companion of a dataset. Individuals are transposed in batches whose packed records fit in memory_bytes, and each batch takes one pass over the .geno file, reading only its own columns. The file is written under a temporary name and renamed when complete.
+
+	RETURNS:
+		tgeno_path: Path of the sample-major companion.
+	ACCEPTS:
+		stem: Path to the Eigenstrat files, without extension.
+		memory_bytes: Memory budget for the transposed records of one batch in bytes. Defaults to DEFAULT_MEMORY_MB.
+		block_bytes: Approximate number of bytes of .geno rows to read at once. Defaults to BLOCK_BYTES.
+	"""
+	ind_ids = [fields[0] for fields in read_ind_file(stem + '.ind')]
+	snp_ids = read_snp_ids(stem + '.snp')
+	tgeno_path = transposed_path(stem)
+	with open_geno(stem + '.geno', len(ind_ids)) as geno, open(tgeno_path + '.tmp', 'wb') as tgeno_file:
+		if geno.n_snp != len(snp_ids):
+			raise IndexError("{} has {} rows but its snp file has {}!".format(stem + '.geno', geno.n_snp, len(snp_ids)))
+		record_len = packed_record_len(geno.n_snp)
+		batch_inds = max(1, min(len(ind_ids), memory_bytes // record_len))
+		# Whole bytes of packed SNPs are written per block, so blocks start at multiples of 4 SNPs
+		block_rows = max(4, block_bytes // max(1, batch_inds) // 4 * 4)
+		tgeno_file.write(transposed_header(len(ind_ids), geno.n_snp, hash_ids(ind_ids), hash_ids(snp_ids)))
+		for first in range(0, len(ind_ids), batch_inds):
+			cols = np.arange(first, min(first + batch_inds, len(ind_ids)))
+			records = np.zeros((len(cols), record_len), dtype=np.uint8)
+			for start in range(0, geno.n_snp, block_rows):
+				stop = min(start + block_rows, geno.n_snp)
+				packed = pack_genotypes(read_geno_columns(geno, np.arange(start, stop), cols).T, (stop - start + 3) // 4)
+				records[:, start // 4:start // 4 + packed.shape[1]] = packed
+			tgeno_file.write(records)
+	rename(tgeno_path + '.tmp', tgeno_path)
+	return tgeno_path
+
+def open_transposed(stem):
+	"""
+	Memory-maps the sample-major companion of a dataset after checking that it is current and matches the .ind and .snp files.
+
+	RETURNS:
+		records: Read-only uint8 memmap with one packed record per individual.
+		n_snp: Number of SNPs in each record.
+	ACCEPTS:
+		stem: Path to the Eigenstrat files, without extension.
+	"""
+	tgeno_path = transposed_path(stem)
+	if not is_transposed_current(stem):
+		raise ValueError("{} is missing or older than the dataset. Rebuild it with geno_transpose.py build.".format(tgeno_path))
+	n_ind, n_snp = read_packed_header(tgeno_path, magic=b'TGENO')[:2]
+	expected_n_ind = len(read_ind_file(stem + '.ind'))
+	expected_n_snp = len(read_snp_ids(stem + '.snp'))
+	if n_ind != expected_n_ind or n_snp != expected_n_snp:
+		raise ValueError("{} has {} individuals and {} SNPs but the dataset has {} and {}!".format(tgeno_path, n_ind, n_snp, expected_n_ind, expected_n_snp))
+	record_len = packed_record_len(n_snp)
+	return np.memmap(tgeno_path, dtype=np.uint8, mode='r', offset=record_len, shape=(n_ind, record_len)), n_snp
+
+def read_individuals(records, n_snp, cols, start=0, stop=None):
+	"""
+	Reads the genotypes of some individuals from a sample-major companion, touching only their records.
+
+	RETURNS:
+		genotypes: uint8 matrix of ASCII genotype characters with one row per SNP and one column per requested individual, as read_geno_rows() returns.
+	ACCEPTS:
+		records: Memmap returned by open_transposed().
+		n_snp: Number of SNPs returned by open_transposed().
+		cols: Integer array of the individuals' columns in the .ind file.
+		start: First SNP row to read. Must be a multiple of 4. Defaults to 0.
+		stop: Row after the last SNP row to read. Defaults to None, reading to the last SNP.
+	"""
+	if start % 4 != 0:
+		raise ValueError("start must be a multiple of 4, the number of SNPs packed in a byte!")
+	stop = n_snp if stop is None else min(stop, n_snp)
+	return unpack_genotypes(records[np.asarray(cols, dtype=np.intp), start // 4:(stop + 3) // 4], stop - start).T
+
+def extract_individuals(stem, ind_ids, output_stem, output_format=PACKEDANCESTRYMAP, block_bytes=BLOCK_BYTES):
+	"""
+	Writes an Eigenstrat dataset holding only the given individuals, in the given order, read from the sample-major companion instead of the .geno file.
+
+	RETURNS:
+		output_stem: Path stem of the extracted dataset.
+	ACCEPTS:
+		stem: Path to the Eigenstrat files, without extension. Its companion must be current, see build_transposed().
+		ind_ids: List of the individual IDs to extract.
+		output_stem: Path stem for the output .geno/.snp/.ind files.
+		output_format: Format of the output geno file, EIGENSTRAT or PACKEDANCESTRYMAP. Defaults to PACKEDANCESTRYMAP.
+		block_bytes: Approximate number of bytes of genotypes to hold in memory at once. Defaults to BLOCK_BYTES.
+	"""
+	records, n_snp = open_transposed(stem)
+	ind_data = read_ind_file(stem + '.ind')
+	columns = {fields[0] : i for i, fields in enumerate(ind_data)}
+	missing = [ind_id for ind_id in ind_ids if ind_id not in columns]
+	if missing:
+		raise KeyError("Individuals not in {}: {}".format(stem, ", ".join(missing)))
+	cols = [columns[ind_id] for ind_id in ind_ids]
+	snp_lines = read_snp_file(stem + '.snp')
+	with open(output_stem + '.ind', 'w') as ind_file:
+		ind_file.writelines("\t".join(ind_data[i]) + "\n" for i in cols)
+	with open(output_stem + '.snp', 'w') as snp_file:
+		snp_file.writelines(snp_lines)
+	with create_geno(output_stem + '.geno', output_format, ind_ids, [line.split()[0] for line in snp_lines]) as geno_file:
+		block_rows = max(4, block_bytes // (len(cols) + 1) // 4 * 4)
+		for start in range(0, n_snp, block_rows):
+			write_geno_rows(geno_file, read_individuals(records, n_snp, cols, start, start + block_rows), output_format)
+	return output_stem
+
+if __name__ == "__main__":
+	Parser = argparse.ArgumentParser(description="Build the sample-major [stem].tgeno companion of an Eigenstrat dataset, or extract individuals from it.")
+	Parser.add_argument('operation', help="build: write [stem].tgeno. extract: write a dataset of the individuals in --ind_list read from [stem].tgeno.", choices=['build', 'extract'])
+	Parser.add_argument('--input', help="Path to the Eigenstrat files, without extension.", type=str, required=True)
+	Parser.add_argument('--ind_list', help="For extract, file listing the individual IDs to extract in output order. Only the first column is used, so an ind file can be given.", type=str, default="")
+	Parser.add_argument('--output', help="For extract, path stem for the output files.", type=str, default="")
+	Parser.add_argument('--output_format', help="For extract, format of the output geno file. Default is PACKEDANCESTRYMAP.", choices=GENO_FORMATS, default=PACKEDANCESTRYMAP)
+	Parser.add_argument('--memory_mb', help="For build, memory budget in MB for the records transposed in each pass over the .geno file. Default is {}.".format(DEFAULT_MEMORY_MB), type=int, default=DEFAULT_MEMORY_MB)
+	args = Parser.parse_args()
+
+	input_stem = abspath(args.input)
+	if args.operation == 'build':
+		build_transposed(input_stem, memory_bytes=args.memory_mb * 1024**2)
+	else:
+		if args.ind_list == "" or args.output == "":
+			Parser.error("extract needs --ind_list and --output.")
+		extract_individuals(input_stem, [fields[0] for fields in read_ind_file(args.ind_list)], abspath(args.output), output_format=args.output_format)
@@ -0,0 +1,234 @@
+"""
+Verifies the integrity of Eigenstrat datasets: that the .geno row count matches the .snp file, that every row's width matches the .ind file and that only 0, 1, 2 and 9 appear. For CHUNKED .geno files, every compressed chunk is decompressed and checked against its side index instead.
+
+The .geno file is memory-mapped and split into chunks of rows that are checked in parallel. Per-chunk checksums are written to a [stem].geno.verify.json sidecar so that later runs can skip files that have not changed. If only the .snp or .ind file changed, the .geno chunks that passed are not read again. If the .geno file changed, every chunk is re-hashed, which costs as much I/O as a full check, and only chunks whose contents differ are checked again, unless the file is known to only have been appended to (see verify_dataset()).
+"""
+import argparse
+import json
+import sys
+from hashlib import md5
+from multiprocessing import Pool
+from os import cpu_count, pread
+from os.path import abspath, exists
+from eigenstrat_io import read_ind_file, read_snp_ids, detect_geno_format, read_packed_header, hash_ids, packed_record_len, open_chunked, stat_key, NEWLINE, PACKEDANCESTRYMAP, CHUNKED, PACKED_FORMATS
+import zlib
+import numpy as np
+
+# Default size of each chunk of .geno rows checked by one worker
+CHUNK_MB = 256
+SIDECAR_SUFFIX = '.verify.json'
+SIDECAR_VERSION = 1
+# Bytes allowed in the genotype columns of an EIGENSTRAT row
+VALID_GENOTYPES = np.zeros(256, dtype=bool)
+VALID_GENOTYPES[[ord('0'), ord('1'), ord('2'), ord('9')]] = True
+
+def verify_chunk(geno_path, geno_format, offset, record_len, n_ind, start, stop, previous_md5=None):
+	"""
+	Checks a range of .geno rows. Run in a worker process.
+
+	RETURNS:
+		result: Dict with the chunk's start and stop rows, the md5 of its bytes, whether it was checked or skipped because its md5 matched previous_md5, and the first bad row and the reason it is bad (None if every row is good).
+	ACCEPTS:
+		geno_path: Path to the geno file.
+		geno_format: EIGENSTRAT or PACKEDANCESTRYMAP.
+		offset: Byte offset of the first SNP row in the file.
+		record_len: Length in bytes of each row, including the newline for EIGENSTRAT.
+		n_ind: Number of individuals.
+		start: First row of the chunk.
+		stop: Row after the last row of the chunk.
+		previous_md5: md5 of this chunk from a previous run that passed. Defaults to None, always checking the chunk.
+	"""
+	geno = np.memmap(geno_path, dtype=np.uint8, mode='r', offset=offset + start * record_len, shape=((stop - start) * record_len,))
+	chunk_md5 = md5(geno).hexdigest()
+	result = {'start' : start, 'stop' : stop, 'md5' : chunk_md5, 'checked' : False, 'bad_row' : None, 'reason' : None}
+	if chunk_md5 == previous_md5:
+		return result
+	result['checked'] = True
+	# Every 2-bit packed code is a valid genotype, so only EIGENSTRAT rows need their contents checked
+	if geno_format == PACKEDANCESTRYMAP:
+		return result
+	rows = geno.reshape((stop - start, record_len))
+	bad_width = rows[:, -1] != NEWLINE
+	bad_value = ~VALID_GENOTYPES[rows[:, :-1]].all(axis=1)
+	bad = bad_width | bad_value
+	if bad.any():
+		i = int(np.argmax(bad))
+		result['bad_row'] = start + i
+		if bad_width[i]:
+			result['reason'] = "row width does not match the {} individuals in the .ind file".format(n_ind)
+		else:
+			column = int(np.argmax(~VALID_GENOTYPES[rows[i, :-1]]))
+			result['reason'] = "invalid genotype {!r} for individual {}".format(chr(rows[i, column]), column)
+	return result
+
+def verify_compressed_chunk(geno_path, chunk, offset, length, record_len, start, stop, previous_md5=None):
+	"""
+	Checks that one chunk of a CHUNKED geno file decompresses to the records of its rows. Run in a worker process. The side index is read once by the caller, which passes each worker the position of its chunk.
+
+	RETURNS:
+		result: Dict in the format returned by verify_chunk(), with the md5 of the compressed chunk.
+	ACCEPTS:
+		geno_path: Path to the geno file.
+		chunk: Index of the chunk.
+		offset: Byte offset of the compressed chunk in the geno file.
+		length: Length of the compressed chunk in bytes.
+		record_len: Length of each packed record in bytes.
+		start: First row of the chunk.
+		stop: Row after the last row of the chunk.
+		previous_md5: md5 of this chunk from a previous run that passed. Defaults to None, always checking the chunk.
+	"""
+	with open(geno_path, 'rb') as geno_file:
+		data = pread(geno_file.fileno(), length, offset)
+	result = {'start' : start, 'stop' : stop, 'md5' : md5(data).hexdigest(), 'checked' : False, 'bad_row' : None, 'reason' : None}
+	if result['md5'] == previous_md5:
+		return result
+	result['checked'] = True
+	try:
+		n_bytes = len(zlib.decompress(data))
+	except zlib.error as e:
+		result['bad_row'] = start
+		result['reason'] = "chunk {} is corrupt: {}".format(chunk, e)
+		return result
+	if n_bytes != (stop - start) * record_len:
+		result['bad_row'] = start
+		result['reason'] = "chunk {} is corrupt: it decompresses to {} bytes instead of {}".format(chunk, n_bytes, (stop - start) * record_len)
+	return result
+
+def read_sidecar(sidecar_path):
+	"""
+	Reads a verification sidecar, returning None if it is missing, unreadable or from another SIDECAR_VERSION.
+	"""
+	try:
+		with open(sidecar_path, 'r') as sidecar_file:
+			sidecar = json.load(sidecar_file)
+	except (OSError, ValueError):
+		return None
+	if sidecar.get('version') != SIDECAR_VERSION:
+		return None
+	return sidecar
+
+def verify_dataset(stem, processes=1, chunk_bytes=CHUNK_MB * 1024**2, use_sidecar=True, assume_append=False):
+	"""
+	Verifies an Eigenstrat dataset and writes its sidecar. Chunks that passed last time are not read again when the .geno file is unchanged, or when assume_append is set and the .geno file only grew, in which case only the chunks past the previously verified rows are read.
+
+	RETURNS:
+		problems: List of problem descriptions. Empty if the dataset passed.
+	ACCEPTS:
+		stem: Path to the Eigenstrat files, without extension.
+		processes: Number of worker processes checking chunks. Defaults to 1.
+		chunk_bytes: Approximate size of each chunk of rows in bytes. Defaults to CHUNK_MB.
+		use_sidecar: Set to False to ignore any existing sidecar and check every chunk. Defaults to True.
+		assume_append: Set to trust that a grown EIGENSTRAT or PACKEDANCESTRYMAP .geno file was only appended to, so that rows verified before are not read again. Defaults to False.
+	"""
+	geno_path = stem + '.geno'
+	sidecar_path = geno_path + SIDECAR_SUFFIX
+	stats = {ext : stat_key(stem + ext) for ext in ['.geno', '.snp', '.ind']}
+	previous = read_sidecar(sidecar_path) if use_sidecar else None
+	if previous is not None and previous['stats'] == stats and not previous['problems']:
+		print("{}: unchanged since it last passed.".format(stem))
+		return []
+
+	ind_ids = [fields[0] for fields in read_ind_file(stem + '.ind')]
+	snp_ids = read_snp_ids(stem + '.snp')
+	n_ind = len(ind_ids)
+	n_snp = len(snp_ids)
+	geno_size = stats['.geno'][1]
+	problems = []
+	try:
+		geno_format = detect_geno_format(geno_path)
+		if geno_format in PACKED_FORMATS:
+			header_n_ind, header_n_snp, ind_hash, snp_hash = read_packed_header(geno_path, magic=b'CGENO' if geno_format == CHUNKED else b'GENO')
+	except ValueError as e:
+		# Without a header, the record length and so the rows cannot be located
+		problems.append("header cannot be read: {}".format(e))
+		print("{}: header cannot be read, no chunks checked.".format(stem))
+		return problems
+	if geno_format in PACKED_FORMATS:
+		if header_n_ind != n_ind:
+			problems.append("header lists {} individuals but the .ind file has {}".format(header_n_ind, n_ind))
+		if header_n_snp != n_snp:
+			problems.append("header lists {} SNPs but the .snp file has {}".format(header_n_snp, n_snp))
+		if ind_hash != hash_ids(ind_ids):
+			problems.append("individual hash in the header does not match the .ind file")
+		if snp_hash != hash_ids(snp_ids):
+			problems.append("SNP hash in the header does not match the .snp file")
+	if geno_format == CHUNKED:
+		# Chunks are the compressed chunks listed in the side index, checked by decompressing them
+		records = None
+		try:
+			# Only the side index is needed here, since the workers read the chunks
+			with open_chunked(geno_path, header_n_ind, threads=1) as geno:
+				records = geno.records
+		except (OSError, ValueError, KeyError) as e:
+			problems.append("side index cannot be used: {}".format(e))
+		if records is not None and records.offsets[-1] != geno_size:
+			problems.append("size of {} bytes does not match the {} bytes listed in the side index".format(geno_size, records.offsets[-1]))
+		record_len = packed_record_len(header_n_ind)
+		chunk_rows = records.chunk_rows if records is not None else 1
+		n_chunks = len(records.offsets) - 1 if records is not None and records.offsets[-1] == geno_size else 0
+	else:
+		if geno_format == PACKEDANCESTRYMAP:
+			record_len = packed_record_len(header_n_ind)
+			offset = record_len
+		else:
+			record_len = n_ind + 1
+			offset = 0
+		if geno_size - offset != n_snp * record_len:
+			problems.append("size of {} bytes does not match {} rows of {} bytes".format(geno_size, n_snp, record_len))
+		# Check every whole row that is present, so that a short or long row is located rather than just reported
+		n_rows = min(n_snp, max(0, geno_size - offset) // record_len)
+		chunk_rows = max(1, chunk_bytes // record_len)
+
+	previous_chunks = {}
+	if previous is not None and previous['format'] == geno_format and previous['record_len'] == record_len and previous['chunk_rows'] == chunk_rows:
+		previous_chunks = {chunk['start'] : chunk for chunk in previous['chunks'] if chunk['bad_row'] is None}
+	# Passing chunks whose bytes cannot have changed are taken from the sidecar without reading them
+	geno_unchanged = previous is not None and previous['stats']['.geno'] == stats['.geno']
+	appended = assume_append and previous is not None and geno_format != CHUNKED and geno_size >= previous['stats']['.geno'][1]
+	if geno_format == CHUNKED:
+		n_rows = records.shape[0] if n_chunks else 0
+	trusted = []
+	tasks = []
+	for i, start in enumerate(range(0, n_rows, chunk_rows)):
+		stop = min(start + chunk_rows, n_rows)
+		previous_chunk = previous_chunks.get(start)
+		if previous_chunk is not None and previous_chunk['stop'] == stop and (geno_unchanged or appended):
+			trusted.append(dict(previous_chunk, checked=False))
+		elif geno_format == CHUNKED:
+			tasks.append((geno_path, i, records.offsets[i], records.offsets[i + 1] - records.offsets[i], record_len, start, stop, previous_chunk['md5'] if previous_chunk else None))
+		else:
+			tasks.append((geno_path, geno_format, offset, record_len, n_ind, start, stop, previous_chunk['md5'] if previous_chunk else None))
+	chunks = []
+	if tasks:
+		with Pool(processes=max(1, min(processes, len(tasks)))) as pool:
+			chunks = pool.starmap(verify_compressed_chunk if geno_format == CHUNKED else verify_chunk, tasks)
+	chunks = sorted(trusted + chunks, key=lambda chunk: chunk['start'])
+	for chunk in chunks:
+		if chunk['bad_row'] is not None:
+			problems.append("rows {}-{}: first bad row is {} ({})".format(chunk['start'], chunk['stop'] - 1, chunk['bad_row'], chunk['reason']))
+	print("{}: {} of {} chunks checked, {} unchanged since the last run ({} not read).".format(stem, sum(chunk['checked'] for chunk in chunks), len(chunks), sum(not chunk['checked'] for chunk in chunks), len(trusted)))
+
+	sidecar = {'version' : SIDECAR_VERSION, 'stats' : stats, 'format' : geno_format, 'record_len' : record_len, 'chunk_rows' : chunk_rows, 'problems' : problems, 'chunks' : chunks}
+	with open(sidecar_path, 'w') as sidecar_file:
+		json.dump(sidecar, sidecar_file, indent=1)
+	return problems
+
+if __name__ == "__main__":
+	Parser = argparse.ArgumentParser(description="Verify the integrity of Eigenstrat .geno/.snp/.ind datasets.")
+	Parser.add_argument('stems', help="Paths to the Eigenstrat files to verify, without extension.", nargs='+')
+	Parser.add_argument('-p', '--processes', help="Number of worker processes checking chunks. Defaults to the number of CPUs.", type=int, default=cpu_count())
+	Parser.add_argument('--chunk_mb', help="Approximate size in MB of each chunk of .geno rows. Default is {}.".format(CHUNK_MB), type=int, default=CHUNK_MB)
+	Parser.add_argument('--assume_append', help="Trust that a .geno file that grew since it last passed was only appended to, so that only its new rows are read. Not used for CHUNKED files.", action='store_true')
+	Parser.add_argument('--force', help="Ignore existing [stem].geno.verify.json sidecars and check every chunk.", action='store_true')
+	args = Parser.parse_args()
+
+	failed = False
+	for stem in args.stems:
+		stem = abspath(stem[:-5] if stem.endswith('.geno') else stem)
+		if not exists(stem + '.geno'):
+			raise FileNotFoundError("{}.geno does not exist!".format(stem))
+		problems = verify_dataset(stem, processes=args.processes, chunk_bytes=args.chunk_mb * 1024**2, use_sidecar=not args.force, assume_append=args.assume_append)
+		for problem in problems:
+			print("{}: {}".format(stem, problem))
+		failed = failed or len(problems) > 0
+	sys.exit(1 if failed else 0)
@@ -1,8 +1,17 @@
 import argparse
-import re
-from os import mkdir, chdir
-from os.path import exists, abspath, basename
+import json
+import pickle
+from os import mkdir, makedirs, chdir, stat, remove, link, sysconf, wait4, waitstatus_to_exitcode
+from os.path import exists, abspath, basename, join
 import subprocess
+import sys
+from hashlib import md5
+from shutil import copyfile
+from contextlib import ExitStack
+from time import time
+from eigenstrat_io import read_ind_file, read_snp_file, read_snp_ids, open_geno, read_geno_columns, iter_geno_blocks, create_geno, write_geno_rows, file_md5, stat_key, detect_geno_format, packed_record_len, HASH_BLOCK_BYTES, CHUNK_INDEX_SUFFIX, EIGENSTRAT, PACKEDANCESTRYMAP, CHUNKED, GENO_FORMATS
+from submit import partition
+import numpy as np
 
 # TODO: Update to real filepaths
 SNP_SET_FILENAMES = {
@@ -17,6 +26,34 @@ PAR_DEFAULT = "/n/groups/reich/matt/pipeline/static/snp_split/par_template"
 SBATCH_TEMPLATE = "/n/groups/reich/matt/pipeline/static/snp_split/sbatch_template"
 CONVERTF_DEFAULT = '/home/np29/o2bin/convertf'
 SUBMIT_COMMAND = 'sbatch'
+# Table of past convertf runs used to calibrate the sbatch resource model. Tab-separated with a header of: n_ind, n_snp, input_format, memory_mb, runtime_minutes
+RESOURCE_BENCHMARKS = "/n/groups/reich/matt/pipeline/static/snp_split/convertf_benchmarks.tsv"
+# Resources requested when there are not enough benchmark runs to fit the model for an input format
+DEFAULT_MEMORY_MB = 16000
+DEFAULT_RUNTIME_MINUTES = 720
+MIN_MEMORY_MB = 2000
+MIN_RUNTIME_MINUTES = 30
+# Multiplier applied to model predictions to leave room for runs that are slower or larger than the benchmarks
+RESOURCE_HEADROOM = 1.25
+
+# Anno file columns used by the filters. These will need to be updated as the anno file format changes.
+GENETIC_ID_COLUMN = 'Genetic ID'
+MASTER_ID_COLUMN = 'Master ID'
+DATA_SOURCE_COLUMN = 'Data source'
+DATA_TYPES_COLUMN = 'Data types in bam'
+ASSESSMENT_COLUMN = 'ASSESSMENT'
+LIBRARY_TYPE_COLUMN = 'Library type (minus=no.damage.correction, half=damage.retained.at.last.position, plus=damage.fully.corrected, ds=double.stranded.library.preparation, ss=single.stranded.library.preparation)'
+PUBLICATION_COLUMN = 'Publication abbreviation or plan'
+SNP_COUNT_COLUMN = 'SNPs hit on autosomal targets (Computed using easystats on 3.2M snpset)'
+# Columns stored as float arrays rather than strings. Values that cannot be parsed (e.g. '..') are stored as NaN.
+NUMERIC_ANNO_COLUMNS = {SNP_COUNT_COLUMN}
+# Bump this if the layout of the anno cache changes to invalidate existing caches
+ANNO_CACHE_VERSION = 1
+# Name of the SNP set index manifest inside the SNP set index directory ([master].snp_index by default)
+SNP_INDEX_MANIFEST = 'manifest.json'
+
+# Sequential read/write throughput assumed when estimating --in_process build times in --plan mode
+PLAN_IO_MB_PER_SECOND = 200
 
 def build_par_file(master_stem, snp_file_path, driver_file_path, output_name, par_template=PAR_DEFAULT):
 	"""
@@ -44,9 +81,68 @@ def build_par_file(master_stem, snp_file_path, driver_file_path, output_name, pa
 		par_file.write(par_file_content)
 	return abspath(par_file_path)
 
-def build_sbatch_script(output_name, par_file, sbatch_template=SBATCH_TEMPLATE, convertf_execuable=CONVERTF_DEFAULT):
+def read_benchmarks(benchmark_path):
+	"""
+	Reads the table of past convertf runs used to calibrate the resource model.
+
+	RETURNS:
+		benchmarks: List of (n_ind, n_snp, input_format, memory_mb, runtime_minutes) tuples. Empty if the table does not exist.
+	ACCEPTS:
+		benchmark_path: Path to a tab-separated benchmark table with a header line containing n_ind, n_snp, input_format, memory_mb and runtime_minutes columns.
+	"""
+	if not exists(benchmark_path):
+		return []
+	with open(benchmark_path, 'r') as benchmark_file:
+		headers = benchmark_file.readline().strip().split('\t')
+		ixs = [headers.index(column) for column in ['n_ind', 'n_snp', 'input_format', 'memory_mb', 'runtime_minutes']]
+		rows = [line.strip().split('\t') for line in benchmark_file if line.strip()]
+	return [(int(row[ixs[0]]), int(row[ixs[1]]), row[ixs[2]].upper(), float(row[ixs[3]]), float(row[ixs[4]])) for row in rows]
+
+def fit_resource_model(benchmarks):
+	"""
+	Fits a linear model of convertf memory and wall time against the number of genotypes processed (individuals x SNP set size), separately for each input format.
+
+	RETURNS:
+		model: Dict keyed on input format of (memory_coefficients, runtime_coefficients) pairs, each an (intercept, slope) numpy array. Formats with fewer than two distinct benchmark sizes are left out.
+	ACCEPTS:
+		benchmarks: List of benchmark tuples as returned by read_benchmarks().
+	"""
+	model = {}
+	for input_format in set(b[2] for b in benchmarks):
+		rows = np.array([(b[0] * b[1], b[3], b[4]) for b in benchmarks if b[2] == input_format], dtype=np.float64)
+		if len(np.unique(rows[:, 0])) < 2:
+			continue
+		design = np.column_stack([np.ones(len(rows)), rows[:, 0]])
+		memory_coefficients = np.linalg.lstsq(design, rows[:, 1], rcond=None)[0]
+		runtime_coefficients = np.linalg.lstsq(design, rows[:, 2], rcond=None)[0]
+		model[input_format] = (memory_coefficients, runtime_coefficients)
+	return model
+
+def predict_resources(model, n_ind, n_snp, input_format):
+	"""
+	Predicts the memory and wall time to request for a convertf job, including RESOURCE_HEADROOM. Falls back to DEFAULT_MEMORY_MB and DEFAULT_RUNTIME_MINUTES if the model has no fit for the input format.
+
+	RETURNS:
+		memory_mb: Memory to request in MB.
+		runtime_minutes: Wall time to request in minutes.
+	ACCEPTS:
+		model: Resource model as returned by fit_resource_model().
+		n_ind: Number of individuals in the input dataset.
+		n_snp: Number of SNPs in the SNP set being written.
+		input_format: Format of the input geno file, EIGENSTRAT or PACKEDANCESTRYMAP.
+	"""
+	if input_format not in model:
+		return DEFAULT_MEMORY_MB, DEFAULT_RUNTIME_MINUTES
+	memory_coefficients, runtime_coefficients = model[input_format]
+	genotypes = float(n_ind) * n_snp
+	memory_mb = (memory_coefficients[0] + memory_coefficients[1] * genotypes) * RESOURCE_HEADROOM
+	runtime_minutes = (runtime_coefficients[0] + runtime_coefficients[1] * genotypes) * RESOURCE_HEADROOM
+	return max(MIN_MEMORY_MB, int(np.ceil(memory_mb))), max(MIN_RUNTIME_MINUTES, int(np.ceil(runtime_minutes)))
+
+def build_sbatch_script(output_name, par_file, sbatch_template=SBATCH_TEMPLATE, convertf_execuable=CONVERTF_DEFAULT, memory_mb=DEFAULT_MEMORY_MB, runtime_minutes=DEFAULT_RUNTIME_MINUTES):
 	"""
-	Constructs an sbatch script or similar scheduler submission script using a template
+	Constructs an sbatch script or similar scheduler submission script using a template.
+	Resource requests are filled into the MEMORY_MB, RUNTIME_MINUTES and PARTITION placeholders, if the template has them.
 	
 	RETURNS:
 		sbatch_path: Path to the newly created submission script file
@@ -55,22 +151,518 @@ def build_sbatch_script(output_name, par_file, sbatch_template=SBATCH_TEMPLATE,
 		par_file: Path to the parfile to run convertf using.
 		sbatch_template: Path to submission script template to use. Defaults to boilerplate submission script specified in SBATCH_TEMPLATE
 		convertf_execuable: Path to the convertf executable file to use. Defaults to the path in CONVERTF_DEFAULT.
+		memory_mb: Memory to request in MB, e.g. from predict_resources(). Defaults to DEFAULT_MEMORY_MB.
+		runtime_minutes: Wall time to request in minutes, e.g. from predict_resources(). Defaults to DEFAULT_RUNTIME_MINUTES.
 		"""
 	with open(sbatch_template, 'r') as template:
 		sbatch_file_content = template.read()
-	# TODO: Scale resource requirements to size of snpset. Verify with Matt that this is worth it due to Cokie's changes.
 	sbatch_file_content = sbatch_file_content.replace("OUTPUT_NAME", output_name.split("/")[-1])
 	sbatch_file_content = sbatch_file_content.replace("CONVERTF_EXE", convertf_execuable)
 	sbatch_file_content = sbatch_file_content.replace("PAR_FILE", par_file)
+	sbatch_file_content = sbatch_file_content.replace("MEMORY_MB", str(memory_mb))
+	sbatch_file_content = sbatch_file_content.replace("RUNTIME_MINUTES", str(runtime_minutes))
+	sbatch_file_content = sbatch_file_content.replace("PARTITION", partition(runtime_minutes, None))
 	
 	sbatch_path = output_name + '.sh'
 	with open(sbatch_path, 'w') as sbatch_file:
 		sbatch_file.write(sbatch_file_content)
 	return abspath(sbatch_path)
 
+def run_local_jobs(jobs, max_workers=1, memory_budget_mb=None):
+	"""
+	Runs jobs as local subprocesses, keeping up to max_workers running at once without exceeding a memory budget. A job that is larger than the whole budget is run on its own.
+	Each job's output goes to its own log file, and its exit code, wall time and peak memory use are recorded.
+
+	RETURNS:
+		results: List of job dicts, in order of completion, with added 'exit_code', 'runtime_seconds' and 'max_rss_mb' keys.
+	ACCEPTS:
+		jobs: List of dicts with 'name', 'command' (argument list), 'memory_mb' (expected peak memory) and 'log' (path to write stdout/stderr to) keys.
+		max_workers: Maximum number of jobs to run at once. Defaults to 1.
+		memory_budget_mb: Maximum total expected memory of running jobs in MB. Defaults to None, meaning no memory limit.
+	"""
+	pending = list(jobs)
+	running = {}
+	used_memory_mb = 0
+	results = []
+	try:
+		while pending or running:
+			# Start the first pending jobs that fit into the free workers and memory
+			while pending and len(running) < max_workers:
+				fits = [job for job in pending if memory_budget_mb is None or used_memory_mb + job['memory_mb'] <= memory_budget_mb]
+				if not fits and running:
+					break
+				job = fits[0] if fits else pending[0]
+				pending.remove(job)
+				with open(job['log'], 'w') as log:
+					proc = subprocess.Popen(job['command'], stdout=log, stderr=subprocess.STDOUT)
+				running[proc.pid] = (job, proc, time())
+				used_memory_mb += job['memory_mb']
+				print("{}: started (expected {} MB).".format(job['name'], job['memory_mb']))
+			# Block until any job exits. wait4 also reports the peak memory of the job.
+			pid, status, rusage = wait4(-1, 0)
+			if pid not in running:
+				continue
+			job, proc, start = running.pop(pid)
+			proc.returncode = waitstatus_to_exitcode(status)
+			used_memory_mb -= job['memory_mb']
+			result = dict(job, exit_code=proc.returncode, runtime_seconds=time() - start, max_rss_mb=rusage.ru_maxrss / 1024)
+			print("{}: exited with code {} after {:.1f} seconds.".format(job['name'], result['exit_code'], result['runtime_seconds']))
+			results.append(result)
+	finally:
+		# If starting a job failed, do not leave the jobs that are already running behind
+		for job, proc, start in running.values():
+			print("{}: terminating.".format(job['name']))
+			proc.terminate()
+			proc.wait()
+	return results
+
+def write_job_log(job_log_path, results):
+	"""
+	Writes a tab-separated summary of locally run jobs.
+
+	ACCEPTS:
+		job_log_path: Path to write the summary to.
+		results: List of job results as returned by run_local_jobs().
+	"""
+	with open(job_log_path, 'w') as job_log:
+		job_log.write("name\texit_code\truntime_seconds\tmax_rss_mb\texpected_memory_mb\tlog\n")
+		for result in results:
+			job_log.write("{}\t{}\t{:.1f}\t{:.0f}\t{}\t{}\n".format(result['name'], result['exit_code'], result['runtime_seconds'], result['max_rss_mb'], result['memory_mb'], abspath(result['log'])))
+
+def record_benchmarks(benchmark_path, results, input_format):
+	"""
+	Appends successful locally run convertf jobs to the resource model benchmark table (see read_benchmarks()) so that future predictions are calibrated against them.
+
+	ACCEPTS:
+		benchmark_path: Path to the benchmark table. It is created with a header if it does not exist.
+		results: List of job results as returned by run_local_jobs(). Jobs must have 'n_ind' and 'n_snp' keys.
+		input_format: Format of the master geno file the jobs read.
+	"""
+	new_table = not exists(benchmark_path)
+	with open(benchmark_path, 'a') as benchmark_file:
+		if new_table:
+			benchmark_file.write("n_ind\tn_snp\tinput_format\tmemory_mb\truntime_minutes\n")
+		for result in results:
+			if result['exit_code'] == 0:
+				benchmark_file.write("{}\t{}\t{}\t{:.0f}\t{:.2f}\n".format(result['n_ind'], result['n_snp'], input_format, result['max_rss_mb'], result['runtime_seconds'] / 60))
+
+def load_snp_index(index_dir, master_snp_path, remove_stale=True):
+	"""
+	Loads the SNP set index manifest for a master snp file. If the master snp file content no longer matches the content hash recorded in the manifest, the stale index files are removed and an empty manifest is returned.
+
+	RETURNS:
+		manifest: Dict describing the master snp file and every indexed SNP set.
+	ACCEPTS:
+		index_dir: Directory holding the SNP set index.
+		master_snp_path: Path to the master snp file.
+		remove_stale: Set to False to leave stale index files on disk. Default is True.
+	"""
+	manifest_path = join(index_dir, SNP_INDEX_MANIFEST)
+	manifest = {}
+	if exists(manifest_path):
+		with open(manifest_path, 'r') as manifest_file:
+			manifest = json.load(manifest_file)
+	master_stat = stat_key(master_snp_path)
+	if manifest.get('master_stat') == master_stat:
+		return manifest
+	# The mtime or size of the master snp file changed, so fall back to comparing content hashes
+	master_md5 = file_md5(master_snp_path)
+	if manifest.get('master_md5') != master_md5:
+		if manifest:
+			print("Master snp file has changed since the SNP set index was built. Rebuilding the index.")
+		for entry in manifest.get('sets', {}).values() if remove_stale else []:
+			try:
+				remove(join(index_dir, entry['index_file']))
+			except OSError:
+				pass
+		manifest = {'master_md5' : master_md5, 'sets' : {}}
+	manifest['master_stat'] = master_stat
+	return manifest
+
+def save_snp_index(index_dir, manifest):
+	"""
+	Writes the SNP set index manifest. Failing to write the index (e.g. next to a read-only master) is not an error.
+	"""
+	try:
+		makedirs(index_dir, exist_ok=True)
+		with open(join(index_dir, SNP_INDEX_MANIFEST), 'w') as manifest_file:
+			json.dump(manifest, manifest_file, indent=1)
+	except OSError:
+		print("Unable to write SNP set index to {}.".format(index_dir))
+
+def get_snp_set_positions(master_snp_path, snp_file_paths, index_dir, update_index=True):
+	"""
+	Looks up the int32 row positions of each SNP set's SNPs in the master snp file using the persistent SNP set index, indexing any SNP set (standard or custom) that has not been seen before.
+	The index is keyed on content hashes of the master snp file and of each SNP set file, so it is rebuilt automatically for a new master version and reused otherwise.
+
+	RETURNS:
+		positions: List of sorted int32 numpy arrays of master snp file row positions, one per SNP set.
+		set_sizes: List of the number of SNPs in each SNP set file, including any that are missing from the master snp file.
+	ACCEPTS:
+		master_snp_path: Path to the master snp file.
+		snp_file_paths: List of paths to SNP set snp files.
+		index_dir: Directory in which to store the SNP set index.
+		update_index: Set to False to only read the index, matching SNP sets that are not indexed without saving them, e.g. for --plan. Default is True.
+	"""
+	manifest = load_snp_index(index_dir, master_snp_path, remove_stale=update_index)
+	master_rows = None
+	positions = []
+	set_sizes = []
+	for snp_file_path in snp_file_paths:
+		snp_file_path = abspath(snp_file_path)
+		entry = manifest['sets'].get(snp_file_path)
+		if entry is None or entry['stat'] != stat_key(snp_file_path):
+			set_md5 = file_md5(snp_file_path)
+			# Reuse an index built from an identical SNP set file at another path
+			entry = next((dict(e) for e in manifest['sets'].values() if e['md5'] == set_md5), {'md5' : set_md5, 'index_file' : set_md5 + '.npy'})
+			entry['stat'] = stat_key(snp_file_path)
+			manifest['sets'][snp_file_path] = entry
+		index_path = join(index_dir, entry['index_file'])
+		if exists(index_path):
+			set_positions = np.load(index_path)
+		else:
+			# First use of this SNP set against this master: match SNP IDs once and save the row positions
+			if master_rows is None:
+				master_rows = {snp_id : i for i, snp_id in enumerate(read_snp_ids(master_snp_path))}
+			snp_ids = read_snp_ids(snp_file_path)
+			set_positions = np.array(sorted(master_rows[snp_id] for snp_id in set(snp_ids) if snp_id in master_rows), dtype=np.int32)
+			entry['set_size'] = len(snp_ids)
+			if update_index:
+				try:
+					makedirs(index_dir, exist_ok=True)
+					np.save(index_path, set_positions)
+				except OSError:
+					pass
+		positions.append(set_positions)
+		set_sizes.append(entry['set_size'])
+	if update_index:
+		save_snp_index(index_dir, manifest)
+	return positions, set_sizes
+
+def read_par_output_format(par_template):
+	"""
+	Reads the convertf output format from a par file template.
+
+	RETURNS:
+		output_format: Value of the template's outputformat line, or None if the template does not set one.
+	ACCEPTS:
+		par_template: Path to the par file template.
+	"""
+	with open(par_template, 'r') as template:
+		for line in template:
+			fields = line.split(':', 1)
+			if len(fields) == 2 and fields[0].strip() == 'outputformat':
+				return fields[1].strip()
+	return None
+
+def plan_outputs(master_stem, sample_ids, exclusion_mask, outputs, index_dir, output_format, in_process=False, resource_model=None):
+	"""
+	Estimates the size of every SNP set output and the I/O needed to build it, without writing any output, par or submission files. The SNP set index is read but not updated.
+
+	RETURNS:
+		plan: List of dicts, one per output, with the output name, SNP counts, output file sizes in bytes, bytes read from the master files and, for convertf, the predicted memory and wall time.
+		master_read_bytes: Combined size of the master geno, snp and ind files in bytes, read once per convertf job or once in total by --in_process.
+	ACCEPTS:
+		master_stem: Path to master Eigenstrat file, without extension.
+		sample_ids: numpy array of master ind file sample IDs.
+		exclusion_mask: Boolean numpy array marking the samples to be dropped from every output.
+		outputs: List of (output_name, snp_file_path) tuples.
+		index_dir: Directory holding the persistent SNP set index (see get_snp_set_positions()).
+		output_format: Format of the output geno files, or None if it is unknown. Geno sizes are left as None for formats other than EIGENSTRAT and PACKEDANCESTRYMAP.
+		in_process: Set to True to plan a single --in_process pass over the master geno file rather than one convertf job per SNP set. Defaults to False.
+		resource_model: Resource model as returned by fit_resource_model(), used to predict convertf memory and wall time.
+	"""
+	master_ind_lines = read_ind_file(master_stem + '.ind')
+	master_snp_lines = read_snp_file(master_stem + '.snp')
+	master_geno = master_stem + '.geno'
+	input_format = detect_geno_format(master_geno)
+	n_kept = len(sample_ids) - int(exclusion_mask.sum())
+	ind_bytes = sum(len("\t".join(fields)) + 1 for fields, excluded in zip(master_ind_lines, exclusion_mask) if not excluded)
+	snp_line_bytes = np.array([len(line) for line in master_snp_lines], dtype=np.int64)
+	master_read_bytes = stat(master_geno).st_size + stat(master_stem + '.snp').st_size + stat(master_stem + '.ind').st_size
+
+	set_positions, set_sizes = get_snp_set_positions(master_stem + '.snp', [snp_file_path for output_name, snp_file_path in outputs], index_dir, update_index=False)
+	plan = []
+	for (output_name, snp_file_path), positions, set_size in zip(outputs, set_positions, set_sizes):
+		n_snp = len(positions)
+		if output_format == EIGENSTRAT:
+			geno_bytes = n_snp * (n_kept + 1)
+		elif output_format == PACKEDANCESTRYMAP:
+			geno_bytes = (n_snp + 1) * packed_record_len(n_kept)
+		else:
+			geno_bytes = None
+		entry = {'name' : output_name, 'n_snp' : n_snp, 'set_size' : set_size, 'geno_bytes' : geno_bytes, 'snp_bytes' : int(snp_line_bytes[positions].sum()), 'ind_bytes' : ind_bytes}
+		# convertf re-reads every master file for each SNP set, while --in_process shares one pass between all of them
+		if in_process:
+			entry['read_bytes'] = None
+		else:
+			entry['read_bytes'] = master_read_bytes
+			entry['memory_mb'], entry['runtime_minutes'] = predict_resources(resource_model, len(sample_ids), set_size, input_format)
+		plan.append(entry)
+	return plan, master_read_bytes
+
+def print_plan(plan, master_read_bytes, filter_report, n_samples, output_format, in_process=False):
+	"""
+	Prints the per-filter sample counts and the per-SNP set table built by plan_outputs().
+
+	RETURNS:
+		None
+	ACCEPTS:
+		plan: List of per-output dicts as returned by plan_outputs().
+		master_read_bytes: Combined size of the master geno, snp and ind files in bytes.
+		filter_report: List of (step, samples_flagged, samples_excluded_after) tuples recorded as the filters were applied.
+		n_samples: Number of samples in the master ind file.
+		output_format: Format of the output geno files, or None if it is unknown.
+		in_process: Set to True if the plan is for an --in_process build. Defaults to False.
+	"""
+	excluded = 0
+	print("{:<40}{:>12}{:>12}{:>12}".format('step', 'flagged', 'change', 'excluded'))
+	for step, flagged, excluded_after in filter_report:
+		print("{:<40}{:>12}{:>+12}{:>12}".format(step, flagged, excluded_after - excluded, excluded_after))
+		excluded = excluded_after
+	print("{} of {} samples kept.\n".format(n_samples - excluded, n_samples))
+	print("Output format: {}".format(output_format if output_format is not None else "unknown"))
+
+	def show(value):
+		return '-' if value is None else value
+
+	print("\t".join(['output', 'snps_kept', 'set_size', 'geno_bytes', 'snp_bytes', 'ind_bytes', 'read_bytes', 'write_bytes', 'memory_mb', 'runtime_minutes']))
+	total_read = master_read_bytes if in_process else 0
+	total_write = 0
+	for entry in plan:
+		write_bytes = None if entry['geno_bytes'] is None else entry['geno_bytes'] + entry['snp_bytes'] + entry['ind_bytes']
+		total_read += entry['read_bytes'] or 0
+		total_write += write_bytes or 0
+		print("\t".join(str(show(value)) for value in [entry['name'], entry['n_snp'], entry['set_size'], entry['geno_bytes'], entry['snp_bytes'], entry['ind_bytes'], entry['read_bytes'], write_bytes, entry.get('memory_mb'), entry.get('runtime_minutes')]))
+	if in_process:
+		print("Single pass over the master files: {} bytes read.".format(master_read_bytes))
+		print("Estimated {:.1f} minutes at {} MB/s.".format((total_read + total_write) / (PLAN_IO_MB_PER_SECOND * 1024**2) / 60, PLAN_IO_MB_PER_SECOND))
+	print("Total I/O: {} bytes read, {} bytes written.".format(total_read, total_write))
+
+def subset_in_process(master_stem, driver_file_path, outputs, index_dir, output_format=EIGENSTRAT):
+	"""
+	Subsets the master Eigenstrat files to every requested SNP set in a single streaming pass over the master geno file. This is an alternative to running convertf once per SNP set, each of which would re-read the full master geno file.
+
+	RETURNS:
+		output_names: List of output names that were written.
+	ACCEPTS:
+		master_stem: Path to master Eigenstrat file, without extension.
+		driver_file_path: Path to the driver file built by build_driver_file(). Samples marked as 'Ignore' are dropped from every output.
+		outputs: List of (output_name, snp_file_path) tuples. Output names should be in SNPSET/name_SNPSET format.
+		index_dir: Directory holding the persistent SNP set index (see get_snp_set_positions()).
+		output_format: Format of the output geno files, EIGENSTRAT, PACKEDANCESTRYMAP or CHUNKED. The master geno file may be in any of these formats. Defaults to EIGENSTRAT.
+	"""
+	driver = read_ind_file(driver_file_path)
+	keep_cols = np.array([i for i, fields in enumerate(driver) if fields[2] != 'Ignore'], dtype=np.intp)
+	master_snp_lines = read_snp_file(master_stem + '.snp')
+	with ExitStack() as genos:
+		geno = genos.enter_context(open_geno(master_stem + '.geno', len(driver)))
+		if geno.n_snp != len(master_snp_lines):
+			raise IndexError("Length of master snp file does not match that of the master geno file.")
+		set_positions, set_sizes = get_snp_set_positions(master_stem + '.snp', [snp_file_path for output_name, snp_file_path in outputs], index_dir)
+
+		# Mark the master snp rows that belong to each output SNP set and write the small .ind/.snp outputs up front
+		snp_masks = []
+		geno_files = []
+		for (output_name, snp_file_path), positions, set_size in zip(outputs, set_positions, set_sizes):
+			snp_mask = np.zeros(len(master_snp_lines), dtype=bool)
+			snp_mask[positions] = True
+			print("{}: {} of {} SNPs found in the master snp file.".format(output_name, len(positions), set_size))
+			with open(output_name + '.ind', 'w') as ind_file:
+				ind_file.writelines("\t".join(driver[i]) + "\n" for i in keep_cols)
+			with open(output_name + '.snp', 'w') as snp_file:
+				snp_file.writelines(master_snp_lines[i] for i in positions)
+			snp_masks.append(snp_mask)
+			geno_files.append(genos.enter_context(create_geno(output_name + '.geno', output_format, [driver[i][0] for i in keep_cols], [master_snp_lines[i].split()[0] for i in positions])))
+
+		# Stream the master geno file once, writing each block out to every SNP set that needs it
+		all_kept = len(keep_cols) == len(driver)
+		for start, stop, block in iter_geno_blocks(geno):
+			if not all_kept:
+				block = block[:, keep_cols]
+			for snp_mask, geno_file in zip(snp_masks, geno_files):
+				write_geno_rows(geno_file, block[snp_mask[start:stop]], output_format)
+	return [output_name for output_name, snp_file_path in outputs]
+
+def build_release_manifest(master_stem, driver_file_path, outputs, output_spec):
+	"""
+	Describes the inputs of every output of a release so that a later release can tell which outputs it can reuse (see reuse_previous_release()).
+	The master geno file is identified by its mtime and size since hashing it would mean reading it in full. The master snp file, the individual IDs in the master ind file, the driver file and the SNP set files are identified by content hash. Group IDs in the master ind file only matter through the driver file.
+
+	RETURNS:
+		manifest: Dict describing the release inputs and outputs.
+	ACCEPTS:
+		master_stem: Path to master Eigenstrat file, without extension.
+		driver_file_path: Path to the driver file for this release.
+		outputs: List of (output_name, snp_file_path) tuples. Output names should be in SNPSET/name_SNPSET format.
+		output_spec: String identifying how outputs are written (e.g. the in-process output format or the par template used). Outputs are only reused between releases with the same output_spec.
+	"""
+	return {
+		'master_stem' : abspath(master_stem),
+		'master_geno_stat' : stat_key(master_stem + '.geno'),
+		'master_snp_md5' : file_md5(master_stem + '.snp'),
+		'master_ind_ids_md5' : md5("\n".join(fields[0] for fields in read_ind_file(master_stem + '.ind')).encode()).hexdigest(),
+		'driver' : abspath(driver_file_path),
+		'driver_md5' : file_md5(driver_file_path),
+		'output_spec' : output_spec,
+		'sets' : {output_name.split('/')[0] : {'snp_file' : abspath(snp_file_path), 'snp_md5' : file_md5(snp_file_path), 'output_stem' : abspath(output_name)} for output_name, snp_file_path in outputs}
+	}
+
+def clear_output(output_name):
+	"""
+	Removes any existing output files before they are rewritten, including the side index of a CHUNKED geno file. Outputs may be hard links into a previous release, so they must be unlinked rather than truncated in place.
+	"""
+	for ext in ['.geno', '.geno' + CHUNK_INDEX_SUFFIX, '.snp', '.ind']:
+		if exists(output_name + ext):
+			remove(output_name + ext)
+
+def link_or_copy(source_path, dest_path):
+	"""
+	Hard links a file from a previous release into a new release, falling back to copying it across filesystems.
+	"""
+	if exists(dest_path):
+		remove(dest_path)
+	try:
+		link(source_path, dest_path)
+	except OSError:
+		copyfile(source_path, dest_path)
+
+def link_geno(previous_stem, output_name):
+	"""
+	Links the geno file of a previous release output into a new release, together with its side index if it is CHUNKED.
+	"""
+	link_or_copy(previous_stem + '.geno', output_name + '.geno')
+	if detect_geno_format(previous_stem + '.geno') == CHUNKED:
+		link_or_copy(previous_stem + '.geno' + CHUNK_INDEX_SUFFIX, output_name + '.geno' + CHUNK_INDEX_SUFFIX)
+
+def patch_output_columns(master_stem, previous_stem, output_name, positions, previous_driver, driver):
+	"""
+	Rebuilds a SNP set output whose SNPs are unchanged since the previous release but whose individuals differ. Genotypes of individuals that were already in the previous output are copied from it and only the newly included individuals are read from the master geno file, so the master is never scanned in full.
+
+	ACCEPTS:
+		master_stem: Path to master Eigenstrat file, without extension.
+		previous_stem: Path to the previous release's output files for this SNP set, without extension.
+		output_name: Name to use for output Eigenstrat files. Should be in SNPSET/name_SNPSET format.
+		positions: Sorted master snp file row positions of the SNP set, as returned by get_snp_set_positions().
+		previous_driver: List of driver file fields from the previous release.
+		driver: List of driver file fields for this release.
+	"""
+	previous_cols = {c : j for j, c in enumerate(i for i, fields in enumerate(previous_driver) if fields[2] != 'Ignore')}
+	keep_cols = [i for i, fields in enumerate(driver) if fields[2] != 'Ignore']
+	copied = [(k, previous_cols[c]) for k, c in enumerate(keep_cols) if c in previous_cols]
+	added = [(k, c) for k, c in enumerate(keep_cols) if c not in previous_cols]
+	copied_to, copied_from = (np.array(x, dtype=np.intp) for x in zip(*copied)) if copied else (np.array([], dtype=np.intp),) * 2
+	added_to, added_from = (np.array(x, dtype=np.intp) for x in zip(*added)) if added else (np.array([], dtype=np.intp),) * 2
+	print("{}: reusing {} individuals from the previous release and reading {} from the master.".format(output_name, len(copied), len(added)))
+
+	with ExitStack() as genos:
+		previous_geno = genos.enter_context(open_geno(previous_stem + '.geno', len(previous_cols)))
+		if previous_geno.n_snp != len(positions):
+			raise IndexError("Previous release output {} does not match the current SNP set.".format(previous_stem))
+		master_geno = genos.enter_context(open_geno(master_stem + '.geno', len(driver))) if added else None
+		clear_output(output_name)
+		with open(output_name + '.ind', 'w') as ind_file:
+			ind_file.writelines("\t".join(driver[i]) + "\n" for i in keep_cols)
+		link_or_copy(previous_stem + '.snp', output_name + '.snp')
+		with create_geno(output_name + '.geno', previous_geno.format, [driver[i][0] for i in keep_cols], read_snp_ids(output_name + '.snp')) as geno_file:
+			for start, stop, block in iter_geno_blocks(previous_geno):
+				out = np.empty((stop - start, len(keep_cols)), dtype=np.uint8)
+				out[:, copied_to] = block[:, copied_from]
+				if added:
+					out[:, added_to] = read_geno_columns(master_geno, positions[start:stop], added_from)
+				write_geno_rows(geno_file, out, previous_geno.format)
+
+def is_output_complete(output_stem, complete=False):
+	"""
+	Checks that a previous release output can be reused. Outputs built by convertf jobs submitted with sbatch are recorded as incomplete in the release manifest since the jobs may not have finished, so their .geno file must hold one row per line of their .snp file for the individuals in their .ind file.
+
+	RETURNS:
+		complete: True if the output files, and the side index of a CHUNKED geno file, exist and are recorded as complete or pass the check.
+	ACCEPTS:
+		output_stem: Path to the output Eigenstrat files, without extension.
+		complete: Whether the release manifest records the output as complete. Defaults to False.
+	"""
+	if not all(exists(output_stem + ext) for ext in ['.geno', '.snp', '.ind']):
+		return False
+	if detect_geno_format(output_stem + '.geno') == CHUNKED and not exists(output_stem + '.geno' + CHUNK_INDEX_SUFFIX):
+		return False
+	if complete:
+		return True
+	try:
+		with open_geno(output_stem + '.geno', len(read_ind_file(output_stem + '.ind'))) as geno:
+			return geno.n_snp == get_file_len(output_stem + '.snp')
+	except (ValueError, OSError):
+		return False
+
+def reuse_previous_release(previous_manifest_path, manifest, outputs, index_dir):
+	"""
+	Reuses outputs of a previous release whose inputs have not changed. SNP set outputs with identical master files, SNP set and driver file are hard linked into the new release.
+	If only the driver file changed, outputs are patched with patch_output_columns(), or only get a new ind file if no individuals were added or dropped (e.g. a group ID correction). Everything else still needs to be built, including previous outputs that fail is_output_complete().
+
+	RETURNS:
+		remaining_outputs: List of (output_name, snp_file_path) tuples that could not be reused and still need to be built.
+	ACCEPTS:
+		previous_manifest_path: Path to the release manifest written by the previous release.
+		manifest: Release manifest for this release, as returned by build_release_manifest().
+		outputs: List of (output_name, snp_file_path) tuples. Output names should be in SNPSET/name_SNPSET format.
+		index_dir: Directory holding the persistent SNP set index (see get_snp_set_positions()).
+	"""
+	with open(previous_manifest_path, 'r') as manifest_file:
+		previous = json.load(manifest_file)
+	master_keys = ['master_geno_stat', 'master_snp_md5', 'master_ind_ids_md5', 'output_spec']
+	if any(previous.get(key) != manifest[key] for key in master_keys):
+		print("Master dataset or output format changed since the previous release. Rebuilding all SNP sets.")
+		return outputs
+	driver_changed = previous['driver_md5'] != manifest['driver_md5']
+	if driver_changed:
+		if not exists(previous['driver']):
+			print("Previous release driver file {} not found. Rebuilding all SNP sets.".format(previous['driver']))
+			return outputs
+		previous_driver = read_ind_file(previous['driver'])
+		driver = read_ind_file(manifest['driver'])
+		same_individuals = [p[2] == 'Ignore' for p in previous_driver] == [d[2] == 'Ignore' for d in driver]
+
+	remaining_outputs = []
+	patch_outputs = []
+	for output_name, snp_file_path in outputs:
+		previous_set = previous['sets'].get(output_name.split('/')[0])
+		previous_stem = previous_set['output_stem'] if previous_set else ""
+		same_snps = previous_set is not None and previous_set['snp_md5'] == manifest['sets'][output_name.split('/')[0]]['snp_md5']
+		if previous_stem == abspath(output_name) and (driver_changed or not same_snps):
+			# Rebuilding in place, so the previous output cannot be read while it is being replaced
+			remaining_outputs.append((output_name, snp_file_path))
+		elif not same_snps or not is_output_complete(previous_stem, previous_set.get('complete', False)):
+			if same_snps:
+				print("{}: previous release output {} is missing or incomplete, rebuilding.".format(output_name, previous_stem))
+			remaining_outputs.append((output_name, snp_file_path))
+		elif previous_stem == abspath(output_name):
+			print("{}: unchanged since the previous release.".format(output_name))
+		elif not driver_changed:
+			print("{}: unchanged since the previous release, linking {}.".format(output_name, previous_stem))
+			clear_output(output_name)
+			link_geno(previous_stem, output_name)
+			for ext in ['.snp', '.ind']:
+				link_or_copy(previous_stem + ext, output_name + ext)
+		elif same_individuals:
+			print("{}: same individuals as the previous release, only rewriting the ind file.".format(output_name))
+			clear_output(output_name)
+			link_geno(previous_stem, output_name)
+			link_or_copy(previous_stem + '.snp', output_name + '.snp')
+			with open(output_name + '.ind', 'w') as ind_file:
+				ind_file.writelines("\t".join(fields) + "\n" for fields in driver if fields[2] != 'Ignore')
+		else:
+			patch_outputs.append((output_name, snp_file_path, previous_stem))
+
+	if patch_outputs:
+		set_positions = get_snp_set_positions(manifest['master_stem'] + '.snp', [snp_file_path for output_name, snp_file_path, previous_stem in patch_outputs], index_dir)[0]
+		for (output_name, snp_file_path, previous_stem), positions in zip(patch_outputs, set_positions):
+			patch_output_columns(manifest['master_stem'], previous_stem, output_name, positions, previous_driver, driver)
+	return remaining_outputs
+
 def get_file_len(target_file, header=False):
 	"""
 	Given a file path, return the line count. Can account for a header.
+	Newlines are counted in large binary blocks rather than by iterating over lines. A final line without a trailing newline is still counted and an empty file has no lines.
 
 	RETURNS:
 		line_count: Number of non-header lines in the target file
@@ -78,43 +670,73 @@ def get_file_len(target_file, header=False):
 		target_file: Path to the file.
 		header: Set to True if the file has a header that should not be counted in the line count. Default is False.
 	"""
-	with open(target_file) as file:
-		for i, l in enumerate(file):
-			pass
-	if header == True:
-		line_count = i
-	else:
-		line_count = i + 1
+	line_count = 0
+	last_block = b''
+	with open(target_file, 'rb') as file:
+		for block in iter(lambda: file.read(HASH_BLOCK_BYTES), b''):
+			line_count += block.count(b'\n')
+			last_block = block
+	if last_block and not last_block.endswith(b'\n'):
+		line_count += 1
+	if header == True and line_count > 0:
+		line_count -= 1
 	return line_count
 
+def check_anno_matches_ind(anno_data, sample_ids):
+	"""
+	Ensures that the anno file describes the master ind file row by row by comparing the Genetic ID column of the anno file with the ID column of the ind file. A different line count or any reordered or renamed sample is an error.
+
+	ACCEPTS:
+		anno_data: Dict of numpy arrays representing anno file data, as returned by read_anno_file(). Keys are column headers and array indicies correspond to anno file row numbers.
+		sample_ids: numpy array of the Genetic IDs in the master ind file, in order.
+	"""
+	anno_ids = anno_data[GENETIC_ID_COLUMN]
+	if len(anno_ids) != len(sample_ids):
+		raise IndexError("Length of input ind file ({}) does not match that of the specified anno file ({}).".format(len(sample_ids), len(anno_ids)))
+	mismatches = np.nonzero(anno_ids != sample_ids)[0]
+	if len(mismatches) > 0:
+		row = mismatches[0]
+		raise IndexError("Anno file does not match the input ind file: {} rows differ, starting at row {} (ind file: {}, anno file: {}).".format(len(mismatches), row + 1, sample_ids[row], anno_ids[row]))
+
+def contains_any(column, substrings):
+	"""
+	Vectorized, case-insensitive substring search over a string column.
+
+	RETURNS:
+		mask: Boolean numpy array that is True where the column value contains any of the substrings.
+	ACCEPTS:
+		column: numpy string array, e.g. an anno_data column.
+		substrings: List of substrings to search for.
+	"""
+	column = np.char.lower(column)
+	mask = np.zeros(len(column), dtype=bool)
+	for substring in substrings:
+		mask |= np.char.find(column, substring.lower()) != -1
+	return mask
+
 def exclude_by_data_type(data_types, anno_data):
 	"""
 	Finds samples to exclude based on a passed in data type(s).
 
 	RETURNS:
-		exclude_set: Set of Genetic IDs that should be dropped from the output Eigenstrat files.
+		exclude_mask: Boolean numpy array over anno file rows that is True for samples that should be dropped from the output Eigenstrat files.
 	ACCEPTS:
 		data_types: List of data sources that should be removed from the output datasets.
-		anno_data: Dict of lists representing anno file data. Keys are column headers and list indicies correspond to anno file row numbers.
+		anno_data: Dict of numpy arrays representing anno file data, as returned by read_anno_file(). Keys are column headers and array indicies correspond to anno file row numbers.
 	"""
-	# Iterate through each data type to exclude
-	exclude_set = set()
-	for data_type in data_types:
-		# Add the Genetic ID to the exclude set if the excluded data type is found in the Data source column in the anno file
-		exclude_set.update([anno_data['Genetic ID'][i] for i, v in enumerate(anno_data['Data types in bam']) if v.lower().find(data_type.lower()) != -1])
-	return exclude_set
+	# Exclude the sample if any excluded data type is found in the Data source column in the anno file
+	return contains_any(anno_data[DATA_TYPES_COLUMN], data_types)
 
 def exclude_by_assessment(assessment_threshold, anno_data):
 	"""
 	Finds samples to exclude based on anno file QC assessments.
 
 	RETURNS:
-		exclude_set: Set of Genetic IDs that should be dropped from the output Eigenstrat files.
+		exclude_mask: Boolean numpy array over anno file rows that is True for samples that should be dropped from the output Eigenstrat files.
 	ACCEPTS:
 		assessment_threshold: Set to "QUESTIONABLE" to exclude only QUESTIONABLE_CRITICAL samples. Set to "PASS" to exclude QUESTIONABLE AND QUESTIONABLE_CRITICAL samples. Any other value will cause an error.
-		anno_data: Dict of lists representing anno file data. Keys are column headers and list indicies correspond to anno file row numbers.
+		anno_data: Dict of numpy arrays representing anno file data, as returned by read_anno_file(). Keys are column headers and array indicies correspond to anno file row numbers.
 	"""
-	exclude_set = set()
 	assessment_threshold = assessment_threshold.upper()
 	if assessment_threshold == 'QUESTIONABLE':
 		exclude_assessment = 'QUESTIONABLE_CRITICAL'
@@ -122,115 +744,182 @@ def exclude_by_assessment(assessment_threshold, anno_data):
 		exclude_assessment = 'QUESTIONABLE'
 	else:
 		raise ValueError("Invalid assessment threshold! Must be either 'questionable' or 'pass'.")
-	exclude_set.update([anno_data['Genetic ID'][i] for i, v in enumerate(anno_data['ASSESSMENT']) if v.upper().find(exclude_assessment) != -1])
-	return exclude_set
+	return contains_any(anno_data[ASSESSMENT_COLUMN], [exclude_assessment])
+
+def is_mixed_udg(library_type):
+	"""
+	Determines if an anno file library type string describes a merge of more than one UDG treatment.
+	"""
+	return len(set(filter(None, library_type.replace("ss.", "").replace("ds.", "").replace("..", "").split(',')))) > 1
 
 def exclude_by_udg(udg_treatments, anno_data):	
 	"""
 	Finds samples to exclude based on anno file UDG treatments.
 
 	RETURNS:
-		exclude_set: Set of Genetic IDs that should be dropped from the output Eigenstrat files.
+		exclude_mask: Boolean numpy array over anno file rows that is True for samples that should be dropped from the output Eigenstrat files.
 	ACCEPTS:
 		udg_treatments: List of UDG treatments to exclude from the output datasets. Valid UDG treatments: 'half', 'plus', 'minus', 'mixed'. 'mixed' will exclude any sample that is a merge of more than one UDG treatment.
-		anno_data: Dict of lists representing anno file data. Keys are column headers and list indicies correspond to anno file row numbers.
-	"""
-	exclude_set = set()
-	# Iterate through each udg_treatment to exclude
-	for udg_treatment in udg_treatments:
-		if udg_treatment == 'mixed':
-			# Exclude mixed udg treatment samples
-			exclude_set.update([anno_data['Genetic ID'][i] for i,v in enumerate(anno_data['Library type (minus=no.damage.correction, half=damage.retained.at.last.position, plus=damage.fully.corrected, ds=double.stranded.library.preparation, ss=single.stranded.library.preparation)']) if len(set(filter(None, v.replace("ss.", "").replace("ds.", "").replace("..", "").split(',')))) > 1])
-		else:
-			exclude_set.update([anno_data['Genetic ID'][i] for i, v in enumerate(anno_data['Library type (minus=no.damage.correction, half=damage.retained.at.last.position, plus=damage.fully.corrected, ds=double.stranded.library.preparation, ss=single.stranded.library.preparation)']) if v.lower().find(udg_treatment.lower()) != -1])
-	return exclude_set
+		anno_data: Dict of numpy arrays representing anno file data, as returned by read_anno_file(). Keys are column headers and array indicies correspond to anno file row numbers.
+	"""
+	library_types = anno_data[LIBRARY_TYPE_COLUMN]
+	exclude_mask = contains_any(library_types, [udg_treatment for udg_treatment in udg_treatments if udg_treatment != 'mixed'])
+	if 'mixed' in udg_treatments:
+		# There are only a handful of distinct library type strings, so only parse each distinct value once and broadcast back to the rows
+		unique_types, row_ixs = np.unique(library_types, return_inverse=True)
+		exclude_mask |= np.array([is_mixed_udg(v) for v in unique_types], dtype=bool)[row_ixs]
+	return exclude_mask
 
 def exclude_unpublished(anno_data):
 	"""
 	Exludes unpublished samples. Unpublished samples are determined by scanning the Publication column in the anno file for values that contain either the string "prepub" or "unpub.
 	
 	RETURNS:
-		exclude_set: Set of Genetic IDs that should be dropped from the output Eigenstrat files.
+		exclude_mask: Boolean numpy array over anno file rows that is True for samples that should be dropped from the output Eigenstrat files.
 	ACCEPTS:
-		anno_data: Dict of lists representing anno file data. Keys are column headers and list indicies correspond to anno file row numbers.
+		anno_data: Dict of numpy arrays representing anno file data, as returned by read_anno_file(). Keys are column headers and array indicies correspond to anno file row numbers.
 	"""
-	exclude_set = set()
 	# TODO figure out if there is potentially a better way to ascertain publication status.
 	# This is just a Python implementation of how I've been doing it when constructing the HO anno file...
-	exclude_set.update([anno_data['Genetic ID'][i] for i, v in enumerate(anno_data['Publication abbreviation or plan']) if v.lower().find("unpub") != -1 or v.lower().find("prepub") != -1])
-	return exclude_set
+	return contains_any(anno_data[PUBLICATION_COLUMN], ["unpub", "prepub"])
+
+def read_id_list(list_path):
+	"""
+	Reads a new line-delimited list of Genetic IDs, ignoring blank lines and surrounding whitespace.
+	"""
+	with open(list_path, 'r') as list_file:
+		return [line.strip() for line in list_file if line.strip()]
 
-def exclude_by_custom_list(exclusion_list_path):
+def exclude_by_custom_list(exclusion_list_path, sample_ids):
 	"""
 	Excludes samples from the output datasets based on a custom list of samples.
 
 	RETURNS:
-		exclude_set: Set of Genetic IDs that should be dropped from the output Eigenstrat files.
+		exclude_mask: Boolean numpy array over ind file rows that is True for samples that should be dropped from the output Eigenstrat files.
 	ACCEPTS:
 		exclusion_list_path: Path to a new line-delimited list of Genetic IDs to be dropped from the output datasets. These should match those in the master ind file.
+		sample_ids: numpy array of the Genetic IDs in the master ind file, in order.
 	"""
-	exclude_set = set()
-	with open(exclusion_list_path, 'r') as exclusion_file:
-		exclude_set.update(exclusion_file.read().split('\n'))
-	return exclude_set
+	return np.isin(sample_ids, read_id_list(exclusion_list_path))
 
-def include_by_custom_list(inclusion_list_path, exclude_set):
+def include_by_custom_list(inclusion_list_path, exclude_mask, sample_ids):
 	"""
 	Includes samples in the output datasets based on a custom list of samples. This fucntion is used to restore specific samples that would be otherwise filtered out with other filtering functions.
 	
 	RETURNS:
-		exclude_set: Set of Genetic IDs that should be dropped from the output Eigenstrat files.
+		exclude_mask: Boolean numpy array over ind file rows that is True for samples that should be dropped from the output Eigenstrat files.
 	ACCEPTS:
 		inclusion_list_path: Path to a new line-delimited list of Genetic IDs to be restored to the output datasets if they would be otherwise dropped. These should match those in the master ind file.
-		exclude_set: Existing set of Genetic IDs to be dropped from the output Eigenstrat files.
+		exclude_mask: Existing boolean exclusion mask over ind file rows.
+		sample_ids: numpy array of the Genetic IDs in the master ind file, in order.
 	"""
-	with open(inclusion_list_path, 'r') as inclusion_file:
-		for ind in inclusion_file.readlines():
-			try:
-				exclude_set.remove(ind.strip())
-			except:
-				pass
-	return exclude_set
+	return exclude_mask & ~np.isin(sample_ids, read_id_list(inclusion_list_path))
 
-def build_driver_file(master_ind_filepath, exclusion_set, driver_filepath):
+def build_driver_file(master_ind_filepath, exclude_mask, driver_filepath):
 	"""
-	Constructs a .driver file to be specified in convertf par files given the input master dataset and a set of samples to be excluded from the output datasets.
+	Constructs a .driver file to be specified in convertf par files given the input master dataset and a mask of samples to be excluded from the output datasets.
 
 	RETURNS:
 		driver_filepath: Path to the newly created driver file
 	ACCEPTS:
 		master_ind_filepath: Path to the master ind file from which samples will be read in order to ensure ordinal integrity with output driver file.
-		exclusion_set: Set of Genetic IDs in the master ind file that should be marked as 'Ignore' in the driver file.
+		exclude_mask: Boolean numpy array over master ind file rows. Samples where this is True are marked as 'Ignore' in the driver file.
 		driver_filepath: Path, including filename and extension, where the driver file should be saved.
 	"""
-	with open(master_ind_filepath, 'r') as ind_template:
-		with open(driver_filepath, 'w') as driver:
-			for line in ind_template:
-				line = list(filter(None,re.split("\t| ", line.strip(), )))
-				ID = line[0]
-				if ID in exclusion_set:
-					driver.write("{}\t{}\tIgnore\n".format(line[0], line[1]))
-				else:
-					driver.write("{}\t{}\t{}\n".format(line[0], line[1], line[2]))
+	ind_data = read_ind_file(master_ind_filepath)
+	if len(ind_data) != len(exclude_mask):
+		raise IndexError("Length of exclusion mask does not match that of the master ind file.")
+	with open(driver_filepath, 'w') as driver:
+		driver.writelines("{}\t{}\t{}\n".format(fields[0], fields[1], "Ignore" if exclude else fields[2]) for fields, exclude in zip(ind_data, exclude_mask))
 	return abspath(driver_filepath)
 
-def read_anno_file(anno_file_path):
+def parse_anno_value(value):
+	"""
+	Parses a numeric anno file field, returning NaN for missing or otherwise non-numeric values.
+	"""
+	try:
+		return float(value)
+	except ValueError:
+		return float('nan')
+
+def read_anno_cache(cache_path, anno_stat):
+	"""
+	Loads previously parsed anno file columns from the binary cache if it is still valid for the anno file.
+
+	RETURNS:
+		columns: Dict of cached columns, or an empty dict if there is no valid cache.
+	ACCEPTS:
+		cache_path: Path to the anno cache file.
+		anno_stat: os.stat() result for the anno file. The cache is invalidated if the anno file mtime or size has changed.
+	"""
+	try:
+		with open(cache_path, 'rb') as cache_file:
+			cache = pickle.load(cache_file)
+	except (OSError, EOFError, pickle.UnpicklingError):
+		return {}
+	if cache.get('version') != ANNO_CACHE_VERSION or cache.get('mtime') != anno_stat.st_mtime_ns or cache.get('size') != anno_stat.st_size:
+		return {}
+	return cache['columns']
+
+def write_anno_cache(cache_path, anno_stat, columns):
+	"""
+	Saves parsed anno file columns to the binary cache. Failing to write the cache (e.g. in a read-only directory) is not an error.
+
+	ACCEPTS:
+		cache_path: Path to the anno cache file.
+		anno_stat: os.stat() result for the anno file that the columns were parsed from.
+		columns: Dict of parsed columns to cache.
+	"""
+	cache = {'version' : ANNO_CACHE_VERSION, 'mtime' : anno_stat.st_mtime_ns, 'size' : anno_stat.st_size, 'columns' : columns}
+	try:
+		with open(cache_path, 'wb') as cache_file:
+			pickle.dump(cache, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+	except OSError:
+		print("Unable to write anno cache to {}.".format(cache_path))
+
+def read_anno_file(anno_file_path, columns=None, use_cache=True, write_cache=True):
 	"""
-	Reads in a tab-separated anno file and parses this data into a dict of lists where the keys represent column names and the lists contain column data in the same order as the input anno file. Indicies in these lists therefore correspond to anno file (as well as ind file) rows.
+	Reads in a tab-separated anno file column-wise and parses the requested columns into a dict of numpy arrays where the keys represent column names. Array indicies correspond to anno file (as well as ind file) rows.
+	Each line is split exactly once and only the requested columns are kept. Columns in NUMERIC_ANNO_COLUMNS are stored as float arrays and all other columns as string arrays.
+	Parsed columns are cached in a binary file next to the anno file ([anno file].cache) which is reused until the anno file's mtime or size changes, so reruns with different filters do not need to re-parse the anno file.
 
 	RETURNS:
-		anno_file_data: Dict of lists representing anno file data. Keys are column headers and list indicies correspond to anno file row numbers.
+		anno_file_data: Dict of numpy arrays representing anno file data. Keys are column headers and array indicies correspond to anno file row numbers.
 	ACCEPTS:
 		anno_file_path: Path to the anno file to read in.
+		columns: List of column headers to load. The Genetic ID column is always loaded. Defaults to None, meaning all columns.
+		use_cache: Set to False to ignore and not update the anno cache. Default is True.
+		write_cache: Set to False to read the anno cache without updating it, e.g. for --plan. Default is True.
 	"""
+	cache_path = anno_file_path + '.cache'
+	anno_stat = stat(anno_file_path)
+	cached_columns = read_anno_cache(cache_path, anno_stat) if use_cache else {}
+	if columns is not None:
+		columns = list(dict.fromkeys([GENETIC_ID_COLUMN] + list(columns)))
+		if all(column in cached_columns for column in columns):
+			return {column : cached_columns[column] for column in columns}
+
 	with open(anno_file_path, "r") as f:
-		header_line = f.readline()
-		headers = header_line.split('\t')
-		anno_file_data = {header : [] for header in headers}
-		for line in f:
-			fields = line.split('\t')
-			for header in headers:
-				anno_file_data[header].append(fields[headers.index(header)])
+		headers = f.readline().rstrip('\r\n').split('\t')
+		if columns is None:
+			columns = headers
+		missing = [column for column in columns if column not in headers]
+		if missing:
+			raise KeyError("Columns not found in anno file: {}".format(", ".join(missing)))
+		column_ixs = [headers.index(column) for column in columns]
+		rows = [line.rstrip('\r\n').split('\t') for line in f if line.strip()]
+
+	anno_file_data = {}
+	for column, ix in zip(columns, column_ixs):
+		values = [fields[ix] if ix < len(fields) else '' for fields in rows]
+		if column in NUMERIC_ANNO_COLUMNS:
+			anno_file_data[column] = np.array([parse_anno_value(v) for v in values], dtype=np.float64)
+		else:
+			anno_file_data[column] = np.array(values, dtype=str)
+
+	if use_cache and write_cache:
+		cached_columns.update(anno_file_data)
+		write_anno_cache(cache_path, anno_stat, cached_columns)
 	return anno_file_data
 
 	# Override mode does not respect filters and generates a best representative sampleset  regardless of any specified filters. WARN USER IN STDOUT.
@@ -238,84 +927,63 @@ def read_anno_file(anno_file_path):
 	# Next_best mode will try to find the next best sample for each Master ID if the otherwise best representative is in the exclude_set. If no next best sample is defined, the highest coverage sample is still accepted.
 	# Next_best_strict mode functions similarly to Next_best mode. It will attempt to find the next best version of each Master ID but will NOT accept the highest coverage version if no next best, non excluded, version is found.
 
-def get_best_representatives(anno_data, preferred_data_source="", filtered_set = set(), strict = False):
+def get_best_representatives(anno_data, preferred_data_source="", filtered_mask=None, strict = False):
 	"""
 	Determine 'best representative' samples for each unique Master ID in the input data.
 	The best representative sample is defined as the sample with highest SNP count for a given Master ID.
-	This function will find all Genetic IDs for each unique Master ID and loop through them, adding all but the best representative verison to the exclude_set.
+	All rows are sorted once by (Master ID, eligibility, SNP count) and the first row of each Master ID group is kept while every other row is added to the exclusion mask.
 	
 	Under normal conditions this will drop all but the sample with the most SNPs hit.
-	However, a set of pre-filtered samples may be provded to the function. These will be skipped over while determining the best representative sample.
+	However, a mask of pre-filtered samples may be provded to the function. These will be skipped over while determining the best representative sample.
 
 	Additonally, if a preferred_data_source is set, the function will try to find the higest coverage sample for the Master ID with the specified data source.
 	If one cannot be found (or it is otherwise pre-filtered out), the highest coverage sample will be accepted and all others dropped for the Master ID.
 
-	If the strict flag is set, however, and no sample matching the preferred_data_source that is not filtered out is found, the all samples for the Master ID will be dropped.
+	If the strict flag is set, however, and no sample matching the preferred_data_source (if set) that is not filtered out is found, the all samples for the Master ID will be dropped.
 
 	RETURNS:
-		exclude_set: Existing set of Genetic IDs to be dropped from the output Eigenstrat files.
+		exclude_mask: Boolean numpy array over anno file rows that is True for samples that should be dropped from the output Eigenstrat files.
 	ACCEPTS:
-		anno_data: Dict of lists representing anno file data. Keys are column headers and list indicies correspond to anno file row numbers.
+		anno_data: Dict of numpy arrays representing anno file data, as returned by read_anno_file(). Keys are column headers and array indicies correspond to anno file row numbers.
 		preferred_data_source: Data source, corresponding to those in the Data Source column in the anno file to prefer while making best representative determinations. Defaults to "", meaning no preferred data source.
-		filtered_set: Set of Genetic IDs that should be skipped over while making best representative determinations. Defaults to an empty set, meaning no samples are pre-filtered.
+		filtered_mask: Boolean numpy array over anno file rows marking samples that should be skipped over while making best representative determinations. Defaults to None, meaning no samples are pre-filtered.
 		strict: Boolean indicating if best representative determination should be run in strict mode. Defaults to False.
 
 	"""
-	exclude_set = set()
+	n_rows = len(anno_data[MASTER_ID_COLUMN])
+	# Integer group codes sort much faster than the Master ID strings themselves
+	master_codes = np.unique(anno_data[MASTER_ID_COLUMN], return_inverse=True)[1].reshape(-1)
+	# Samples without a usable SNP count are ranked last
+	snp_counts = np.nan_to_num(anno_data[SNP_COUNT_COLUMN], nan=-np.inf)
 
-	# This was too slow
-	# master_id_set = set(anno_data['Master ID'])
+	# A sample is eligible if it has not been pre-filtered and, if a preferred data source is set, comes from that data source
+	eligible = np.ones(n_rows, dtype=bool)
+	if filtered_mask is not None:
+		eligible &= ~filtered_mask
+	if preferred_data_source != "":
+		eligible &= np.char.lower(anno_data[DATA_SOURCE_COLUMN]) == preferred_data_source.lower()
 
-	# Loop through unique master IDs after building a reverse index of unique Master IDs to occurance indicies in the anno/ind files
-	master_id_dict = {}
-	for ix, master_id in enumerate(anno_data['Master ID']):
-		if master_id in master_id_dict:
-			master_id_dict[master_id].append(ix)
-		else:
-			master_id_dict.update({master_id : [ix]})
-	for master_id in master_id_dict.keys():
-		# ...for each master ID, construct a dictionary of samples, keyed on the anno file index, containing SNP count and data source information'
-		match_ixs = {i : (anno_data['SNPs hit on autosomal targets (Computed using easystats on 3.2M snpset)'][i], anno_data['Data source'][i].lower()) for i in master_id_dict[master_id]}
-		
-		# This was way too slow...
-		# match_ixs = {i : (anno_data['SNPs hit on autosomal targets'][i], anno_data['Data source'][i].lower()) for i, v in enumerate(anno_data['Master ID']) if v == master_id}
-		
-		# Get keys sorted by SNP count
-		keys_by_cov = [k for k, v in sorted(match_ixs.items(), key = lambda x: float(x[1][0]), reverse=True)]
-		if preferred_data_source != "":
-			for i, k in enumerate(keys_by_cov):
-				# Attempt to find the higest coverage sample with our preferred data source and drop it from the exclusion set...
-				if match_ixs[k][1] == preferred_data_source.lower() and anno_data['Genetic ID'][k] not in filtered_set:
-					keys_by_cov.remove(k)
-					exclude_set.update([anno_data['Genetic ID'][id] for id in keys_by_cov])
-					break
-			# ...if we reach the end of keys_by_cov without finding a sample with our preferred data source just accept the highest coverage one and drop the rest:
-				elif i == len(keys_by_cov)-1:
-					if strict:
-						exclude_set.update([anno_data['Genetic ID'][id] for id in keys_by_cov])
-					else:
-						exclude_set.update([anno_data['Genetic ID'][id] for id in keys_by_cov[1:]])
-		# If there's no preferred data source, just accept the highest coverage sample and drop the rest
-		else:
-			for i, k in enumerate(keys_by_cov):
-				if anno_data['Genetic ID'][k] not in filtered_set:
-					try:
-						exclude_set.update([anno_data['Genetic ID'][id] for id in keys_by_cov[i+1:]])
-						break
-					except IndexError:
-						pass
-				elif i == len(keys_by_cov)-1:
-					if strict:
-						exclude_set.update([anno_data['Genetic ID'][id] for id in keys_by_cov])
-					else:
-						exclude_set.update([anno_data['Genetic ID'][id] for id in keys_by_cov[1:]])
-	return exclude_set
+	# np.lexsort sorts by the last key first and is stable, so SNP count ties keep anno file order.
+	# Within each Master ID, eligible samples come first, highest SNP count first. If a group has no eligible samples, its highest SNP count sample comes first.
+	order = np.lexsort((-snp_counts, ~eligible, master_codes))
+	sorted_codes = master_codes[order]
+	group_starts = np.ones(n_rows, dtype=bool)
+	group_starts[1:] = sorted_codes[1:] != sorted_codes[:-1]
+	best_ixs = order[group_starts]
+	# In strict mode, a Master ID with no eligible samples is dropped entirely
+	if strict:
+		best_ixs = best_ixs[eligible[best_ixs]]
+
+	exclude_mask = np.ones(n_rows, dtype=bool)
+	exclude_mask[best_ixs] = False
+	return exclude_mask
 
 if __name__ == "__main__":
 	Parser = argparse.ArgumentParser(description="Generate usable release dataset(s) based on master Eigenstrat file.")
 
 	# Specify anno file for this release. This will drive filtering fuctionality.
 	Parser.add_argument('--anno_file', help="Specify path to a tsv formatted anno file.", type=str)
+	Parser.add_argument('--no_anno_cache', help="Set this flag to neither read nor write the parsed anno file cache ([anno file].cache).", action='store_true')
 	Parser.add_argument('--master', help="Specify path to master Eigentrat files, pulled down on largest SNP union.", required=True, type=str)
 	Parser.add_argument('--label', help="Label to use on output files.", type=str, required=True)
 	# Parser.add_argument('--HO', help="Generate genotype files on HO SNPs", action='store_false')
@@ -324,9 +992,18 @@ if __name__ == "__main__":
 	# Parser.add_argument('--3M', help="Generate genotype files on the union of 1240k-enhanced + Twist-enhanced + BigYoruba + Yfull SNPs", action='store_false')
 	Parser.add_argument('--snp_sets', nargs='+', default=['Master'], choices=['HO', '1240k_classic', '2M', '3M', 'Master'])
 	Parser.add_argument('--custom_list', nargs='+', help="Generate a genotype files based on a custom .snp file. Use this option to specify the path to this file.", type=str, default=[])
-	Parser.add_argument('--foreground', help="Set this flag to run convertf in the foreground insted of submitting jobs to SLURM to run in parallel. NOT RECOMMENDED.", action="store_true")
+	Parser.add_argument('--foreground', help="Set this flag to run convertf jobs on this machine insted of submitting jobs to SLURM. Jobs run concurrently up to --local_workers and --local_memory_mb, and their exit codes and runtimes are written to [label].jobs.tsv.", action="store_true")
+	Parser.add_argument('--local_workers', help="Maximum number of convertf jobs to run at once with --foreground. Default is 1.", type=int, default=1)
+	Parser.add_argument('--local_memory_mb', help="Memory budget in MB for concurrent --foreground jobs, using the resource model's per-job predictions. Defaults to the physical memory of this machine.", type=int, default=0)
+	Parser.add_argument('--record_benchmarks', help="Set this flag to append the measured memory and runtime of successful --foreground jobs to the --resource_benchmarks table.", action="store_true")
+	Parser.add_argument('--in_process', help="Set this flag to subset all SNP sets in a single streaming pass over the master geno file in this process instead of running convertf once per SNP set. Does not use SLURM.", action="store_true")
+	Parser.add_argument('--output_format', help="Genotype format of the files written by --in_process. The master geno file may be in any of these formats; convertf output formats are set in the par template.", choices=GENO_FORMATS, default=EIGENSTRAT)
+	Parser.add_argument('--snp_index_dir', help="Directory in which to keep the persistent index of SNP set positions in the master snp file used by --in_process. Defaults to [master].snp_index.", type=str, default="")
+	Parser.add_argument('--previous_release', help="Path to the [label].release_manifest.json written by a previous release. SNP set outputs whose inputs are unchanged are linked from the previous release instead of being rebuilt, and outputs where only some individuals changed are patched column-wise.", type=str, default="")
+	Parser.add_argument('--plan', help="Set this flag to apply the filters and print the samples each one excluded and a per-SNP set table of SNP counts, output sizes in bytes, I/O volume and predicted resources, without writing a driver, par or submission file or running anything. Does not account for outputs that --previous_release would reuse.", action="store_true")
 	Parser.add_argument('--convertf_exe', help="Specify custom convertf executable. Default is stored in CONVERTF_DEFAULT.", type=str, default=CONVERTF_DEFAULT)
 	Parser.add_argument('--sbatch_template', help="Specify a custom submission script. This could be used to adapt this script to work on other schedulers. Default is stored in SBATCH_TEMPLATE", type=str, default=SBATCH_TEMPLATE)
+	Parser.add_argument('--resource_benchmarks', help="Tab-separated table of past convertf runs (n_ind, n_snp, input_format, memory_mb, runtime_minutes) used to predict the memory and wall time requested in submission scripts. Default is stored in RESOURCE_BENCHMARKS.", type=str, default=RESOURCE_BENCHMARKS)
 	Parser.add_argument('--working_dir', help="Specify the working directory. Defaults to the currect directory.", default=".")
 
 	# Filter arguments
@@ -374,22 +1051,39 @@ if __name__ == "__main__":
 	else:
 		anno_path = args.anno_file		
 
-	exclusion_set = set()
+	# Read the master ind file once. Its rows define the index that every exclusion mask is built over.
+	sample_ids = np.array([fields[0] for fields in read_ind_file(master_ind)], dtype=str)
+	exclusion_mask = np.zeros(len(sample_ids), dtype=bool)
+	# (step, samples flagged by the step, samples excluded after the step) for --plan
+	filter_report = []
 
 	# Run custom exclusion if a custom exclusion list is provided unless we're in best_representative/override mode.
 	if args.custom_exclusion != "" and (args.best_representative == False or args.best_representative_mode != 'override'):
 		list_filepath = abspath(args.custom_exclusion)
 		if exists(list_filepath):
-			exclusion_set.update(exclude_by_custom_list(list_filepath))
+			filter_mask = exclude_by_custom_list(list_filepath, sample_ids)
+			exclusion_mask |= filter_mask
+			filter_report.append(('custom_exclusion', int(filter_mask.sum()), int(exclusion_mask.sum())))
 		else:
 			raise FileNotFoundError("Custom exclusion list filepath invalid!")
 
 	# Disable sample based filters if we don't have an anno file.
 	if exists(anno_path):
-		# Make sure it's the right anno file based on line count
-		if get_file_len(anno_path, header=True) != get_file_len(master_ind, header=False):
-			raise IndexError("Length of input ind file does not match that of the specified anno file.")
-		anno_data = read_anno_file(anno_path)
+		# Only load the anno columns that the requested filters need
+		anno_columns = [GENETIC_ID_COLUMN]
+		if len(args.data_exclude) > 0:
+			anno_columns.append(DATA_TYPES_COLUMN)
+		if args.assessment_threshold != "":
+			anno_columns.append(ASSESSMENT_COLUMN)
+		if len(args.UDG_exclude) > 0:
+			anno_columns.append(LIBRARY_TYPE_COLUMN)
+		if args.published_only == True:
+			anno_columns.append(PUBLICATION_COLUMN)
+		if args.best_representative:
+			anno_columns.extend([MASTER_ID_COLUMN, SNP_COUNT_COLUMN, DATA_SOURCE_COLUMN])
+		anno_data = read_anno_file(anno_path, columns=anno_columns, use_cache=not args.no_anno_cache, write_cache=not args.plan)
+		# Make sure it's the right anno file by comparing sample IDs row by row
+		check_anno_matches_ind(anno_data, sample_ids)
 
 		# Exclusion filters
 		# These will not be applied in best representative override mode
@@ -397,34 +1091,44 @@ if __name__ == "__main__":
 			
 			# Data type filter
 			if len(args.data_exclude) > 0:
-				exclusion_set.update(exclude_by_data_type(data_types=args.data_exclude, anno_data=anno_data))
+				filter_mask = exclude_by_data_type(data_types=args.data_exclude, anno_data=anno_data)
+				exclusion_mask |= filter_mask
+				filter_report.append(('data_exclude', int(filter_mask.sum()), int(exclusion_mask.sum())))
 			
 			# Assessment threshold filter
 			if args.assessment_threshold != "":
-				exclusion_set.update(exclude_by_assessment(assessment_threshold=args.assessment_threshold, anno_data=anno_data))
+				filter_mask = exclude_by_assessment(assessment_threshold=args.assessment_threshold, anno_data=anno_data)
+				exclusion_mask |= filter_mask
+				filter_report.append(('assessment_threshold', int(filter_mask.sum()), int(exclusion_mask.sum())))
 			
 			# UDG treatment filter
 			if len(args.UDG_exclude) > 0:
-				exclusion_set.update(exclude_by_udg(udg_treatments=args.UDG_exclude, anno_data=anno_data))
+				filter_mask = exclude_by_udg(udg_treatments=args.UDG_exclude, anno_data=anno_data)
+				exclusion_mask |= filter_mask
+				filter_report.append(('UDG_exclude', int(filter_mask.sum()), int(exclusion_mask.sum())))
 			
 			# Exclude unpublished samples
 			if args.published_only == True:
-				exclusion_set.update(exclude_unpublished(anno_data=anno_data))
+				filter_mask = exclude_unpublished(anno_data=anno_data)
+				exclusion_mask |= filter_mask
+				filter_report.append(('published_only', int(filter_mask.sum()), int(exclusion_mask.sum())))
 		
 		# Define best representative sample set if --best_representative flag is set
 		if args.best_representative:
 			
 			# If the override mode is set, exclude should be empty. If we're in filter_union mode, we'll take the union of the filtered samples and the non-best representative samples
 			if args.best_representative_mode == 'override' or args.best_representative_mode == 'filter_union':
-				exclusion_set.update(get_best_representatives(anno_data=anno_data, preferred_data_source=args.preferred_data_source))
+				filter_mask = get_best_representatives(anno_data=anno_data, preferred_data_source=args.preferred_data_source)
+				exclusion_mask |= filter_mask
 			
 			# If the next_best mode is set, also pass in the pre-filtered samples.
 			elif args.best_representative_mode == 'next_best':
-				exclusion_set = get_best_representatives(anno_data=anno_data, preferred_data_source=args.preferred_data_source, filtered_set=exclusion_set)
+				filter_mask = exclusion_mask = get_best_representatives(anno_data=anno_data, preferred_data_source=args.preferred_data_source, filtered_mask=exclusion_mask)
 
 			# If the next_best_strict mode is set, pass in the pre-filtered samples and set the strict argument to True.
-			elif args.best_representative_mode == 'nest_best_strict':
-				exclusion_set = get_best_representatives(anno_data=anno_data, preferred_data_source=args.preferred_data_source, filtered_set=exclusion_set, strict=True)
+			elif args.best_representative_mode == 'next_best_strict':
+				filter_mask = exclusion_mask = get_best_representatives(anno_data=anno_data, preferred_data_source=args.preferred_data_source, filtered_mask=exclusion_mask, strict=True)
+			filter_report.append(('best_representative ({})'.format(args.best_representative_mode), int(filter_mask.sum()), int(exclusion_mask.sum())))
 	else:
 		print('Anno file not found. Filters and/or best representative mode will be NOT be applied.')
 	
@@ -432,15 +1136,15 @@ if __name__ == "__main__":
 	if args.custom_inclusion != "":
 		list_filepath = abspath(args.custom_inclusion)
 		if exists(list_filepath):
-			exclusion_set = include_by_custom_list(list_filepath, exclusion_set)
+			filter_mask = include_by_custom_list(list_filepath, exclusion_mask, sample_ids)
+			filter_report.append(('custom_inclusion', int((exclusion_mask & ~filter_mask).sum()), int(filter_mask.sum())))
+			exclusion_mask = filter_mask
 		else:
 			raise FileNotFoundError("Custom inclusion list filepath invalid!")
 
-	# Build the driver file based on the exclusion set
-	driver_file = build_driver_file(master_ind, exclusion_set, '{}.driver'.format(args.label))
-	
 	# Determine full list of snp sets to output to, including custom ones.
 	snp_sets = args.snp_sets.extend(args.custom_list)
+	outputs = []
 	for snp_set in args.snp_sets:
 		# Pull standard snp set filepaths from the global...
 		try:
@@ -452,19 +1156,84 @@ if __name__ == "__main__":
 				snp_set = basename(snp_set)[:-4]
 			else:
 				raise FileNotFoundError("{} custom SNP set does not exist!".format(snp_set))
-		# Make a directory for each output dataset by snp set
+		output_name = "{}/{}_{}".format(snp_set, args.label, snp_set)
+		outputs.append((output_name, snp_file_path))
+
+	index_dir = abspath(args.snp_index_dir) if args.snp_index_dir != "" else master_stem + '.snp_index'
+
+	# Report what the release would contain and cost, then stop before writing the driver, par or submission files
+	if args.plan:
+		if args.in_process:
+			output_format = args.output_format
+		elif exists(PAR_DEFAULT):
+			output_format = read_par_output_format(PAR_DEFAULT)
+		else:
+			print("Warning: par template {} not found, so geno sizes are not estimated.".format(PAR_DEFAULT))
+			output_format = None
+		resource_model = None if args.in_process else fit_resource_model(read_benchmarks(args.resource_benchmarks))
+		plan, master_read_bytes = plan_outputs(master_stem=master_stem, sample_ids=sample_ids, exclusion_mask=exclusion_mask, outputs=outputs, index_dir=index_dir, output_format=output_format, in_process=args.in_process, resource_model=resource_model)
+		print_plan(plan, master_read_bytes, filter_report, len(sample_ids), output_format, in_process=args.in_process)
+		sys.exit(0)
+
+	# Build the driver file based on the exclusion mask
+	driver_file = build_driver_file(master_ind, exclusion_mask, '{}.driver'.format(args.label))
+
+	# Make a directory for each output dataset by snp set
+	for output_name, snp_file_path in outputs:
 		try:
-			mkdir(snp_set)
+			mkdir(output_name.split('/')[0])
 		except:
 			pass
-		output_name = "{}/{}_{}".format(snp_set, args.label, snp_set)
+	output_spec = args.output_format if args.in_process else "convertf:" + file_md5(PAR_DEFAULT)
+	release_manifest = build_release_manifest(master_stem=master_stem, driver_file_path=driver_file, outputs=outputs, output_spec=output_spec)
 
-		par_file = build_par_file(master_stem=master_stem, snp_file_path=snp_file_path, driver_file_path=driver_file, output_name=output_name, par_template=PAR_DEFAULT)
-		
-		# Build command to run submission script or convertf directly if the forground flag is set and run.
-		if args.foreground:
-			bash_command = "{} -p {}".format(args.convertf_exe, par_file)
-		else:
-			submit = build_sbatch_script(output_name=output_name, convertf_execuable=args.convertf_exe, par_file=par_file, sbatch_template=args.sbatch_template)
-			bash_command = "{} {}".format(SUBMIT_COMMAND, submit)
-		subprocess.run(bash_command, shell=True)
+	# Reuse whatever the previous release already built from the same inputs
+	if args.previous_release != "":
+		outputs = reuse_previous_release(previous_manifest_path=abspath(args.previous_release), manifest=release_manifest, outputs=outputs, index_dir=index_dir)
+	for output_name, snp_file_path in outputs:
+		clear_output(output_name)
+
+	# Write every SNP set in one pass over the master geno file instead of running convertf per SNP set.
+	if args.in_process:
+		if outputs:
+			subset_in_process(master_stem=master_stem, driver_file_path=driver_file, outputs=outputs, index_dir=index_dir, output_format=args.output_format)
+	else:
+		# Size each convertf job from the benchmarks of past runs
+		resource_model = fit_resource_model(read_benchmarks(args.resource_benchmarks))
+		input_format = detect_geno_format(master_geno)
+		master_n_ind = len(sample_ids)
+		if input_format not in resource_model:
+			print("Not enough {} benchmarks in {} to fit the resource model. Using default resources.".format(input_format, args.resource_benchmarks))
+		local_jobs = []
+		for output_name, snp_file_path in outputs:
+			par_file = build_par_file(master_stem=master_stem, snp_file_path=snp_file_path, driver_file_path=driver_file, output_name=output_name, par_template=PAR_DEFAULT)
+			n_snp = get_file_len(snp_file_path)
+			memory_mb, runtime_minutes = predict_resources(resource_model, master_n_ind, n_snp, input_format)
+			
+			# Queue convertf to run locally if the forground flag is set, otherwise build a submission script and submit it.
+			if args.foreground:
+				local_jobs.append({'name' : output_name, 'command' : [args.convertf_exe, '-p', par_file], 'memory_mb' : memory_mb, 'log' : output_name + '.log', 'n_ind' : master_n_ind, 'n_snp' : n_snp})
+			else:
+				print("{}: requesting {} MB and {} minutes.".format(output_name, memory_mb, runtime_minutes))
+				submit = build_sbatch_script(output_name=output_name, convertf_execuable=args.convertf_exe, par_file=par_file, sbatch_template=args.sbatch_template, memory_mb=memory_mb, runtime_minutes=runtime_minutes)
+				bash_command = "{} {}".format(SUBMIT_COMMAND, submit)
+				subprocess.run(bash_command, shell=True)
+
+		if local_jobs:
+			# Default the memory budget to the physical memory of this machine
+			memory_budget_mb = args.local_memory_mb if args.local_memory_mb > 0 else sysconf('SC_PAGE_SIZE') * sysconf('SC_PHYS_PAGES') // 1024**2
+			results = run_local_jobs(local_jobs, max_workers=args.local_workers, memory_budget_mb=memory_budget_mb)
+			write_job_log('{}.jobs.tsv'.format(args.label), results)
+			if args.record_benchmarks:
+				record_benchmarks(args.resource_benchmarks, results, input_format)
+			failed = [result['name'] for result in results if result['exit_code'] != 0]
+			if failed:
+				raise RuntimeError("convertf failed for {}! See {}.jobs.tsv and the job logs.".format(", ".join(failed), args.label))
+
+	# Record this release's inputs so that the next release can be built incrementally with --previous_release.
+	# Outputs left to submitted jobs are recorded as incomplete and checked with is_output_complete() before they are reused.
+	submitted = set() if args.in_process or args.foreground else {output_name.split('/')[0] for output_name, snp_file_path in outputs}
+	for snp_set, release_set in release_manifest['sets'].items():
+		release_set['complete'] = snp_set not in submitted
+	with open('{}.release_manifest.json'.format(args.label), 'w') as manifest_file:
+		json.dump(release_manifest, manifest_file, indent=1)